@@ -0,0 +1,75 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, Optional
+
+logger = logging.getLogger("swedish_law_chat")
+
+CANCELLED_MARKER = "\n\n*[Response stopped before completion]*"
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation for one user message. The task handling the message
+    binds itself to the token; Chainlit's stop and session-end hooks call `cancel`,
+    which cancels that task so in-flight OpenAI streams are closed immediately.
+    """
+
+    def __init__(self):
+        self._event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.reason: Optional[str] = None
+
+    def bind(self, task: Optional[asyncio.Task] = None) -> "CancellationToken":
+        self._task = task or asyncio.current_task()
+        return self
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "stop") -> None:
+        if self._event.is_set():
+            return
+        self.reason = reason
+        self._event.set()
+        if self._task and not self._task.done() and self._task is not asyncio.current_task():
+            self._task.cancel()
+        logger.info(f"Cancellation requested ({reason})")
+
+
+class CancellationStats:
+    """Process-wide counters for cancelled generations and the tokens they saved"""
+
+    def __init__(self, window: int = 200, default_answer_tokens: int = 600):
+        self.counters: Dict[str, int] = {
+            "generations_cancelled": 0,
+            "regenerations_cancelled": 0,
+            "tokens_streamed_before_cancel": 0,
+            "estimated_tokens_saved": 0,
+        }
+        self.default_answer_tokens = default_answer_tokens
+        self._answer_tokens: Deque[int] = deque(maxlen=window)
+
+    def expected_answer_tokens(self) -> int:
+        if not self._answer_tokens:
+            return self.default_answer_tokens
+        return int(sum(self._answer_tokens) / len(self._answer_tokens))
+
+    def record_completed(self, tokens: int) -> None:
+        """Record the length of a fully generated answer"""
+        self._answer_tokens.append(tokens)
+
+    def record_cancelled(self, tokens_streamed: int) -> int:
+        """Record a cancelled generation and return the estimated tokens saved"""
+        saved = max(0, self.expected_answer_tokens() - tokens_streamed)
+        self.counters["generations_cancelled"] += 1
+        self.counters["tokens_streamed_before_cancel"] += tokens_streamed
+        self.counters["estimated_tokens_saved"] += saved
+        return saved
+
+    def record_regeneration_cancelled(self) -> None:
+        self.counters["regenerations_cancelled"] += 1
+
+
+CANCELLATION_STATS = CancellationStats()
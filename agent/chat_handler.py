@@ -1,8 +1,9 @@
+import asyncio
 import os
 import logging
 import time
 from datetime import datetime
-from typing import List, Dict, Tuple, Any, Optional
+from typing import List, Dict, Tuple, Any, Optional, Set
 
 from langchain_classic.chains.combine_documents import create_stuff_documents_chain
 from langchain_openai import ChatOpenAI
@@ -21,6 +22,32 @@ from langchain_core.documents import Document
 import chainlit as cl
 from langsmith import traceable
 
+from agent.rate_limiter import OPENAI_MAX_RETRIES, RATE_LIMITERS, aembed_documents_paced
+from observability.metrics import (
+    GENERATION_SECONDS,
+    STAGE_SECONDS,
+    TIME_TO_FIRST_TOKEN_SECONDS,
+    current_plan,
+    stage_timer,
+)
+from observability.tracing import set_attributes, span, traced
+from agent.cancellation import CANCELLATION_STATS, CANCELLED_MARKER
+from agent.docstore import create_chunk_store
+from agent.fakes import LAW_AGENT_BACKEND, FakeStreamingChatModel, create_fake_vector_store
+from agent.compression import CONTEXT_COMPRESSION_ENABLED, compress_documents
+from agent.summarize import MapReduceSummarizer
+from agent.memo import RetrievalMemo
+from agent.routing import ROUTING_ENABLED, StatuteRouter
+from agent.retrieval import MULTI_QUERY_MODE, decompose_query, reciprocal_rank_fusion
+from agent.resilience import (
+    CIRCUIT_BREAKERS,
+    LATENCY_TRACKERS,
+    CircuitOpenError,
+    DegradedModeCache,
+    hedged,
+    stream_with_first_token_timeout,
+)
+
 # Configure logger
 logger = logging.getLogger("swedish_law_chat")
 
@@ -29,6 +56,12 @@ class LawAgent:
     PINECONE_API_KEY = os.environ.get("PINECONE_API_KEY")
     PINECONE_ENV = os.environ.get("PINECONE_ENV", "us-west1-gcp")
     PINECONE_INDEX = os.environ.get("PINECONE_INDEX")
+    CHAT_MODEL = "gpt-4.1-2025-04-14"
+    EMBEDDING_MODEL = "text-embedding-3-large"
+    # Retrieval parameters
+    RETRIEVAL_K = 50
+    SCORE_THRESHOLD = 0.6
+    CONTEXT_DOCS = 10
     # Define supported file loaders
     FILE_LOADERS = {
         "txt": TextLoader,
@@ -63,6 +96,16 @@ class LawAgent:
             length_function=len,
         )
         self.vector_store = None
+        # Shared across sessions so degraded mode has something to fall back to
+        self.degraded_cache = DegradedModeCache()
+        # Local chunk text store when Pinecone only holds IDs and filterable fields
+        self.chunk_store = create_chunk_store()
+        # Precomputed topic routes that let core statute questions skip Pinecone
+        self.router = StatuteRouter() if ROUTING_ENABLED else None
+        if self.router is not None:
+            self.router.load()
+        # Background vector fetches for retrieval memos (referenced until done)
+        self._memo_tasks: Set[asyncio.Task] = set()
     
     def initialize_pinecone(self) -> Pinecone.Index:
         """Initialize Pinecone client and return the index"""
@@ -77,13 +120,23 @@ class LawAgent:
         """Create and return a vector store with the given index"""
         logger.info("Creating vector store with OpenAI embeddings")
         start_time = time.time()
-        embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
+        embeddings = OpenAIEmbeddings(
+            model=self.EMBEDDING_MODEL,
+            max_retries=OPENAI_MAX_RETRIES,
+            http_async_client=RATE_LIMITERS["embeddings"].async_client(),
+        )
         vector_store = PineconeVectorStore(index=index, embedding=embeddings)
         logger.info(f"Vector store created in {time.time() - start_time:.2f} seconds")
         return vector_store
     
     def setup_vector_store(self) -> Optional[PineconeVectorStore]:
         """Set up the vector store"""
+        if LAW_AGENT_BACKEND == "fake":
+            # Built once per process; sessions share the seeded store
+            if self.vector_store is None:
+                logger.info("Using the fake embedder and vector store (LAW_AGENT_BACKEND=fake)")
+                self.vector_store = create_fake_vector_store()
+            return self.vector_store
         try:
             index = self.initialize_pinecone()
             self.vector_store = self.create_vector_store(index)
@@ -93,9 +146,27 @@ class LawAgent:
             logger.error(f"Error initializing vector store: {e}")
             return None
 
+    def create_chat_model(self, temperature: float) -> ChatOpenAI:
+        """Create a chat model whose requests are paced by the shared rate limiter"""
+        if LAW_AGENT_BACKEND == "fake":
+            return FakeStreamingChatModel(temperature=temperature)
+        return ChatOpenAI(
+            model=self.CHAT_MODEL,
+            temperature=temperature,
+            max_retries=OPENAI_MAX_RETRIES,
+            http_async_client=RATE_LIMITERS["chat"].async_client(),
+        )
+
+    @property
+    def chat_model_label(self) -> str:
+        return "fake" if LAW_AGENT_BACKEND == "fake" else self.CHAT_MODEL
+
+    @property
+    def embedding_model_label(self) -> str:
+        return "fake" if LAW_AGENT_BACKEND == "fake" else self.EMBEDDING_MODEL
 
     @traceable(name="RegenerateQuestionChain")
-    def regenerate_question(self, chat_history: List[Dict[str, str]], current_question: str) -> str:
+    async def regenerate_question(self, chat_history: List[Dict[str, str]], current_question: str) -> str:
         """
         Regenerate the user's question based on the conversation history to provide context
         for follow-up questions and maintain conversation flow.
@@ -104,7 +175,7 @@ class LawAgent:
         start_time = time.time()
         
         # Initialize the chat model for question regeneration
-        chat = ChatOpenAI(model="gpt-4.1-2025-04-14", temperature=0)
+        chat = self.create_chat_model(temperature=0)
         
         # Convert chat history to LangChain message format
         messages = []
@@ -141,10 +212,16 @@ class LawAgent:
         
         # Generate the regenerated question
         chain = prompt | chat
-        regenerated = chain.invoke({
-            "history": messages[-8:-1],  # All messages except the current question
-            "question": current_question
-        })
+        try:
+            with stage_timer("regeneration", model=self.chat_model_label):
+                regenerated = await chain.ainvoke({
+                    "history": messages[-8:-1],  # All messages except the current question
+                    "question": current_question
+                })
+        except asyncio.CancelledError:
+            CANCELLATION_STATS.record_regeneration_cancelled()
+            logger.info("Question regeneration cancelled")
+            raise
         
         result = regenerated.content.strip()
         logger.info(f"Question regenerated in {time.time() - start_time:.2f} seconds")
@@ -169,11 +246,13 @@ class LawAgent:
                 
                 if loader_class:
                     logger.info(f"Loading file {file.name} with {loader_class.__name__}")
-                    loader = loader_class(file.path)
-                    docs = loader.load()
-                    
-                    # Split documents into chunks if they're too large
-                    split_docs = self.text_splitter.split_documents(docs)
+                    with span("file.parse", **{"file.extension": file_extension, "loader": loader_class.__name__}):
+                        loader = loader_class(file.path)
+                        docs = loader.load()
+                        
+                        # Split documents into chunks if they're too large
+                        split_docs = self.text_splitter.split_documents(docs)
+                        set_attributes(chunks=len(split_docs))
                     processed_docs.extend(split_docs)
                     
                     logger.info(f"Successfully processed {file.name}, extracted {len(split_docs)} chunks")
@@ -192,7 +271,8 @@ class LawAgent:
         msg,
         query: str, 
         chat_history: List[Dict[str, str]], 
-        additional_docs: Optional[List[Document]] = None
+        additional_docs: Optional[List[Document]] = None,
+        memo: Optional[RetrievalMemo] = None
     ) -> Tuple[str, List[Document]]:
         """Retrieve documents and generate a response"""
         logger.info(f"Starting retrieval and response generation for query: '{query}'")
@@ -200,23 +280,23 @@ class LawAgent:
         
         if not self.vector_store:
             logger.error("Vector store not initialized")
+            msg.metadata = {**(msg.metadata or {}), "failed": True}
             return "I'm sorry, but the knowledge base is not available right now. Please try again later.", []
         
-        # Create a retriever with similarity score threshold
-        retriever = self.vector_store.as_retriever(
-            search_type="similarity_score_threshold",
-            search_kwargs={"k": 50, "score_threshold": 0.6},
-        )
-        # Retrieve relevant documents
-        docs = retriever.invoke(query)[:10]
+        # Retrieve relevant documents (hedged, with local fallback when Pinecone is down)
+        docs = await self.retrieve_documents(query, memo=memo)
         logger.info(f"GOT DOCUMENTS FROM RETRIEVER length = {len(docs)}" )
+        context_start_time = time.perf_counter()
+        if CONTEXT_COMPRESSION_ENABLED and docs:
+            docs, report = compress_documents(query, docs)
+            logger.info(f"Compressed context from ~{report['tokens_before']} to ~{report['tokens_after']} tokens")
         # Add additional documents from file uploads if available
         if additional_docs:
             docs.extend(additional_docs)
             logger.info(f"Added {len(additional_docs)} documents from uploaded files")
         
         logger.info(f"Retrieved total of {len(docs)} documents in {time.time() - retrieval_start_time:.2f} seconds")
-        chat = ChatOpenAI(model="gpt-4.1-2025-04-14", temperature=0.4)
+        chat = self.create_chat_model(temperature=0.4)
         
         # Define the system template
         uslaw_expert_prompt = """
@@ -287,19 +367,249 @@ class LawAgent:
         logger.info("Starting response generation")
         generation_start_time = time.time()
         
+        model_label = self.chat_model_label
+        STAGE_SECONDS.observe(
+            time.perf_counter() - context_start_time,
+            stage="context_assembly", model=model_label, plan=current_plan(),
+        )
+
+        breaker = CIRCUIT_BREAKERS["openai_chat"]
+        if not breaker.allow():
+            return await self._degraded_answer(msg, query)
+        
+        tokens_streamed = 0
+        generation_clock = time.perf_counter()
+        with span("generation", model=model_label, context_documents=len(docs)):
+            try:
+                stream = stream_with_first_token_timeout(
+                    lambda: document_chain.astream(
+                        {
+                            "context": docs,
+                            "messages": messages,
+                        }
+                    )
+                )
+                async for token in stream:
+                    if tokens_streamed == 0:
+                        TIME_TO_FIRST_TOKEN_SECONDS.observe(
+                            time.perf_counter() - generation_clock, model=model_label, plan=current_plan()
+                        )
+                    tokens_streamed += 1
+                    await msg.stream_token(token)
+
+                # Update with final content
+                await msg.update()
+                GENERATION_SECONDS.observe(time.perf_counter() - generation_clock, model=model_label, plan=current_plan())
+                breaker.record_success()
+                CANCELLATION_STATS.record_completed(tokens_streamed)
+                if not additional_docs and len(chat_history) <= 1:
+                    # The cache is shared by every user; only answers built from the
+                    # question alone, without uploads or earlier turns of the
+                    # thread, may be served to anyone else
+                    self.degraded_cache.remember_answer(query, msg.content)
+                set_attributes(tokens=tokens_streamed)
+                logger.info(f"Response generated in {time.time() - generation_start_time:.2f} seconds")
+                return msg.content, docs
+            except asyncio.CancelledError:
+                # The upstream stream has already been closed by the cancellation;
+                # persist what the user saw so the thread history stays truthful
+                breaker.release()
+                saved = CANCELLATION_STATS.record_cancelled(tokens_streamed)
+                logger.info(f"Generation cancelled after {tokens_streamed} tokens (~{saved} tokens saved)")
+                msg.content = (msg.content or "") + CANCELLED_MARKER
+                msg.metadata = {**(msg.metadata or {}), "cancelled": True}
+                await msg.update()
+                raise
+            except Exception as e:
+                breaker.record_failure()
+                logger.error(f"Error generating response: {e}")
+                msg.metadata = {**(msg.metadata or {}), "failed": True}
+                return "I'm sorry, but I encountered an error while generating a response. Please try again.", []
+
+    @traced("summarization")
+    async def summarize_uploaded_documents(
+        self, msg, request: str, docs: List[Document]
+    ) -> Tuple[str, List[Document]]:
+        """Summarize large uploads with the parallel map-reduce pipeline, streaming into msg"""
+        start_time = time.time()
+        summarizer = MapReduceSummarizer(self.create_chat_model(temperature=0))
+        final_started = False
+
+        async def report_progress(text: str) -> None:
+            msg.content = f"_{text}_"
+            await msg.update()
+
+        tokens_streamed = 0
         try:
-            async for token in document_chain.astream(
-                {
-                    "context": docs,
-                    "messages": messages,
-                }
-            ):
+            async for token in summarizer.summarize(request, docs, on_progress=report_progress):
+                if not final_started:
+                    # Replace the progress line with the streamed summary
+                    msg.content = ""
+                    final_started = True
+                tokens_streamed += 1
                 await msg.stream_token(token)
-
-            # Update with final content
             await msg.update()
-            logger.info(f"Response generated in {time.time() - generation_start_time:.2f} seconds")
+            logger.info(f"Summary of {len(docs)} chunks generated in {time.time() - start_time:.2f} seconds")
             return msg.content, docs
+        except asyncio.CancelledError:
+            CANCELLATION_STATS.record_cancelled(tokens_streamed)
+            msg.content = (msg.content if final_started else "") + CANCELLED_MARKER
+            msg.metadata = {**(msg.metadata or {}), "cancelled": True}
+            await msg.update()
+            raise
+        except Exception as e:
+            logger.error(f"Error summarizing documents: {e}")
+            # Replace the progress line (or partial summary) with the error
+            msg.content = "I'm sorry, but I encountered an error while summarizing your documents. Please try again."
+            msg.metadata = {**(msg.metadata or {}), "failed": True}
+            await msg.update()
+            return msg.content, []
+
+    @traced("retrieval")
+    async def retrieve_documents(self, query: str, memo: Optional[RetrievalMemo] = None) -> List[Document]:
+        """
+        Embed the query and search Pinecone, hedging each call after its adaptive p95
+        delay. If either dependency fails or its circuit is open, fall back to the
+        local index of recently retrieved documents.
+
+        With MULTI_QUERY_MODE enabled, questions spanning several jurisdictions or
+        sub-issues are decomposed; all queries are embedded in one batch, searched
+        concurrently and fused with reciprocal-rank fusion.
+
+        When a per-thread memo is given, each query is first scored against the
+        candidates of earlier turns and only goes to Pinecone if the memo cannot
+        cover it.
+
+        In document-store mode candidates carry only IDs and scores until the final
+        top-k is hydrated from the local chunk store.
+        """
+        decomposer = self.create_chat_model(temperature=0) if MULTI_QUERY_MODE == "llm" else None
+        queries = await decompose_query(query, chat_model=decomposer)
+        try:
+            embeddings = await self._embed_queries(queries)
+            results = await asyncio.gather(
+                *(self._search_by_vector(embedding, memo) for embedding in embeddings)
+            )
+        except CircuitOpenError as e:
+            logger.warning(f"{e}; using local fallback index")
+            return self.degraded_cache.search(query, k=self.CONTEXT_DOCS)
         except Exception as e:
-            logger.error(f"Error generating response: {e}")
-            return "I'm sorry, but I encountered an error while generating a response. Please try again.", []
+            logger.error(f"Retrieval failed, using local fallback index: {e}")
+            return self.degraded_cache.search(query, k=self.CONTEXT_DOCS)
+
+        if len(results) == 1:
+            docs = results[0][: self.CONTEXT_DOCS]
+        else:
+            docs = reciprocal_rank_fusion(results, top_k=self.CONTEXT_DOCS)
+        if self.chunk_store is not None:
+            # Only the final top-k are hydrated with their text
+            docs = await self.chunk_store.hydrate(docs)
+        self.degraded_cache.remember_documents(docs)
+        set_attributes(queries=len(queries), documents=len(docs))
+        return docs
+
+    async def _embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """Embed one or more queries with a single (hedged) embeddings request"""
+        embeddings = self.vector_store.embeddings
+        if len(queries) == 1:
+            call = lambda: embeddings.aembed_query(queries[0])
+        else:
+            # Sub-queries go out in TPM-shaped batches like every other bulk embedding
+            call = lambda: aembed_documents_paced(embeddings, queries)
+        with stage_timer("embedding", model=self.embedding_model_label):
+            result = await CIRCUIT_BREAKERS["embeddings"].call(
+                lambda: hedged(call, LATENCY_TRACKERS["embeddings"])
+            )
+        return [result] if len(queries) == 1 else result
+
+    async def _search_by_vector(
+        self, embedding: List[float], memo: Optional[RetrievalMemo] = None
+    ) -> List[Document]:
+        """Query Pinecone (hedged) and keep candidates above the relevance threshold"""
+        if self.router is not None:
+            routed = self.router.route(embedding)
+            if routed:
+                return routed[1]
+
+        relevance = self.vector_store._select_relevance_score_fn()
+        if memo is not None:
+            local_docs = memo.covered(embedding, self.CONTEXT_DOCS, relevance)
+            if local_docs:
+                return local_docs
+
+        with stage_timer("vector_query", model=self.embedding_model_label):
+            results = await CIRCUIT_BREAKERS["pinecone"].call(
+                lambda: hedged(lambda: self._query_index(embedding), LATENCY_TRACKERS["pinecone"])
+            )
+        relevant = []
+        for doc, score in results:
+            if relevance(score) >= self.SCORE_THRESHOLD:
+                doc.metadata["relevance"] = relevance(score)
+                relevant.append(doc)
+        if memo is not None and relevant:
+            self._remember_in_memo(memo, relevant)
+        return relevant
+
+    async def _query_index(self, embedding: List[float]) -> List[Tuple[Document, float]]:
+        """
+        Return (document, score) candidates for an embedding. In document-store mode
+        the documents are ID-only placeholders with the slim metadata.
+        """
+        if self.chunk_store is None:
+            return await self.vector_store.asimilarity_search_by_vector_with_score(
+                embedding, k=self.RETRIEVAL_K
+            )
+
+        response = await asyncio.to_thread(
+            self.vector_store.index.query,
+            vector=embedding,
+            top_k=self.RETRIEVAL_K,
+            include_metadata=True,
+        )
+        text_key = self.vector_store._text_key
+        candidates = []
+        for match in response["matches"]:
+            metadata = dict(match["metadata"] or {})
+            text = metadata.pop(text_key, "")
+            doc = Document(id=match.get("id"), page_content=text, metadata=metadata)
+            candidates.append((doc, match["score"]))
+        return candidates
+
+    def _remember_in_memo(self, memo: RetrievalMemo, docs: List[Document]) -> None:
+        """
+        Add the kept candidates to the memo once their vectors are fetched. Only these
+        few vectors are fetched, and off the answer's critical path, instead of asking
+        the query for the values of all RETRIEVAL_K matches.
+        """
+        task = asyncio.get_running_loop().create_task(self._fetch_into_memo(memo, docs))
+        self._memo_tasks.add(task)
+        task.add_done_callback(self._memo_tasks.discard)
+
+    async def _fetch_into_memo(self, memo: RetrievalMemo, docs: List[Document]) -> None:
+        ids = [doc.id for doc in docs if doc.id]
+        if not ids:
+            return
+        try:
+            response = await asyncio.to_thread(self.vector_store.index.fetch, ids=ids)
+        except Exception as e:
+            logger.warning(f"Could not fetch vectors for the retrieval memo: {e}")
+            return
+        vectors = response["vectors"] if isinstance(response, dict) else response.vectors
+        candidates = []
+        for doc in docs:
+            vector = vectors.get(doc.id)
+            if vector is not None:
+                candidates.append((doc, vector["values"] if isinstance(vector, dict) else vector.values))
+        memo.add(candidates)
+
+    async def _degraded_answer(self, msg, query: str) -> Tuple[str, List[Document]]:
+        """Answer from the cache while the generation circuit is open"""
+        cached = self.degraded_cache.cached_answer(query)
+        if cached:
+            logger.warning("Generation circuit open, serving cached answer")
+            await msg.stream_token(cached)
+            await msg.update()
+            return msg.content, []
+        logger.warning("Generation circuit open and no cached answer available")
+        msg.metadata = {**(msg.metadata or {}), "failed": True}
+        return "I'm sorry, the answer service is temporarily unavailable. Please try again in a minute.", []
@@ -0,0 +1,192 @@
+"""
+Local extractive compression of retrieved chunks before generation.
+
+Chunks are split into sentences and each sentence is scored against the question
+with IDF-weighted term overlap plus the relevance score its chunk got from the
+vector search. The best sentences are kept, in their original order, until the
+target compression ratio is reached. The chunk's first citation is always kept as
+an anchor so the model can still cite the source.
+
+Report prompt-token reduction and key-fact retention on the fixed eval set:
+
+    python -m agent.compression eval/compression_v1.jsonl
+"""
+
+import json
+import logging
+import math
+import os
+import re
+import sys
+from typing import Dict, List, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+logger = logging.getLogger("swedish_law_chat")
+
+CONTEXT_COMPRESSION_ENABLED = os.environ.get("CONTEXT_COMPRESSION_ENABLED", "false").lower() == "true"
+COMPRESSION_RATIO = float(os.environ.get("COMPRESSION_RATIO", "0.5"))
+# Weight of lexical overlap vs. the chunk's embedding relevance
+LEXICAL_WEIGHT = 0.7
+# Share of a sentence's lexical score passed on to the next one (enumerations, provisos)
+CARRYOVER = 0.5
+
+_ABBREVIATIONS = [
+    "U.S.C", "U.S", "Stat", "Code", "Fam", "Ann", "Rev", "Gen", "Civ", "Proc", "Cal", "Fla",
+    "Tex", "N.Y", "Dom", "Rel", "Sec", "Art", "No", "Nos", "v", "vs", "Inc", "Co", "e.g", "i.e",
+    "Mr", "Mrs", "Ms", "Dr", "St", "Ch", "Subd", "Para", "Cf",
+]
+_PLACEHOLDER = "\u0000"
+_ABBREVIATION_PATTERN = re.compile(r"\b(" + "|".join(re.escape(a) for a in _ABBREVIATIONS) + r")\.")
+_SENTENCE_BOUNDARY = re.compile(
+    r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9§])|\s+(?=\([a-z0-9]{1,4}\)\s)|\n{2,}"
+)
+_CITATION_PATTERN = re.compile(
+    r"([A-Z][A-Za-z.]*\s){0,4}(Code|Stat\.?|U\.S\.C\.|Law|Rules?)\s*(Ann\.\s*)?§+\s*[\d.\-:()a-z]+"
+    r"|§+\s*[\d.\-:()a-z]+"
+)
+_BOILERPLATE_LINE = re.compile(
+    r"^\s*(table of contents|contents:?|page \d+\.?)\s*$|\.{4,}\s*\d+[\s.;]*$", re.IGNORECASE | re.MULTILINE
+)
+# Fragments shorter than this (headings, stray numbering) are merged into the next sentence
+MIN_SENTENCE_TERMS = 4
+_STOPWORDS = {
+    "the", "and", "for", "are", "was", "were", "that", "this", "with", "from", "which", "what",
+    "how", "does", "can", "any", "may", "shall", "under", "into", "their", "there", "has",
+    "have", "been", "not", "but", "its", "his", "her", "all", "such", "each", "other",
+}
+
+
+def split_sentences(text: str) -> List[str]:
+    """Split legal text into sentences without breaking on citation abbreviations"""
+    text = _BOILERPLATE_LINE.sub(" ", text)
+    protected = _ABBREVIATION_PATTERN.sub(lambda m: m.group(1) + _PLACEHOLDER, text)
+    sentences = []
+    pending = ""
+    for part in _SENTENCE_BOUNDARY.split(protected):
+        if not part:
+            continue
+        sentence = " ".join(part.replace(_PLACEHOLDER, ".").split())
+        if not sentence:
+            continue
+        sentence = f"{pending} {sentence}".strip()
+        # Headings and stray numbering are attached to the sentence that follows them
+        if len(_terms(sentence)) < MIN_SENTENCE_TERMS:
+            pending = sentence
+            continue
+        sentences.append(sentence)
+        pending = ""
+    if pending:
+        sentences.append(pending)
+    return sentences
+
+
+def _terms(text: str) -> List[str]:
+    return [t for t in re.findall(r"[a-z0-9§]+", text.lower()) if len(t) > 2 and t not in _STOPWORDS]
+
+
+def estimate_prompt_tokens(docs: Sequence[Document]) -> int:
+    return sum(max(1, len(doc.page_content) // 4) for doc in docs)
+
+
+def compress_documents(
+    question: str,
+    docs: Sequence[Document],
+    ratio: float = COMPRESSION_RATIO,
+) -> Tuple[List[Document], Dict[str, int]]:
+    """
+    Return compressed copies of the documents and a small report with the
+    estimated prompt tokens before and after compression.
+    """
+    chunk_sentences = [split_sentences(doc.page_content) for doc in docs]
+    all_sentences = [s for sentences in chunk_sentences for s in sentences]
+    query_terms = set(_terms(question))
+
+    # Inverse document frequency over the candidate sentences
+    document_frequency: Dict[str, int] = {}
+    for sentence in all_sentences:
+        for term in set(_terms(sentence)):
+            document_frequency[term] = document_frequency.get(term, 0) + 1
+    total = max(1, len(all_sentences))
+    idf = {term: math.log(1 + total / df) for term, df in document_frequency.items()}
+    max_lexical = sum(idf.get(term, 0.0) for term in query_terms) or 1.0
+
+    scored: List[Tuple[float, int, int]] = []
+    for doc_index, (doc, sentences) in enumerate(zip(docs, chunk_sentences)):
+        relevance = float(doc.metadata.get("relevance", 0.5))
+        previous = 0.0
+        for sentence_index, sentence in enumerate(sentences):
+            terms = _terms(sentence)
+            overlap = query_terms & set(terms)
+            lexical = sum(idf.get(term, 0.0) for term in overlap) / max_lexical
+            lexical, previous = max(lexical, CARRYOVER * previous), lexical
+            score = LEXICAL_WEIGHT * lexical + (1 - LEXICAL_WEIGHT) * relevance
+            scored.append((score, doc_index, sentence_index))
+
+    budget = int(sum(len(doc.page_content) for doc in docs) * ratio)
+    kept: Dict[int, set] = {i: set() for i in range(len(docs))}
+    used = 0
+    for score, doc_index, sentence_index in sorted(scored, reverse=True):
+        length = len(chunk_sentences[doc_index][sentence_index])
+        if used + length > budget and used > 0:
+            continue
+        kept[doc_index].add(sentence_index)
+        used += length
+
+    compressed: List[Document] = []
+    for doc_index, doc in enumerate(docs):
+        if not kept[doc_index]:
+            continue
+        sentences = chunk_sentences[doc_index]
+        content = " … ".join(sentences[i] for i in sorted(kept[doc_index]))
+        anchor = _CITATION_PATTERN.search(doc.page_content)
+        if anchor and anchor.group(0).strip() not in content:
+            content = f"[{anchor.group(0).strip()}] {content}"
+        compressed.append(Document(id=doc.id, page_content=content, metadata=dict(doc.metadata)))
+
+    report = {
+        "tokens_before": estimate_prompt_tokens(docs),
+        "tokens_after": estimate_prompt_tokens(compressed),
+    }
+    return compressed, report
+
+
+def evaluate(path: str, ratio: float = COMPRESSION_RATIO) -> Dict[str, float]:
+    """
+    Run the fixed compression eval set. Each line holds a question, its retrieved
+    chunks and the key facts a correct answer needs; retention of those facts in the
+    compressed context is the answer-quality proxy (1.0 = nothing needed was lost).
+    """
+    tokens_before = tokens_after = 0
+    facts_total = facts_kept_full = facts_kept_compressed = 0
+    with open(path) as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+    for case in cases:
+        docs = [
+            Document(page_content=chunk["text"], metadata={"relevance": chunk.get("relevance", 0.5)})
+            for chunk in case["chunks"]
+        ]
+        compressed, report = compress_documents(case["question"], docs, ratio=ratio)
+        tokens_before += report["tokens_before"]
+        tokens_after += report["tokens_after"]
+        full_text = " ".join(doc.page_content for doc in docs).lower()
+        compressed_text = " ".join(doc.page_content for doc in compressed).lower()
+        for fact in case["key_facts"]:
+            facts_total += 1
+            facts_kept_full += fact.lower() in full_text
+            facts_kept_compressed += fact.lower() in compressed_text
+    return {
+        "cases": len(cases),
+        "ratio": ratio,
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "token_reduction": round(1 - tokens_after / max(1, tokens_before), 3),
+        "fact_retention_full": round(facts_kept_full / max(1, facts_total), 3),
+        "fact_retention_compressed": round(facts_kept_compressed / max(1, facts_total), 3),
+    }
+
+
+if __name__ == "__main__":
+    eval_path = sys.argv[1] if len(sys.argv) > 1 else "eval/compression_v1.jsonl"
+    for target_ratio in (0.3, 0.5, 0.7):
+        print(json.dumps(evaluate(eval_path, ratio=target_ratio)))
@@ -0,0 +1,375 @@
+"""
+Local chunk document store for slim retrieval payloads.
+
+In document-store mode Pinecone only holds vectors, chunk IDs and small filterable
+metadata fields; the chunk text lives locally, either in a Postgres table or in a
+memory-mapped file pair, behind a hot LRU cache. Retrieval works on IDs and scores
+only and hydrates the final top-k documents right before generation.
+
+Build the store (and optionally strip the text from Pinecone metadata) with:
+
+    python -m agent.docstore build [--slim]
+
+`--slim` runs as a second pass after the full store has been written, and only
+strips a vector's text once the store returns that exact text, so an
+interrupted run can simply be started again.
+"""
+
+import asyncio
+import json
+import logging
+import mmap
+import os
+import sys
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+logger = logging.getLogger("swedish_law_chat")
+
+# off | postgres | mmap
+DOCSTORE_MODE = os.environ.get("DOCSTORE_MODE", "off").lower()
+DOCSTORE_PATH = os.environ.get("DOCSTORE_PATH", "data/chunks")
+DOCSTORE_TABLE = os.environ.get("DOCSTORE_TABLE", "retrieval_chunks")
+DOCSTORE_CACHE_SIZE = int(os.environ.get("DOCSTORE_CACHE_SIZE", "5000"))
+# Metadata fields kept in Pinecone in slim mode (everything else moves to the store)
+SLIM_METADATA_FIELDS = [
+    f.strip() for f in os.environ.get("SLIM_METADATA_FIELDS", "state,source,section").split(",") if f.strip()
+]
+
+Chunk = Tuple[str, Dict]
+
+
+class ChunkStore(ABC):
+    """Base class: an ID → (text, metadata) lookup fronted by an LRU cache"""
+
+    def __init__(self, cache_size: int = DOCSTORE_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Chunk]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @abstractmethod
+    async def _fetch(self, ids: Sequence[str]) -> Dict[str, Chunk]:
+        """Read the given IDs from storage, skipping unknown ones"""
+
+    @abstractmethod
+    async def write(self, chunks: Iterable[Tuple[str, str, Dict]]) -> int:
+        """Insert or replace chunks; returns how many were written"""
+
+    async def close(self) -> None:
+        pass
+
+    async def get_many(self, ids: Sequence[str]) -> Dict[str, Chunk]:
+        """Return the chunks for the given IDs, reading only cache misses from storage"""
+        found: Dict[str, Chunk] = {}
+        missing: List[str] = []
+        for chunk_id in ids:
+            if chunk_id in self._cache:
+                self._cache.move_to_end(chunk_id)
+                found[chunk_id] = self._cache[chunk_id]
+                self.hits += 1
+            elif chunk_id not in missing:
+                missing.append(chunk_id)
+        if missing:
+            self.misses += len(missing)
+            fetched = await self._fetch(missing)
+            for chunk_id, chunk in fetched.items():
+                self._cache[chunk_id] = chunk
+                found[chunk_id] = chunk
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return found
+
+    async def hydrate(self, docs: Sequence[Document]) -> List[Document]:
+        """
+        Fill in the text (and stored metadata) of ID-only documents in place. Documents
+        that already carry text are left untouched; IDs missing from the store are
+        dropped.
+        """
+        pending = [doc.id for doc in docs if not doc.page_content and doc.id]
+        if not pending:
+            return list(docs)
+        chunks = await self.get_many(pending)
+        hydrated = []
+        for doc in docs:
+            if doc.page_content:
+                hydrated.append(doc)
+                continue
+            chunk = chunks.get(doc.id)
+            if chunk is None:
+                logger.warning(f"Chunk {doc.id} not found in the document store")
+                continue
+            text, metadata = chunk
+            doc.page_content = text
+            doc.metadata = {**metadata, **doc.metadata}
+            hydrated.append(doc)
+        return hydrated
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "cached": len(self._cache),
+        }
+
+
+class PostgresChunkStore(ChunkStore):
+    """
+    Chunks in a Postgres table, fetched with one `id = ANY(:ids)` query per hydration.
+    Queries run on the shared data layer's engine, so the store adds no connection
+    pool of its own.
+    """
+
+    def __init__(self, table: str = DOCSTORE_TABLE, cache_size: int = DOCSTORE_CACHE_SIZE, engine=None):
+        super().__init__(cache_size)
+        self._engine = engine
+        self.table = table
+
+    @property
+    def engine(self):
+        if self._engine is not None:
+            return self._engine
+        # Looked up on use: the agent is built before Chainlit creates the data layer
+        from sql_data_layer import get_shared_data_layer
+
+        return get_shared_data_layer().engine
+
+    async def create_table(self) -> None:
+        from sqlalchemy import text
+
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                text(
+                    f"""CREATE TABLE IF NOT EXISTS {self.table} (
+                        "id" TEXT PRIMARY KEY,
+                        "text" TEXT NOT NULL,
+                        "metadata" JSONB NOT NULL DEFAULT '{{}}'
+                    )"""
+                )
+            )
+
+    async def _fetch(self, ids: Sequence[str]) -> Dict[str, Chunk]:
+        from sqlalchemy import text
+
+        from observability.runtime import pooled_connection
+
+        async with pooled_connection(self.engine) as conn:
+            result = await conn.execute(
+                text(f"""SELECT "id", "text", "metadata" FROM {self.table} WHERE "id" = ANY(:ids)"""),
+                {"ids": list(ids)},
+            )
+            rows = result.mappings().all()
+        return {
+            row["id"]: (
+                row["text"],
+                json.loads(row["metadata"]) if isinstance(row["metadata"], str) else dict(row["metadata"] or {}),
+            )
+            for row in rows
+        }
+
+    async def write(self, chunks: Iterable[Tuple[str, str, Dict]]) -> int:
+        from sqlalchemy import text
+
+        rows = [{"id": i, "text": t, "metadata": json.dumps(m)} for i, t, m in chunks]
+        if not rows:
+            return 0
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                text(
+                    f"""INSERT INTO {self.table} ("id", "text", "metadata")
+                        VALUES (:id, :text, CAST(:metadata AS JSONB))
+                        ON CONFLICT ("id") DO UPDATE
+                        SET "text" = EXCLUDED."text", "metadata" = EXCLUDED."metadata"
+                    """
+                ),
+                rows,
+            )
+        return len(rows)
+
+
+class MmapChunkStore(ChunkStore):
+    """
+    Chunks in a compact file pair: `chunks.bin` holds JSON records back to back and
+    `chunks.idx.json` maps each ID to its (offset, length). Reads slice the mapped
+    file, so the OS page cache does the caching below the LRU.
+    """
+
+    def __init__(self, path: str = DOCSTORE_PATH, cache_size: int = DOCSTORE_CACHE_SIZE):
+        super().__init__(cache_size)
+        self.path = path
+        self._data_path = os.path.join(path, "chunks.bin")
+        self._index_path = os.path.join(path, "chunks.idx.json")
+        self._index: Dict[str, Tuple[int, int]] = {}
+        self._mmap: Optional[mmap.mmap] = None
+        self._open()
+
+    def _open(self) -> None:
+        exists = os.path.exists(self._index_path) and os.path.exists(self._data_path)
+        if not exists or not os.path.getsize(self._data_path):
+            logger.warning(f"Chunk store at {self.path} is empty")
+            return
+        with open(self._index_path) as f:
+            self._index = {k: tuple(v) for k, v in json.load(f).items()}
+        with open(self._data_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    async def _fetch(self, ids: Sequence[str]) -> Dict[str, Chunk]:
+        found: Dict[str, Chunk] = {}
+        if self._mmap is None:
+            return found
+        for chunk_id in ids:
+            location = self._index.get(chunk_id)
+            if location is None:
+                continue
+            offset, length = location
+            record = json.loads(self._mmap[offset : offset + length])
+            found[chunk_id] = (record["text"], record.get("metadata", {}))
+        return found
+
+    async def write(self, chunks: Iterable[Tuple[str, str, Dict]]) -> int:
+        """
+        Rewrite the file pair with the given chunks plus the stored ones they do not
+        replace. The new pair is written next to the old one and swapped in at the end.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        records: Dict[str, bytes] = {}
+        for chunk_id, text, metadata in chunks:
+            records[chunk_id] = json.dumps({"text": text, "metadata": metadata}, ensure_ascii=False).encode("utf-8")
+        written = len(records)
+        if self._mmap is not None:
+            for chunk_id, (offset, length) in self._index.items():
+                if chunk_id not in records:
+                    records[chunk_id] = self._mmap[offset : offset + length]
+            self._mmap.close()
+            self._mmap = None
+        index: Dict[str, Tuple[int, int]] = {}
+        offset = 0
+        with open(self._data_path + ".tmp", "wb") as f:
+            for chunk_id, record in records.items():
+                f.write(record)
+                index[chunk_id] = (offset, len(record))
+                offset += len(record)
+        with open(self._index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(self._data_path + ".tmp", self._data_path)
+        os.replace(self._index_path + ".tmp", self._index_path)
+        self._cache.clear()
+        self._open()
+        return written
+
+    async def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+def create_chunk_store(mode: Optional[str] = None) -> Optional[ChunkStore]:
+    """Build the configured chunk store, or None when document-store mode is off"""
+    mode = mode or DOCSTORE_MODE
+    if mode == "off":
+        return None
+    if mode == "postgres":
+        conninfo = os.environ.get("DATABASE_URL")
+        if not conninfo:
+            raise ValueError("DATABASE_URL environment variable is required for DOCSTORE_MODE=postgres")
+        return PostgresChunkStore()
+    if mode == "mmap":
+        return MmapChunkStore()
+    raise ValueError(f"Unknown DOCSTORE_MODE: {mode}")
+
+
+def slim_metadata(metadata: Dict, fields: Sequence[str] = SLIM_METADATA_FIELDS) -> Dict:
+    """Metadata kept in Pinecone: only small fields used for filtering"""
+    return {k: v for k, v in metadata.items() if k in fields}
+
+
+async def build_from_index(index, store: ChunkStore, text_key: str = "text", slim: bool = False) -> int:
+    """
+    Copy every chunk's text and metadata from a Pinecone index into the store. With
+    `slim`, a second pass then re-upserts the vectors with only SLIM_METADATA_FIELDS
+    as metadata (see slim_index).
+    """
+    chunks: List[Tuple[str, str, Dict]] = []
+    for ids in index.list():
+        response = await asyncio.to_thread(index.fetch, ids=list(ids))
+        for chunk_id, vector in response.vectors.items():
+            metadata = dict(vector.metadata or {})
+            text = metadata.pop(text_key, None)
+            # Vectors slimmed by an earlier run keep their text in the store
+            if text is not None:
+                chunks.append((chunk_id, text, metadata))
+        logger.info(f"Collected {len(chunks)} chunks from the index")
+    written = await store.write(chunks)
+    if slim:
+        await slim_index(index, store, text_key)
+    return written
+
+
+async def slim_index(index, store: ChunkStore, text_key: str = "text") -> int:
+    """
+    Strip the chunk text from Pinecone metadata, page by page. A vector is only
+    re-upserted once the store returns exactly its text, so nothing is slimmed that
+    could not be hydrated again. Returns how many vectors were slimmed.
+    """
+    slimmed = 0
+    unverified = 0
+    for ids in index.list():
+        response = await asyncio.to_thread(index.fetch, ids=list(ids))
+        pending = {}
+        for chunk_id, vector in response.vectors.items():
+            metadata = dict(vector.metadata or {})
+            text = metadata.pop(text_key, None)
+            if text is not None:
+                pending[chunk_id] = (text, vector.values, metadata)
+        if not pending:
+            continue
+        stored = await store.get_many(list(pending))
+        upserts = []
+        for chunk_id, (text, values, metadata) in pending.items():
+            if chunk_id in stored and stored[chunk_id][0] == text:
+                upserts.append((chunk_id, values, slim_metadata(metadata)))
+            else:
+                unverified += 1
+        if upserts:
+            await asyncio.to_thread(index.upsert, vectors=upserts)
+            slimmed += len(upserts)
+    logger.info(f"Stripped chunk text from {slimmed} Pinecone vectors")
+    if unverified:
+        logger.warning(f"Kept the text of {unverified} vectors whose chunk is missing or different in the store")
+    return slimmed
+
+
+async def _build(slim: bool) -> None:
+    from dotenv import load_dotenv
+    from pinecone import Pinecone
+
+    load_dotenv()
+    store = create_chunk_store()
+    if store is None:
+        raise ValueError("Set DOCSTORE_MODE=postgres or DOCSTORE_MODE=mmap to build the chunk store")
+    if isinstance(store, PostgresChunkStore):
+        await store.create_table()
+    index = Pinecone(api_key=os.environ.get("PINECONE_API_KEY")).Index(os.environ.get("PINECONE_INDEX"))
+    try:
+        written = await build_from_index(index, store, slim=slim)
+        print(f"Wrote {written} chunks to the {DOCSTORE_MODE} chunk store")
+    finally:
+        await store.close()
+        if isinstance(store, PostgresChunkStore):
+            from sql_data_layer import close_shared_data_layer
+
+            await close_shared_data_layer()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "build":
+        print("Usage: python -m agent.docstore build [--slim]")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_build(slim="--slim" in sys.argv))
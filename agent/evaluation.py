@@ -0,0 +1,273 @@
+"""
+Offline retrieval evaluation and latency harness.
+
+Runs a versioned golden question set through the retrieval stages `LawAgent`
+uses (decomposition, embedding, vector search, fusion/reranking, hydration and
+context assembly) for every configuration in a grid, and reports recall@k over
+the candidate pool, recall over the final context docs, MRR, context token
+counts and per-stage latency percentiles as JSON:
+
+    python -m agent.evaluation --k 20,50 --threshold 0.5,0.6 --reranker off,lexical \\
+        --profile hashing-256,hashing-1024 --output eval/results.json
+
+The default `local` backend indexes eval/retrieval_corpus_v1.jsonl in memory
+with deterministic hashing embeddings, so it runs offline in CI. `--backend
+pinecone` evaluates the live index instead (golden IDs must then be index IDs).
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import re
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+from agent.compression import compress_documents, estimate_prompt_tokens
+from agent.fakes import HashingEmbeddings, LocalVectorStore
+from agent.retrieval import decompose_query, reciprocal_rank_fusion
+
+logger = logging.getLogger("swedish_law_chat")
+
+GOLDEN_SET_PATH = "eval/retrieval_golden_v1.jsonl"
+CORPUS_PATH = "eval/retrieval_corpus_v1.jsonl"
+STAGES = ["decompose", "embed", "search", "rank", "hydrate", "context", "total"]
+
+
+def _openai_profile(model: str) -> Callable:
+    def build():
+        from langchain_openai import OpenAIEmbeddings
+
+        return OpenAIEmbeddings(model=model)
+
+    return build
+
+
+EMBEDDING_PROFILES: Dict[str, Callable] = {
+    "hashing-256": lambda: HashingEmbeddings(256),
+    "hashing-1024": lambda: HashingEmbeddings(1024),
+    "openai-large": _openai_profile("text-embedding-3-large"),
+    "openai-small": _openai_profile("text-embedding-3-small"),
+}
+
+
+def _terms(text: str) -> set:
+    return {t for t in re.findall(r"[a-z0-9§]+", text.lower()) if len(t) > 2}
+
+
+def lexical_rerank(question: str, docs: Sequence[Document]) -> List[Document]:
+    """Baseline reranker: blend vector relevance with question-term coverage"""
+    query_terms = _terms(question)
+    if not query_terms:
+        return list(docs)
+
+    def score(doc: Document) -> float:
+        coverage = len(query_terms & _terms(doc.page_content)) / len(query_terms)
+        return 0.5 * float(doc.metadata.get("relevance", 0.0)) + 0.5 * coverage
+
+    return sorted(docs, key=score, reverse=True)
+
+
+RERANKERS: Dict[str, Optional[Callable[[str, Sequence[Document]], List[Document]]]] = {
+    "off": None,
+    "lexical": lexical_rerank,
+}
+
+
+def load_golden_set(path: str = GOLDEN_SET_PATH) -> Tuple[str, List[Dict]]:
+    """Return the set's version (its file stem) and its cases"""
+    with open(path) as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+    version = path.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+    return version, cases
+
+
+def load_corpus(path: str = CORPUS_PATH) -> List[Document]:
+    with open(path) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return [Document(id=row["id"], page_content=row["text"], metadata=row.get("metadata", {})) for row in rows]
+
+
+def percentile(values: Sequence[float], quantile: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(quantile * len(ordered)) - 1))]
+
+
+def configuration_grid(
+    ks: Sequence[int],
+    thresholds: Sequence[float],
+    rerankers: Sequence[str],
+    profiles: Sequence[str],
+    context_docs: int,
+    multi_query: str,
+    compression: bool,
+) -> List[Dict]:
+    return [
+        {
+            "k": k,
+            "threshold": threshold,
+            "reranker": reranker,
+            "embedding_profile": profile,
+            "context_docs": context_docs,
+            "multi_query": multi_query,
+            "compression": compression,
+        }
+        for profile, k, threshold, reranker in itertools.product(profiles, ks, thresholds, rerankers)
+    ]
+
+
+async def run_case(agent, question: str, config: Dict) -> Tuple[List[Document], List[Document], Dict[str, float]]:
+    """Run one question through the retrieval stages, timing each one"""
+    timings: Dict[str, float] = {}
+    started = time.perf_counter()
+
+    def lap(stage: str, since: float) -> float:
+        now = time.perf_counter()
+        timings[stage] = (now - since) * 1000
+        return now
+
+    mark = started
+    queries = await decompose_query(question, mode=config["multi_query"])
+    mark = lap("decompose", mark)
+    embeddings = await agent._embed_queries(queries)
+    mark = lap("embed", mark)
+    results = await asyncio.gather(*(agent._search_by_vector(embedding) for embedding in embeddings))
+    mark = lap("search", mark)
+
+    if len(results) == 1:
+        candidates = results[0]
+    else:
+        candidates = reciprocal_rank_fusion(results, top_k=config["k"])
+    reranker = RERANKERS[config["reranker"]]
+    if reranker is not None:
+        candidates = reranker(question, candidates)
+    docs = candidates[: config["context_docs"]]
+    mark = lap("rank", mark)
+
+    if agent.chunk_store is not None:
+        docs = await agent.chunk_store.hydrate(docs)
+    mark = lap("hydrate", mark)
+    if config["compression"] and docs:
+        docs, _ = compress_documents(question, docs)
+    lap("context", mark)
+    timings["total"] = (time.perf_counter() - started) * 1000
+    return candidates, docs, timings
+
+
+async def evaluate_config(agent, cases: Sequence[Dict], config: Dict) -> Dict:
+    """Score one configuration over the golden set"""
+    agent.RETRIEVAL_K = config["k"]
+    agent.SCORE_THRESHOLD = config["threshold"]
+    agent.CONTEXT_DOCS = config["context_docs"]
+
+    recall_candidates, recall_context, reciprocal_ranks, context_tokens = [], [], [], []
+    latencies: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    for case in cases:
+        relevant = set(case["relevant_ids"])
+        candidates, docs, timings = await run_case(agent, case["question"], config)
+        candidate_ids = [doc.id for doc in candidates]
+        context_ids = [doc.id for doc in docs]
+        recall_candidates.append(len(relevant & set(candidate_ids)) / len(relevant))
+        recall_context.append(len(relevant & set(context_ids)) / len(relevant))
+        rank = next((i + 1 for i, doc_id in enumerate(context_ids) if doc_id in relevant), None)
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+        context_tokens.append(estimate_prompt_tokens(docs))
+        for stage, value in timings.items():
+            latencies[stage].append(value)
+
+    count = max(1, len(cases))
+    return {
+        "config": config,
+        "metrics": {
+            "questions": len(cases),
+            "recall_at_k": round(sum(recall_candidates) / count, 4),
+            "recall_at_context": round(sum(recall_context) / count, 4),
+            "mrr": round(sum(reciprocal_ranks) / count, 4),
+            "context_tokens_mean": round(sum(context_tokens) / count, 1),
+            "context_tokens_p95": percentile(context_tokens, 0.95),
+        },
+        "latency_ms": {
+            stage: {
+                "p50": round(percentile(values, 0.5), 3),
+                "p95": round(percentile(values, 0.95), 3),
+                "p99": round(percentile(values, 0.99), 3),
+            }
+            for stage, values in latencies.items()
+        },
+    }
+
+
+def _build_agent(backend: str, profile: str, corpus: List[Document]):
+    from agent.chat_handler import LawAgent
+
+    agent = LawAgent()
+    # Measure retrieval itself, not precomputed routes
+    agent.router = None
+    if backend == "pinecone":
+        if agent.setup_vector_store() is None:
+            raise RuntimeError("Vector store could not be initialized")
+    else:
+        agent.vector_store = LocalVectorStore(EMBEDDING_PROFILES[profile](), corpus)
+    return agent
+
+
+async def run(args: argparse.Namespace) -> Dict:
+    version, cases = load_golden_set(args.golden)
+    corpus = load_corpus(args.corpus) if args.backend == "local" else []
+    grid = configuration_grid(
+        ks=[int(k) for k in args.k.split(",")],
+        thresholds=[float(t) for t in args.threshold.split(",")],
+        rerankers=args.reranker.split(","),
+        profiles=args.profile.split(","),
+        context_docs=args.context_docs,
+        multi_query=args.multi_query,
+        compression=args.compression,
+    )
+    results = []
+    agents: Dict[str, object] = {}
+    for config in grid:
+        profile = config["embedding_profile"]
+        if profile not in agents:
+            agents[profile] = _build_agent(args.backend, profile, corpus)
+        results.append(await evaluate_config(agents[profile], cases, config))
+        logger.info(f"Evaluated {config}: {results[-1]['metrics']}")
+    return {
+        "golden_set": version,
+        "backend": args.backend,
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "results": results,
+    }
+
+
+def parse_args(argv: Sequence[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline retrieval evaluation")
+    parser.add_argument("--golden", default=GOLDEN_SET_PATH)
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--backend", choices=["local", "pinecone"], default="local")
+    parser.add_argument("--k", default="20,50", help="comma-separated candidate counts")
+    parser.add_argument("--threshold", default="0.5,0.6", help="comma-separated relevance thresholds")
+    parser.add_argument("--reranker", default="off,lexical", help=f"comma-separated, from {list(RERANKERS)}")
+    parser.add_argument("--profile", default="hashing-256,hashing-1024", help=f"from {list(EMBEDDING_PROFILES)}")
+    parser.add_argument("--context-docs", type=int, default=10)
+    parser.add_argument("--multi-query", choices=["off", "heuristic"], default="off")
+    parser.add_argument("--compression", action="store_true")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_args(sys.argv[1:])
+    report = asyncio.run(run(arguments))
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {len(report['results'])} configurations to {arguments.output}")
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,384 @@
+"""
+Local stand-ins for remote dependencies.
+
+`FaultInjector` wraps async calls with configurable latency, slow-call and error
+rates so the resilience layer can be exercised without OpenAI or Pinecone
+(see tests/test_resilience.py).
+
+`HashingEmbeddings` and `LocalVectorStore` form a deterministic offline retrieval
+backend used by the evaluation harness.
+
+With LAW_AGENT_BACKEND=fake, `LawAgent` swaps OpenAI and Pinecone for these
+stand-ins plus `FakeStreamingChatModel`, so load and latency tests measure only
+our own overhead. Time-to-first-token, tokens/sec and error rate are set with
+the FAKE_CHAT_* variables.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import re
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.documents import Document
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+logger = logging.getLogger("swedish_law_chat")
+
+T = TypeVar("T")
+
+# live | fake
+LAW_AGENT_BACKEND = os.environ.get("LAW_AGENT_BACKEND", "live").lower()
+FAKE_SEED = int(os.environ.get("FAKE_SEED", "42"))
+FAKE_EMBEDDING_DIMENSIONS = int(os.environ.get("FAKE_EMBEDDING_DIMENSIONS", "1024"))
+FAKE_CORPUS_PATH = os.environ.get("FAKE_CORPUS_PATH", "eval/retrieval_corpus_v1.jsonl")
+# Synthetic chunks added to the seed corpus so search cost resembles a real index
+FAKE_CORPUS_SIZE = int(os.environ.get("FAKE_CORPUS_SIZE", "5000"))
+FAKE_CHAT_TTFT = float(os.environ.get("FAKE_CHAT_TTFT", "0.5"))
+FAKE_CHAT_TOKENS_PER_SECOND = float(os.environ.get("FAKE_CHAT_TOKENS_PER_SECOND", "60"))
+FAKE_CHAT_ERROR_RATE = float(os.environ.get("FAKE_CHAT_ERROR_RATE", "0"))
+FAKE_ANSWER_TOKENS = int(os.environ.get("FAKE_ANSWER_TOKENS", "250"))
+
+
+class InjectedFault(Exception):
+    """Error raised by a fault-injecting stand-in"""
+
+
+class FaultInjector:
+    """Adds latency, slow outliers and failures to wrapped calls"""
+
+    def __init__(
+        self,
+        latency: float = 0.01,
+        slow_rate: float = 0.0,
+        slow_latency: float = 2.0,
+        error_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.calls = 0
+        self._random = random.Random(seed)
+
+    async def delay(self) -> None:
+        """Sleep for one call's latency and maybe raise an injected error"""
+        self.calls += 1
+        slow = self._random.random() < self.slow_rate
+        await asyncio.sleep(self.slow_latency if slow else self.latency)
+        if self._random.random() < self.error_rate:
+            raise InjectedFault("injected failure")
+
+    async def run(self, func: Callable[[], Awaitable[T]]) -> T:
+        await self.delay()
+        return await func()
+
+
+class FaultInjectingEmbeddings:
+    """Embeddings stand-in returning a fixed vector through a fault injector"""
+
+    def __init__(self, injector: FaultInjector, dimensions: int = 8):
+        self.injector = injector
+        self.dimensions = dimensions
+
+    async def aembed_query(self, text: str) -> List[float]:
+        await self.injector.delay()
+        return [1.0 / self.dimensions] * self.dimensions
+
+
+class FaultInjectingVectorStore:
+    """Vector store stand-in exposing the calls `LawAgent.retrieve_documents` makes"""
+
+    def __init__(self, injector: FaultInjector, documents: List[Document], embeddings=None):
+        self.injector = injector
+        self.documents = documents
+        self.embeddings = embeddings or FaultInjectingEmbeddings(FaultInjector())
+
+    async def asimilarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        await self.injector.delay()
+        return [(doc, 0.9) for doc in self.documents[:k]]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        return lambda score: score
+
+
+class FaultInjectingStream:
+    """Chain stand-in whose `astream` stalls before the first token on demand"""
+
+    def __init__(self, tokens: List[str], first_token_delays: List[float]):
+        self.tokens = tokens
+        self.first_token_delays = list(first_token_delays)
+
+    async def astream(self, inputs: Any) -> AsyncIterator[str]:
+        delay = self.first_token_delays.pop(0) if self.first_token_delays else 0.0
+        await asyncio.sleep(delay)
+        for token in self.tokens:
+            yield token
+
+
+class HashingEmbeddings:
+    """
+    Deterministic embeddings: unigrams and bigrams are hashed into a fixed number of
+    signed buckets and log-weighted. Similar wording gives similar vectors, which is
+    enough to make offline retrieval metrics meaningful.
+    """
+
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+
+    def _vector(self, text: str) -> List[float]:
+        tokens = re.findall(r"[a-z0-9§]+", text.lower())
+        features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        counts: Dict[str, int] = {}
+        for feature in features:
+            counts[feature] = counts.get(feature, 0) + 1
+        for feature, count in counts.items():
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimensions
+            sign = 1.0 if digest[4] & 1 else -1.0
+            vector[bucket] += sign * (1.0 + math.log(count))
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._vector(text)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._vector(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return self.embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_documents(texts)
+
+
+class _LocalIndex:
+    """Mimics the Pinecone `Index.query` response shape over a LocalVectorStore"""
+
+    def __init__(self, store: "LocalVectorStore"):
+        self.store = store
+
+    def query(
+        self,
+        vector: List[float],
+        top_k: int = 10,
+        include_metadata: bool = True,
+        include_values: bool = False,
+        **kwargs: Any,
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        matches = []
+        for position, score in self.store.search(vector, top_k):
+            doc = self.store.documents[position]
+            match: Dict[str, Any] = {"id": doc.id, "score": score, "metadata": None, "values": None}
+            if include_metadata:
+                match["metadata"] = {**doc.metadata, self.store._text_key: doc.page_content}
+            if include_values:
+                match["values"] = self.store.matrix[position].tolist()
+            matches.append(match)
+        return {"matches": matches}
+
+    def fetch(self, ids: List[str], **kwargs: Any) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        positions = {doc.id: position for position, doc in enumerate(self.store.documents)}
+        return {
+            "vectors": {
+                id: {"id": id, "values": self.store.matrix[positions[id]].tolist()}
+                for id in ids
+                if id in positions
+            }
+        }
+
+
+class LocalVectorStore:
+    """
+    In-memory cosine index exposing the subset of `PineconeVectorStore` that
+    `LawAgent` uses, including the raw `index.query` path.
+    """
+
+    _text_key = "text"
+
+    def __init__(self, embeddings, documents: List[Document], vectors: Optional[List[List[float]]] = None):
+        self.embeddings = embeddings
+        self.documents = list(documents)
+        if vectors is None:
+            vectors = embeddings.embed_documents([doc.page_content for doc in self.documents])
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.matrix = matrix / np.where(norms == 0, 1.0, norms)
+        self.index = _LocalIndex(self)
+
+    def search(self, embedding: List[float], k: int) -> List[Tuple[int, float]]:
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        scores = self.matrix @ query
+        top = np.argsort(-scores)[:k]
+        return [(int(i), float(scores[i])) for i in top]
+
+    async def asimilarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return [
+            (Document(id=self.documents[i].id, page_content=self.documents[i].page_content,
+                      metadata=dict(self.documents[i].metadata)), score)
+            for i, score in self.search(embedding, k)
+        ]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # Same cosine → [0, 1] mapping as PineconeVectorStore
+        return lambda score: (score + 1) / 2
+
+
+_SYNTHETIC_SENTENCES = [
+    "The court shall consider {issue} in light of the best interest of the child.",
+    "A party may petition the court to modify an order concerning {issue} upon a material change in circumstances.",
+    "Orders regarding {issue} shall be enforced in the same manner as other judgments.",
+    "The court may deviate from the presumptive amount for {issue} if application would be unjust or inappropriate.",
+    "Each party shall file a financial affidavit before a hearing on {issue}.",
+    "Temporary orders concerning {issue} may be entered while the proceeding is pending.",
+]
+
+
+def generate_corpus(size: int = FAKE_CORPUS_SIZE, seed: int = FAKE_SEED) -> List[Document]:
+    """Deterministic statute-like chunks spread over jurisdictions and family-law issues"""
+    from agent.retrieval import FAMILY_LAW_ISSUES, US_JURISDICTIONS
+
+    rng = random.Random(seed)
+    issues = list(FAMILY_LAW_ISSUES)
+    docs = []
+    for position in range(size):
+        state = rng.choice(US_JURISDICTIONS)
+        issue = rng.choice(issues)
+        section = f"{rng.randint(1, 99)}.{rng.randint(1, 999):03d}"
+        sentences = rng.sample(_SYNTHETIC_SENTENCES, 3)
+        text = f"{state} Code § {section}. " + " ".join(s.format(issue=issue) for s in sentences)
+        docs.append(
+            Document(
+                id=f"synthetic-{position}",
+                page_content=text,
+                metadata={"state": state, "section": section, "source": "synthetic"},
+            )
+        )
+    return docs
+
+
+def create_fake_vector_store(
+    corpus_path: str = FAKE_CORPUS_PATH, size: int = FAKE_CORPUS_SIZE, seed: int = FAKE_SEED
+) -> LocalVectorStore:
+    """Seeded fake vector store: the eval corpus (if present) plus synthetic chunks"""
+    docs: List[Document] = []
+    if corpus_path and os.path.exists(corpus_path):
+        with open(corpus_path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        docs = [Document(id=row["id"], page_content=row["text"], metadata=row.get("metadata", {})) for row in rows]
+    docs.extend(generate_corpus(size, seed))
+    start_time = time.time()
+    store = LocalVectorStore(HashingEmbeddings(FAKE_EMBEDDING_DIMENSIONS), docs)
+    logger.info(f"Fake vector store with {len(docs)} chunks built in {time.time() - start_time:.2f} seconds")
+    return store
+
+
+_REGENERATION_PROMPT = re.compile(r"Current question: (.*)\nRegenerated question:", re.DOTALL)
+_ANSWER_WORDS = (
+    "the court shall consider custody support statute guideline party obligor petition "
+    "order jurisdiction parent child income amount modification hearing best interest"
+).split()
+_fake_chat_random = random.Random(FAKE_SEED)
+
+
+class FakeStreamingChatModel(BaseChatModel):
+    """
+    Chat model stand-in with a configurable time-to-first-token, streaming rate and
+    error rate. Question regeneration echoes the question; other calls stream a
+    deterministic pseudo-answer seeded by the last message.
+    """
+
+    temperature: float = 0.0
+    ttft: float = FAKE_CHAT_TTFT
+    tokens_per_second: float = FAKE_CHAT_TOKENS_PER_SECOND
+    error_rate: float = FAKE_CHAT_ERROR_RATE
+    answer_tokens: int = FAKE_ANSWER_TOKENS
+    seed: int = FAKE_SEED
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming-chat"
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        last = str(messages[-1].content) if messages else ""
+        regeneration = _REGENERATION_PROMPT.search(last)
+        if regeneration:
+            return [regeneration.group(1).strip()]
+        rng = random.Random(f"{self.seed}:{last}")
+        words = [rng.choice(_ANSWER_WORDS) for _ in range(self.answer_tokens)]
+        return [words[0].capitalize()] + [f" {word}" for word in words[1:-1]] + [f" {words[-1]}."]
+
+    def _maybe_fail(self) -> None:
+        if _fake_chat_random.random() < self.error_rate:
+            raise InjectedFault("injected chat model failure")
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(self.ttft)
+        self._maybe_fail()
+        content = "".join(self._tokens(messages))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        await asyncio.sleep(self.ttft)
+        self._maybe_fail()
+        tokens = self._tokens(messages)
+        await asyncio.sleep(len(tokens) / self.tokens_per_second)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.ttft)
+        self._maybe_fail()
+        for token in self._tokens(messages):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+            time.sleep(1.0 / self.tokens_per_second)
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.ttft)
+        self._maybe_fail()
+        for token in self._tokens(messages):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+            await asyncio.sleep(1.0 / self.tokens_per_second)
@@ -0,0 +1,93 @@
+import logging
+import os
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from agent.retrieval import document_key
+
+logger = logging.getLogger("swedish_law_chat")
+
+RETRIEVAL_MEMO_ENABLED = os.environ.get("RETRIEVAL_MEMO_ENABLED", "true").lower() == "true"
+MEMO_MAX_CANDIDATES = int(os.environ.get("MEMO_MAX_CANDIDATES", "200"))
+# Stricter than the remote threshold: only reuse candidates that clearly still match
+MEMO_SCORE_THRESHOLD = float(os.environ.get("MEMO_SCORE_THRESHOLD", "0.7"))
+
+
+class RetrievalMemo:
+    """
+    Per-thread memo of the candidates earlier turns kept (IDs, texts and
+    vectors). Follow-up questions are scored against it locally with one matmul; the
+    caller only queries Pinecone again when the memo cannot cover the question.
+    """
+
+    def __init__(self, max_candidates: int = MEMO_MAX_CANDIDATES):
+        self.max_candidates = max_candidates
+        self._documents: "OrderedDict[Hashable, Document]" = OrderedDict()
+        self._vectors: "OrderedDict[Hashable, np.ndarray]" = OrderedDict()
+        self._matrix: np.ndarray = np.empty((0, 0), dtype=np.float32)
+        self._keys: List[Hashable] = []
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def add(self, candidates: Sequence[Tuple[Document, Sequence[float]]]) -> None:
+        """Add remote candidates, evicting the oldest beyond the size bound"""
+        for doc, values in candidates:
+            if not values:
+                continue
+            key = document_key(doc)
+            vector = np.asarray(values, dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            if norm == 0:
+                continue
+            self._documents[key] = doc
+            self._vectors[key] = vector / norm
+            self._documents.move_to_end(key)
+            self._vectors.move_to_end(key)
+        while len(self._documents) > self.max_candidates:
+            key, _ = self._documents.popitem(last=False)
+            self._vectors.pop(key, None)
+        self._keys = list(self._vectors.keys())
+        self._matrix = np.stack(list(self._vectors.values())) if self._vectors else np.empty((0, 0), dtype=np.float32)
+
+    def search(self, embedding: Sequence[float], k: int) -> List[Tuple[Document, float]]:
+        """Return the k memo candidates most similar (cosine) to the embedding"""
+        if not self._keys:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        if query.shape[0] != self._matrix.shape[1]:
+            return []
+        query = query / (np.linalg.norm(query) or 1.0)
+        scores = self._matrix @ query
+        top = np.argsort(-scores)[:k]
+        return [(self._documents[self._keys[i]], float(scores[i])) for i in top]
+
+    def covered(
+        self, embedding: Sequence[float], k: int, relevance: Callable[[float], float]
+    ) -> List[Document]:
+        """
+        Return k locally scored documents if every one clears MEMO_SCORE_THRESHOLD,
+        otherwise an empty list (the caller should query Pinecone).
+        """
+        relevant = []
+        for doc, score in self.search(embedding, k):
+            if relevance(score) >= MEMO_SCORE_THRESHOLD:
+                doc.metadata["relevance"] = relevance(score)
+                relevant.append(doc)
+        if len(relevant) >= k:
+            self.hits += 1
+            logger.info(f"Retrieval memo hit ({len(self)} candidates memoized)")
+            return relevant
+        self.misses += 1
+        return []
+
+    def clear(self) -> None:
+        self._documents.clear()
+        self._vectors.clear()
+        self._keys = []
+        self._matrix = np.empty((0, 0), dtype=np.float32)
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger("swedish_law_chat")
+
+# Retries performed by the OpenAI SDK; each retry is paced by the limiter below
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "6"))
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """Parse OpenAI reset headers such as '1s', '6m0s' or '20ms' into seconds"""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def estimate_tokens(text_or_bytes) -> int:
+    """Cheap token estimate (~4 characters per token) used for pacing only"""
+    return max(1, len(text_or_bytes) // 4)
+
+
+class AdaptiveRateLimiter:
+    """
+    Client-side limiter for one OpenAI model family, shared by every request in the
+    process. Requests and tokens are drawn from two buckets refilled at the current
+    allowed rate. The rate follows AIMD: it grows additively on success and halves on
+    each 429, and is capped by the limits OpenAI reports in its response headers.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        min_fraction: float = 0.05,
+        increase_fraction: float = 0.02,
+        backoff_base: float = 0.5,
+        backoff_cap: float = 30.0,
+    ):
+        self.name = name
+        self.max_rpm = requests_per_minute
+        self.max_tpm = tokens_per_minute
+        self.rpm = requests_per_minute
+        self.min_fraction = min_fraction
+        self.increase_fraction = increase_fraction
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        self._request_allowance = requests_per_minute / 60.0
+        self._token_allowance = tokens_per_minute / 60.0
+        self._last_refill = time.monotonic()
+        self._cooldown_until = 0.0
+        self._consecutive_429s = 0
+        self._lock = asyncio.Lock()
+        self._client: Optional[httpx.AsyncClient] = None
+        self.stats: Dict[str, int] = {"requests": 0, "throttled": 0, "rate_limited": 0}
+
+    @property
+    def tpm(self) -> float:
+        """Token rate scaled with the current request rate"""
+        return self.max_tpm * (self.rpm / self.max_rpm)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        # Buckets hold at most one second of burst at the current rate
+        self._request_allowance = min(
+            max(1.0, self.rpm / 60.0), self._request_allowance + elapsed * self.rpm / 60.0
+        )
+        self._token_allowance = min(
+            max(1.0, self.tpm / 60.0), self._token_allowance + elapsed * self.tpm / 60.0
+        )
+
+    async def acquire(self, tokens: int = 1) -> None:
+        """Wait until a request of roughly `tokens` tokens may be sent"""
+        async with self._lock:
+            waited = False
+            while True:
+                now = time.monotonic()
+                if now < self._cooldown_until:
+                    waited = True
+                    await asyncio.sleep(self._cooldown_until - now)
+                    continue
+                self._refill()
+                token_capacity = max(1.0, self.tpm / 60.0)
+                # Oversized requests wait for a full bucket and then overdraw it
+                needed_tokens = min(tokens, token_capacity)
+                if self._request_allowance >= 1.0 and self._token_allowance >= needed_tokens:
+                    self._request_allowance -= 1.0
+                    self._token_allowance -= tokens
+                    break
+                waited = True
+                request_wait = max(0.0, (1.0 - self._request_allowance) * 60.0 / self.rpm)
+                token_wait = max(0.0, (needed_tokens - self._token_allowance) * 60.0 / self.tpm)
+                await asyncio.sleep(max(request_wait, token_wait, 0.01))
+            self.stats["requests"] += 1
+            if waited:
+                self.stats["throttled"] += 1
+
+    def record_success(self) -> None:
+        self._consecutive_429s = 0
+        self.rpm = min(self.max_rpm, self.rpm + self.max_rpm * self.increase_fraction)
+
+    def record_rate_limited(self, retry_after: Optional[float] = None) -> None:
+        """Multiplicative decrease plus a jittered cooldown before the next request"""
+        self.stats["rate_limited"] += 1
+        self._consecutive_429s += 1
+        self.rpm = max(self.max_rpm * self.min_fraction, self.rpm / 2)
+        backoff = min(self.backoff_cap, self.backoff_base * 2 ** (self._consecutive_429s - 1))
+        delay = random.uniform(backoff / 2, backoff)
+        if retry_after:
+            delay = max(delay, retry_after)
+        self._cooldown_until = max(self._cooldown_until, time.monotonic() + delay)
+        logger.warning(
+            f"OpenAI rate limit hit for '{self.name}', pacing to {self.rpm:.0f} rpm "
+            f"and pausing {delay:.2f}s"
+        )
+
+    def observe_headers(self, headers: httpx.Headers) -> None:
+        """Adopt the limits and remaining budget OpenAI reports"""
+        limit_requests = headers.get("x-ratelimit-limit-requests")
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        if limit_requests and limit_requests.isdigit():
+            self.max_rpm = float(limit_requests)
+            self.rpm = min(self.rpm, self.max_rpm)
+        if limit_tokens and limit_tokens.isdigit():
+            self.max_tpm = float(limit_tokens)
+
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_requests and remaining_requests.isdigit():
+            self._request_allowance = min(self._request_allowance, float(remaining_requests))
+            if int(remaining_requests) == 0:
+                self._pause_until_reset(headers.get("x-ratelimit-reset-requests"))
+        if remaining_tokens and remaining_tokens.isdigit():
+            self._token_allowance = min(self._token_allowance, float(remaining_tokens))
+            if int(remaining_tokens) == 0:
+                self._pause_until_reset(headers.get("x-ratelimit-reset-tokens"))
+
+    def _pause_until_reset(self, reset_header: Optional[str]) -> None:
+        reset = parse_reset_duration(reset_header)
+        if reset:
+            self._cooldown_until = max(self._cooldown_until, time.monotonic() + reset)
+
+    async def _on_request(self, request: httpx.Request) -> None:
+        await self.acquire(estimate_tokens(request.content))
+
+    async def _on_response(self, response: httpx.Response) -> None:
+        self.observe_headers(response.headers)
+        if response.status_code == 429:
+            self.record_rate_limited(parse_reset_duration(response.headers.get("retry-after")))
+        elif response.status_code < 400:
+            self.record_success()
+
+    def async_client(self) -> httpx.AsyncClient:
+        """Shared httpx client whose event hooks route every OpenAI call through the limiter"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(60.0, connect=10.0),
+                event_hooks={"request": [self._on_request], "response": [self._on_response]},
+            )
+        return self._client
+
+    def shape_batches(self, texts: List[str], max_batch_size: int = 1000) -> List[List[str]]:
+        """
+        Group texts into embedding batches whose estimated size fits the per-second
+        token budget, so large jobs stream steadily instead of bursting into 429s.
+        """
+        budget = max(1, int(self.tpm / 60.0))
+        batches: List[List[str]] = []
+        current: List[str] = []
+        current_tokens = 0
+        for text in texts:
+            tokens = estimate_tokens(text)
+            if current and (current_tokens + tokens > budget or len(current) >= max_batch_size):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(text)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+
+# Process-wide limiters; defaults are conservative tier limits, tune per account
+RATE_LIMITERS: Dict[str, AdaptiveRateLimiter] = {
+    "chat": AdaptiveRateLimiter(
+        "chat",
+        requests_per_minute=float(os.environ.get("OPENAI_CHAT_RPM", "500")),
+        tokens_per_minute=float(os.environ.get("OPENAI_CHAT_TPM", "300000")),
+    ),
+    "embeddings": AdaptiveRateLimiter(
+        "embeddings",
+        requests_per_minute=float(os.environ.get("OPENAI_EMBEDDINGS_RPM", "3000")),
+        tokens_per_minute=float(os.environ.get("OPENAI_EMBEDDINGS_TPM", "1000000")),
+    ),
+}
+
+
+async def aembed_documents_paced(embeddings, texts: List[str]) -> List[List[float]]:
+    """Embed many texts in TPM-shaped batches through the shared embeddings limiter"""
+    vectors: List[List[float]] = []
+    for batch in RATE_LIMITERS["embeddings"].shape_batches(texts):
+        vectors.extend(await embeddings.aembed_documents(batch))
+    return vectors
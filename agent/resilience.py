@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, TypeVar
+
+from langchain_core.documents import Document
+
+logger = logging.getLogger("swedish_law_chat")
+
+T = TypeVar("T")
+
+# Generation timeouts (seconds) and retry budget, configurable per environment
+FIRST_TOKEN_TIMEOUT = float(os.environ.get("FIRST_TOKEN_TIMEOUT", "15"))
+GENERATION_RETRIES = int(os.environ.get("GENERATION_RETRIES", "1"))
+HEDGING_ENABLED = os.environ.get("HEDGING_ENABLED", "true").lower() == "true"
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the dependency's circuit is open"""
+
+
+class LatencyTracker:
+    """Rolling window of observed latencies used to derive an adaptive hedge delay"""
+
+    def __init__(
+        self,
+        name: str,
+        window: int = 200,
+        quantile: float = 0.95,
+        default_delay: float = 1.0,
+        min_delay: float = 0.05,
+        max_delay: float = 5.0,
+        min_samples: int = 20,
+    ):
+        self.name = name
+        self.quantile = quantile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        """Record the latency of a successful call"""
+        self._samples.append(seconds)
+
+    def percentile(self) -> Optional[float]:
+        """Return the tracked quantile, or None until enough samples exist"""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.quantile))
+        return ordered[index]
+
+    def hedge_delay(self) -> float:
+        """Delay after which a duplicate request should be sent"""
+        observed = self.percentile()
+        if observed is None:
+            return self.default_delay
+        return max(self.min_delay, min(self.max_delay, observed))
+
+
+class CircuitBreaker:
+    """Per-dependency circuit breaker (closed → open → half-open → closed)"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        """Return True if a call may be attempted right now"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            # Let exactly one probe through to test the dependency
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit '{self.name}' closed after successful probe")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit '{self.name}' opened after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def release(self) -> None:
+        """Give up a half-open probe slot without recording an outcome (e.g. on cancel)"""
+        self._probe_in_flight = False
+
+    async def call(self, func: Callable[[], Awaitable[T]]) -> T:
+        """Run an async call through the breaker"""
+        if not self.allow():
+            raise CircuitOpenError(f"Circuit '{self.name}' is open")
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            self.release()
+            raise
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+async def hedged(
+    func: Callable[[], Awaitable[T]],
+    tracker: LatencyTracker,
+    max_attempts: int = 2,
+) -> T:
+    """
+    Run an idempotent async call, sending a duplicate when the first attempt is
+    slower than the tracker's adaptive delay. The first successful result wins and
+    the remaining attempts are cancelled.
+    """
+    if not HEDGING_ENABLED:
+        max_attempts = 1
+
+    start_time = time.monotonic()
+    pending = {asyncio.ensure_future(func())}
+    attempts = 1
+    last_error: Optional[BaseException] = None
+
+    try:
+        while pending:
+            timeout = tracker.hedge_delay() if attempts < max_attempts else None
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    tracker.record(time.monotonic() - start_time)
+                    return task.result()
+                last_error = task.exception()
+
+            if attempts < max_attempts and (not done or not pending):
+                # Either the hedge delay elapsed or every attempt so far failed
+                if not done:
+                    logger.info(f"Hedging '{tracker.name}' after {tracker.hedge_delay():.2f}s")
+                pending.add(asyncio.ensure_future(func()))
+                attempts += 1
+    finally:
+        for task in pending:
+            task.cancel()
+
+    assert last_error is not None
+    raise last_error
+
+
+async def stream_with_first_token_timeout(
+    stream_factory: Callable[[], AsyncIterator[Any]],
+    first_token_timeout: float = FIRST_TOKEN_TIMEOUT,
+    retries: int = GENERATION_RETRIES,
+) -> AsyncIterator[Any]:
+    """
+    Yield from a freshly created stream, restarting it if the first token does not
+    arrive within the timeout. Once a token has been yielded no retry happens, so the
+    caller never sees duplicated output.
+    """
+    for attempt in range(retries + 1):
+        stream = stream_factory()
+        try:
+            first = await asyncio.wait_for(stream.__anext__(), timeout=first_token_timeout)
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            await stream.aclose()
+            if attempt >= retries:
+                raise
+            logger.warning(
+                f"No first token after {first_token_timeout:.1f}s, retrying generation "
+                f"(attempt {attempt + 2}/{retries + 1})"
+            )
+            continue
+
+        try:
+            yield first
+            async for token in stream:
+                yield token
+        finally:
+            await stream.aclose()
+        return
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def _terms(text: str) -> set:
+    return {term for term in re.findall(r"[a-z0-9§.]+", text.lower()) if len(term) > 2}
+
+
+class DegradedModeCache:
+    """
+    Bounded in-process cache of recent answers and retrieved documents, used when a
+    dependency's circuit is open. Retrieval falls back to lexical matching over the
+    documents seen recently (a small local index); generation falls back to a
+    previously generated answer for the same question. It is shared by every
+    session, so only store answers that carry nothing of one user's thread.
+    """
+
+    def __init__(self, max_answers: int = 500, max_documents: int = 2000):
+        self.max_answers = max_answers
+        self.max_documents = max_documents
+        self._answers: "OrderedDict[str, str]" = OrderedDict()
+        self._documents: "OrderedDict[str, Document]" = OrderedDict()
+
+    def remember_answer(self, question: str, answer: str) -> None:
+        key = _normalize(question)
+        self._answers[key] = answer
+        self._answers.move_to_end(key)
+        while len(self._answers) > self.max_answers:
+            self._answers.popitem(last=False)
+
+    def cached_answer(self, question: str) -> Optional[str]:
+        return self._answers.get(_normalize(question))
+
+    def remember_documents(self, docs: List[Document]) -> None:
+        for doc in docs:
+            key = doc.id or str(hash(doc.page_content))
+            self._documents[key] = doc
+            self._documents.move_to_end(key)
+        while len(self._documents) > self.max_documents:
+            self._documents.popitem(last=False)
+
+    def search(self, query: str, k: int = 10) -> List[Document]:
+        """Rank locally indexed documents by term overlap with the query"""
+        query_terms = _terms(query)
+        if not query_terms:
+            return []
+        scored = []
+        for doc in self._documents.values():
+            overlap = len(query_terms & _terms(doc.page_content))
+            if overlap:
+                scored.append((overlap, doc))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [doc for _, doc in scored[:k]]
+
+
+# Process-wide state per remote dependency
+LATENCY_TRACKERS: Dict[str, LatencyTracker] = {
+    "embeddings": LatencyTracker("embeddings", default_delay=0.8),
+    "pinecone": LatencyTracker("pinecone", default_delay=1.0),
+}
+
+CIRCUIT_BREAKERS: Dict[str, CircuitBreaker] = {
+    "embeddings": CircuitBreaker("embeddings"),
+    "pinecone": CircuitBreaker("pinecone"),
+    "openai_chat": CircuitBreaker("openai_chat", failure_threshold=3, reset_timeout=60.0),
+}
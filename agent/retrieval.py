@@ -0,0 +1,163 @@
+import logging
+import os
+import re
+from typing import Dict, Hashable, List, Optional, Sequence
+
+from langchain_core.documents import Document
+from langchain_core.prompts import ChatPromptTemplate
+
+logger = logging.getLogger("swedish_law_chat")
+
+# off | heuristic | llm  ("llm" = heuristics first, LLM only for unresolved compound questions)
+MULTI_QUERY_MODE = os.environ.get("MULTI_QUERY_MODE", "off").lower()
+MAX_SUBQUERIES = int(os.environ.get("MAX_SUBQUERIES", "4"))
+RRF_K = 60
+
+US_JURISDICTIONS = [
+    "Alabama", "Alaska", "Arizona", "Arkansas", "California", "Colorado", "Connecticut",
+    "Delaware", "District of Columbia", "Florida", "Georgia", "Hawaii", "Idaho", "Illinois",
+    "Indiana", "Iowa", "Kansas", "Kentucky", "Louisiana", "Maine", "Maryland",
+    "Massachusetts", "Michigan", "Minnesota", "Mississippi", "Missouri", "Montana",
+    "Nebraska", "Nevada", "New Hampshire", "New Jersey", "New Mexico", "New York",
+    "North Carolina", "North Dakota", "Ohio", "Oklahoma", "Oregon", "Pennsylvania",
+    "Rhode Island", "South Carolina", "South Dakota", "Tennessee", "Texas", "Utah",
+    "Vermont", "Virginia", "Washington", "West Virginia", "Wisconsin", "Wyoming",
+]
+
+# Family-law sub-issues; each entry maps a canonical issue to the phrases that signal it
+FAMILY_LAW_ISSUES: Dict[str, List[str]] = {
+    "child custody": ["custody", "parenting time", "visitation", "parenting plan"],
+    "child support": ["child support", "support guideline"],
+    "spousal support": ["alimony", "spousal support", "maintenance"],
+    "property division": ["property division", "marital property", "community property", "equitable distribution"],
+    "divorce grounds": ["grounds for divorce", "no-fault", "dissolution"],
+    "relocation": ["relocation", "move away", "move-away"],
+    "paternity": ["paternity", "parentage"],
+    "domestic violence": ["domestic violence", "protective order", "restraining order"],
+}
+
+# Longest names first so "West Virginia" wins over "Virginia"
+_JURISDICTION_PATTERN = re.compile(
+    r"\b(" + "|".join(re.escape(name) for name in sorted(US_JURISDICTIONS, key=len, reverse=True)) + r")\b",
+    re.IGNORECASE,
+)
+_DANGLING_CONNECTORS = re.compile(
+    r"(\b(between|and|or|vs\.?|versus|compared to|in|of|for)\b[\s,]*)+$", re.IGNORECASE
+)
+_COMPOUND_MARKERS = re.compile(r"\b(and|versus|vs\.?|compared to|as well as|both)\b|;|\?.+\?", re.IGNORECASE)
+# A leading bullet or "1." / "1)" list number; citations such as "154.125" stay intact
+_LIST_MARKER = re.compile(r"^\s*(?:[-•*]\s*|\d+[.)]\s+)")
+
+
+def find_jurisdictions(question: str) -> List[str]:
+    """Return the distinct U.S. jurisdictions named in the question, in order"""
+    seen: List[str] = []
+    for match in _JURISDICTION_PATTERN.finditer(question):
+        name = next(j for j in US_JURISDICTIONS if j.lower() == match.group(1).lower())
+        if name not in seen:
+            seen.append(name)
+    return seen
+
+
+def find_issues(question: str) -> List[str]:
+    """Return the distinct family-law sub-issues the question touches"""
+    lowered = question.lower()
+    return [issue for issue, phrases in FAMILY_LAW_ISSUES.items() if any(p in lowered for p in phrases)]
+
+
+def _topic_without_jurisdictions(question: str) -> str:
+    topic = _JURISDICTION_PATTERN.sub(" ", question)
+    topic = re.sub(r"[\s,]+", " ", topic).strip(" ?.")
+    return _DANGLING_CONNECTORS.sub("", topic).strip(" ,")
+
+
+def decompose_heuristically(question: str) -> List[str]:
+    """
+    Split a question that spans several jurisdictions and/or sub-issues into focused
+    sub-queries. Returns an empty list when the question looks atomic.
+    """
+    jurisdictions = find_jurisdictions(question)
+    issues = find_issues(question)
+
+    if len(jurisdictions) < 2 and len(issues) < 2:
+        return []
+
+    topic = _topic_without_jurisdictions(question) or question
+    if len(jurisdictions) >= 2 and len(issues) >= 2 and len(jurisdictions) * len(issues) <= MAX_SUBQUERIES:
+        return [f"{issue} in {state}" for state in jurisdictions for issue in issues]
+    if len(jurisdictions) >= 2:
+        return [f"{topic} in {state}" for state in jurisdictions][:MAX_SUBQUERIES]
+
+    suffix = f" in {jurisdictions[0]}" if jurisdictions else ""
+    return [f"{issue}{suffix}" for issue in issues][:MAX_SUBQUERIES]
+
+
+def looks_compound(question: str) -> bool:
+    """Whether an undecomposed question still looks like several questions in one"""
+    return len(question.split()) >= 12 and bool(_COMPOUND_MARKERS.search(question))
+
+
+async def decompose_with_llm(chat_model, question: str) -> List[str]:
+    """Ask the chat model to split a compound question into standalone search queries"""
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                "Split the user's U.S. family law question into at most {max_queries} short, "
+                "standalone search queries, one per line, each covering a single jurisdiction "
+                "or legal sub-issue. If the question is already atomic, output it unchanged. "
+                "Output ONLY the queries, one per line.",
+            ),
+            ("user", "{question}"),
+        ]
+    )
+    response = await (prompt | chat_model).ainvoke({"question": question, "max_queries": MAX_SUBQUERIES})
+    lines = [_LIST_MARKER.sub("", line).strip() for line in response.content.splitlines()]
+    return [line for line in lines if line][:MAX_SUBQUERIES]
+
+
+async def decompose_query(question: str, chat_model=None, mode: Optional[str] = None) -> List[str]:
+    """
+    Return the queries to run for a question: the original question first, followed
+    by any sub-queries. Heuristics are tried first; the LLM is only consulted in
+    "llm" mode for questions that still look compound.
+    """
+    mode = mode or MULTI_QUERY_MODE
+    if mode == "off":
+        return [question]
+
+    sub_queries = decompose_heuristically(question)
+    if not sub_queries and mode == "llm" and chat_model is not None and looks_compound(question):
+        try:
+            sub_queries = await decompose_with_llm(chat_model, question)
+        except Exception as e:
+            logger.warning(f"LLM query decomposition failed, using original question: {e}")
+            sub_queries = []
+
+    queries = [question]
+    for sub_query in sub_queries:
+        if sub_query.lower() != question.lower() and sub_query not in queries:
+            queries.append(sub_query)
+    if len(queries) > 1:
+        logger.info(f"Decomposed question into {len(queries) - 1} sub-queries: {queries[1:]}")
+    return queries
+
+
+def document_key(doc: Document) -> Hashable:
+    """Stable identity for de-duplicating documents across result lists"""
+    return doc.id or hash(doc.page_content)
+
+
+def reciprocal_rank_fusion(
+    ranked_lists: Sequence[Sequence[Document]], top_k: int, k: int = RRF_K
+) -> List[Document]:
+    """Fuse several ranked document lists with reciprocal-rank fusion"""
+    scores: Dict[Hashable, float] = {}
+    documents: Dict[Hashable, Document] = {}
+    for ranked in ranked_lists:
+        for rank, doc in enumerate(ranked):
+            key = document_key(doc)
+            documents.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    ordered = sorted(scores, key=scores.get, reverse=True)
+    return [documents[key] for key in ordered[:top_k]]
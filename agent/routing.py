@@ -0,0 +1,238 @@
+"""
+Embedding-based routing to precomputed statute chunk sets.
+
+Most questions land on a small set of core statutes (each state's child-support
+guidelines, custody factors, ...). A precompute job embeds a few phrasings per
+topic, averages them into a centroid and stores the curated chunks Pinecone
+returns for it. At query time one matmul against the centroid matrix decides
+whether a question confidently belongs to a topic; if so its chunk set is used
+and the remote Pinecone query is skipped.
+
+Rebuild the routes (e.g. after re-indexing the corpus) with:
+
+    python -m agent.routing refresh
+
+Running workers pick up the new files within ROUTING_RELOAD_INTERVAL seconds.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from agent.rate_limiter import aembed_documents_paced
+from agent.retrieval import FAMILY_LAW_ISSUES, US_JURISDICTIONS
+from observability.metrics import REGISTRY
+
+logger = logging.getLogger("swedish_law_chat")
+
+ROUTING_ENABLED = os.environ.get("ROUTING_ENABLED", "false").lower() == "true"
+ROUTING_PATH = os.environ.get("ROUTING_PATH", "data/routes")
+# Cosine similarity a question needs to its best centroid, and its lead over the runner-up
+ROUTING_MIN_SCORE = float(os.environ.get("ROUTING_MIN_SCORE", "0.8"))
+ROUTING_MIN_MARGIN = float(os.environ.get("ROUTING_MIN_MARGIN", "0.04"))
+# Seconds between checks for refreshed route files; 0 disables reloading
+ROUTING_RELOAD_INTERVAL = float(os.environ.get("ROUTING_RELOAD_INTERVAL", "30"))
+ROUTING_ISSUES = [
+    i.strip()
+    for i in os.environ.get("ROUTING_ISSUES", "child support,child custody,spousal support").split(",")
+    if i.strip() in FAMILY_LAW_ISSUES
+]
+
+STATUTE_ROUTES = REGISTRY.counter("law_statute_routes_total", "Statute router decisions by result", ["result"])
+STATUTE_ROUTE_TOPICS = REGISTRY.gauge("law_statute_route_topics", "Topics loaded in the statute router")
+STATUTE_ROUTE_HIT_RATIO = REGISTRY.gauge("law_statute_route_hit_ratio", "Share of questions answered from a statute route")
+
+TOPIC_PHRASINGS = [
+    "{issue} in {state}",
+    "How is {issue} determined in {state}?",
+    "{state} statute governing {issue}",
+]
+
+
+def route_topics(issues: Sequence[str] = ROUTING_ISSUES) -> List[Tuple[str, List[str]]]:
+    """Topics to precompute as (name, phrasings), one per issue and jurisdiction"""
+    return [
+        (f"{issue} / {state}", [p.format(issue=issue, state=state) for p in TOPIC_PHRASINGS])
+        for issue in issues
+        for state in US_JURISDICTIONS
+    ]
+
+
+class StatuteRouter:
+    """
+    In-memory "topic centroid → curated chunk set" matrix loaded from ROUTING_PATH
+    (`centroids.npy` plus `topics.json`), with hit-rate counters. The files are
+    reloaded when `topics.json` changes.
+    """
+
+    def __init__(self, path: str = ROUTING_PATH, min_score: float = ROUTING_MIN_SCORE, min_margin: float = ROUTING_MIN_MARGIN):
+        self.path = path
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self._centroids: np.ndarray = np.empty((0, 0), dtype=np.float32)
+        self._topics: List[Dict] = []
+        self.built_at: Optional[str] = None
+        self.hits = 0
+        self.misses = 0
+        self.reload_interval = ROUTING_RELOAD_INTERVAL
+        self._loaded_mtime: Optional[float] = None
+        self._checked_at = time.monotonic()
+        REGISTRY.on_collect(self._collect)
+
+    def __len__(self) -> int:
+        return len(self._topics)
+
+    def load(self) -> bool:
+        """(Re)load the routes from disk; returns whether any were found"""
+        centroids_path = os.path.join(self.path, "centroids.npy")
+        topics_path = os.path.join(self.path, "topics.json")
+        if not os.path.exists(centroids_path) or not os.path.exists(topics_path):
+            logger.warning(f"No precomputed routes at {self.path}; run `python -m agent.routing refresh`")
+            return False
+        mtime = os.path.getmtime(topics_path)
+        with open(topics_path) as f:
+            payload = json.load(f)
+        centroids = np.load(centroids_path).astype(np.float32)
+        if centroids.shape[0] != len(payload["topics"]):
+            # Caught between the two file swaps of a refresh; try again later
+            logger.warning(f"Routes at {self.path} are being rewritten, keeping the loaded ones")
+            return bool(self._topics)
+        self._centroids = centroids
+        self._topics = payload["topics"]
+        self.built_at = payload.get("built_at")
+        self._loaded_mtime = mtime
+        logger.info(f"Loaded {len(self._topics)} statute routes built at {self.built_at}")
+        return True
+
+    def route(self, embedding: Sequence[float]) -> Optional[Tuple[str, List[Document]]]:
+        """Return (topic, documents) on a confident match, otherwise None"""
+        self._maybe_reload()
+        if not self._topics:
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        if query.shape[0] != self._centroids.shape[1]:
+            return None
+        query = query / (np.linalg.norm(query) or 1.0)
+        scores = self._centroids @ query
+        order = np.argsort(-scores)[:2]
+        best = float(scores[order[0]])
+        runner_up = float(scores[order[1]]) if len(order) > 1 else -1.0
+        if best < self.min_score or best - runner_up < self.min_margin:
+            self.misses += 1
+            STATUTE_ROUTES.inc(result="miss")
+            return None
+
+        self.hits += 1
+        STATUTE_ROUTES.inc(result="hit")
+        topic = self._topics[order[0]]
+        logger.info(f"Routed question to '{topic['name']}' (score {best:.3f}, margin {best - runner_up:.3f})")
+        docs = [
+            Document(id=d.get("id"), page_content=d["text"], metadata=dict(d.get("metadata", {})))
+            for d in topic["documents"]
+        ]
+        return topic["name"], docs
+
+    def _maybe_reload(self) -> None:
+        """Reload when `topics.json` changed, checking at most every reload_interval seconds"""
+        if self.reload_interval <= 0 or time.monotonic() - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = time.monotonic()
+        try:
+            mtime = os.path.getmtime(os.path.join(self.path, "topics.json"))
+        except OSError:
+            return
+        if mtime != self._loaded_mtime:
+            try:
+                self.load()
+            except Exception as e:
+                logger.error(f"Could not reload statute routes, keeping the loaded ones: {e}")
+
+    def _collect(self) -> None:
+        STATUTE_ROUTE_TOPICS.set(len(self._topics))
+        routed = self.hits + self.misses
+        STATUTE_ROUTE_HIT_RATIO.set(self.hits / routed if routed else 0.0)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        routed = self.hits + self.misses
+        return {
+            "topics": len(self._topics),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / routed, 3) if routed else 0.0,
+        }
+
+
+async def build_routes(agent, path: str = ROUTING_PATH, issues: Sequence[str] = ROUTING_ISSUES) -> int:
+    """
+    Precompute centroids and curated chunk sets with the agent's embeddings and
+    index, then write them to `path`. Returns the number of topics stored.
+    """
+    topics = route_topics(issues)
+    phrasings = [p for _, topic_phrasings in topics for p in topic_phrasings]
+    vectors = np.asarray(
+        await aembed_documents_paced(agent.vector_store.embeddings, phrasings), dtype=np.float32
+    )
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    centroids = []
+    stored = []
+    per_topic = len(TOPIC_PHRASINGS)
+    for position, (name, _) in enumerate(topics):
+        centroid = vectors[position * per_topic : (position + 1) * per_topic].mean(axis=0)
+        centroid /= np.linalg.norm(centroid) or 1.0
+        docs = (await agent._search_by_vector(centroid.tolist()))[: agent.CONTEXT_DOCS]
+        if agent.chunk_store is not None:
+            docs = await agent.chunk_store.hydrate(docs)
+        if not docs:
+            logger.info(f"No chunks above the relevance threshold for '{name}', skipping")
+            continue
+        centroids.append(centroid)
+        stored.append(
+            {
+                "name": name,
+                "documents": [{"id": d.id, "text": d.page_content, "metadata": d.metadata} for d in docs],
+            }
+        )
+
+    # Swap the files in whole (topics.json last) so running workers never read a partial file
+    os.makedirs(path, exist_ok=True)
+    centroids_path = os.path.join(path, "centroids.npy")
+    topics_path = os.path.join(path, "topics.json")
+    with open(centroids_path + ".tmp", "wb") as f:
+        np.save(f, np.stack(centroids) if centroids else np.empty((0, 0)))
+    with open(topics_path + ".tmp", "w") as f:
+        json.dump({"built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "topics": stored}, f)
+    os.replace(centroids_path + ".tmp", centroids_path)
+    os.replace(topics_path + ".tmp", topics_path)
+    return len(stored)
+
+
+async def _refresh() -> None:
+    from dotenv import load_dotenv
+
+    from agent.chat_handler import LawAgent
+
+    load_dotenv()
+    agent = LawAgent()
+    # Build from Pinecone itself, not from stale routes
+    agent.router = None
+    if agent.setup_vector_store() is None:
+        raise RuntimeError("Vector store could not be initialized")
+    count = await build_routes(agent)
+    print(f"Wrote {count} statute routes to {ROUTING_PATH}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "refresh":
+        print("Usage: python -m agent.routing refresh")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_refresh())
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import os
+import re
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Sequence
+
+from langchain_core.documents import Document
+from langchain_core.prompts import ChatPromptTemplate
+
+logger = logging.getLogger("swedish_law_chat")
+
+SUMMARY_PARALLELISM = int(os.environ.get("SUMMARY_PARALLELISM", "6"))
+# Characters of source text per map call (~4k tokens) and summaries per reduce call
+SUMMARY_GROUP_CHARS = int(os.environ.get("SUMMARY_GROUP_CHARS", "16000"))
+SUMMARY_REDUCE_FAN_IN = int(os.environ.get("SUMMARY_REDUCE_FAN_IN", "6"))
+
+_SUMMARIZE_INTENT = re.compile(
+    r"\b(summari[sz]e|summary|summaries|overview|tl;?dr|key points|main points|gist|outline|"
+    r"analy[sz]e (this|the|my|these) (document|file|pdf|filing|agreement|order)s?)\b",
+    re.IGNORECASE,
+)
+
+MAP_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "You are summarizing one section of a larger U.S. family law document. "
+            "Summarize the section below in concise bullet points, keeping parties' roles "
+            "(not names), dates, amounts, obligations, deadlines and any statutes cited. "
+            "Do not add information that is not in the text.\n\nUser request: {request}",
+        ),
+        ("user", "Section {index} of {total}:\n\n{text}"),
+    ]
+)
+
+REDUCE_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "Combine the partial summaries below into one coherent summary that answers the "
+            "user's request. Remove duplication, keep every distinct obligation, amount, date "
+            "and statute, and never disclose personal names or case numbers. Use Markdown "
+            "headings and bullet points; never use tables.\n\nUser request: {request}",
+        ),
+        ("user", "{summaries}"),
+    ]
+)
+
+
+def is_summarize_intent(question: str) -> bool:
+    """Whether the user is asking for a summary/overview of uploaded documents"""
+    return bool(_SUMMARIZE_INTENT.search(question or ""))
+
+
+def group_documents(docs: Sequence[Document], max_chars: int = SUMMARY_GROUP_CHARS) -> List[str]:
+    """Concatenate consecutive chunks into map groups of at most max_chars"""
+    groups: List[str] = []
+    current: List[str] = []
+    size = 0
+    for doc in docs:
+        text = doc.page_content
+        if current and size + len(text) > max_chars:
+            groups.append("\n\n".join(current))
+            current, size = [], 0
+        current.append(text)
+        size += len(text)
+    if current:
+        groups.append("\n\n".join(current))
+    return groups
+
+
+class MapReduceSummarizer:
+    """
+    Summarizes long documents by mapping chunk groups concurrently (bounded by a
+    semaphore) and reducing the partial summaries hierarchically. Wall-clock grows
+    with document length divided by the number of parallel lanes.
+    """
+
+    def __init__(
+        self,
+        chat_model,
+        parallelism: int = SUMMARY_PARALLELISM,
+        group_chars: int = SUMMARY_GROUP_CHARS,
+        fan_in: int = SUMMARY_REDUCE_FAN_IN,
+    ):
+        self.chat_model = chat_model
+        self.parallelism = parallelism
+        self.group_chars = group_chars
+        self.fan_in = max(2, fan_in)
+
+    async def _gather_bounded(self, coroutines: List[Awaitable[str]]) -> List[str]:
+        semaphore = asyncio.Semaphore(self.parallelism)
+
+        async def run(coroutine: Awaitable[str]) -> str:
+            try:
+                async with semaphore:
+                    return await coroutine
+            finally:
+                # Calls cancelled while queued on the semaphore never started
+                coroutine.close()
+
+        tasks = [asyncio.ensure_future(run(c)) for c in coroutines]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            # One failed call fails the summary; stop the sibling calls instead of
+            # letting them spend tokens in the background
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def _map(self, request: str, text: str, index: int, total: int) -> str:
+        response = await (MAP_PROMPT | self.chat_model).ainvoke(
+            {"request": request, "text": text, "index": index, "total": total}
+        )
+        return response.content
+
+    async def _reduce(self, request: str, summaries: Sequence[str]) -> str:
+        response = await (REDUCE_PROMPT | self.chat_model).ainvoke(
+            {"request": request, "summaries": "\n\n---\n\n".join(summaries)}
+        )
+        return response.content
+
+    async def summarize(
+        self,
+        request: str,
+        docs: Sequence[Document],
+        on_progress: Optional[Callable[[str], Awaitable[None]]] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Yield the final summary token by token. Progress messages are reported through
+        `on_progress` while the map and intermediate reduce stages run.
+        """
+        groups = group_documents(docs, self.group_chars)
+        total = len(groups)
+        logger.info(f"Summarizing {len(docs)} chunks in {total} groups with {self.parallelism} lanes")
+        completed = 0
+
+        async def mapped(index: int, text: str) -> str:
+            nonlocal completed
+            summary = await self._map(request, text, index + 1, total)
+            completed += 1
+            if on_progress:
+                await on_progress(f"Summarizing sections… {completed}/{total}")
+            return summary
+
+        if total == 1:
+            summaries = [groups[0]]
+        else:
+            summaries = await self._gather_bounded([mapped(i, text) for i, text in enumerate(groups)])
+
+        # Hierarchical reduce until one final reduce call fits the fan-in
+        level = 1
+        while len(summaries) > self.fan_in:
+            batches = [summaries[i : i + self.fan_in] for i in range(0, len(summaries), self.fan_in)]
+            if on_progress:
+                await on_progress(f"Combining summaries (level {level}, {len(batches)} groups)…")
+            summaries = await self._gather_bounded([self._reduce(request, batch) for batch in batches])
+            level += 1
+
+        if on_progress:
+            await on_progress("Writing final summary…")
+        async for chunk in (REDUCE_PROMPT | self.chat_model).astream(
+            {"request": request, "summaries": "\n\n---\n\n".join(summaries)}
+        ):
+            yield chunk.content
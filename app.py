@@ -1,16 +1,23 @@
 from dotenv import load_dotenv
 from typing import Dict, Optional
+import asyncio
 import chainlit as cl
 import os
 import jwt
 import json
 import httpx
 
+from agent.cancellation import CancellationToken
 from agent.chat_handler import LawAgent
-from sql_data_layer import CustomSQLAlchemyDataLayer
+from agent.memo import RETRIEVAL_MEMO_ENABLED, RetrievalMemo
+from agent.summarize import is_summarize_intent
+from observability.metrics import set_plan, stage_timer
+from observability.tracing import set_attributes, setup_tracing, span, traced
+from sql_data_layer import get_shared_data_layer
 from storage.storage_clients.digitalocean import DigitalOceanStorageClient
 
 load_dotenv()
+setup_tracing()
 
 # Configuration
 FREE_USER_MESSAGE_LIMIT = int(os.environ.get("FREE_USER_MESSAGE_LIMIT", "20"))
@@ -46,18 +53,11 @@ def get_data_layer():
     """
     Get the data layer for Chainlit
 
-    This function returns a SQLAlchemyDataLayer instance configured with the
-    connection string from the environment variables.
+    Every callback and the FastAPI routes in main.py share one
+    CustomSQLAlchemyDataLayer (and so one connection pool) per process; it is
+    created from DATABASE_URL on first use and disposed on shutdown.
     """
-    conninfo = os.environ.get("DATABASE_URL")
-    cl.logger.info(f"Database connection string: {conninfo}")
-    if not conninfo:
-        raise ValueError("DATABASE_URL environment variable is not set")
-
-    # Make sure the connection string uses the asyncpg driver
-    if "postgresql" in conninfo and "+asyncpg" not in conninfo:
-        conninfo = conninfo.replace("postgresql://", "postgresql+asyncpg://")
-    return CustomSQLAlchemyDataLayer(conninfo=conninfo, storage_provider=storage_client)
+    return get_shared_data_layer(storage_provider=storage_client)
 
 @cl.password_auth_callback
 async def auth_callback(username: str, password: str):
@@ -170,6 +170,8 @@ async def on_chat_start():
     """Initialize the chat session"""
     # Initialize chat history
     cl.user_session.set("chat_history", [])
+    if RETRIEVAL_MEMO_ENABLED:
+        cl.user_session.set("retrieval_memo", RetrievalMemo())
 
     # Initialize vector store silently
     vector_store = chat_handler.setup_vector_store()
@@ -178,24 +180,37 @@ async def on_chat_start():
 
 
 @cl.on_message
+@traced("chat.message")
 async def on_message(message: cl.Message):
     """Handle user messages"""
     user_question = message.content
+    set_attributes(**{"thread.id": message.thread_id, "files": len(message.elements or [])})
+    
+    # Bind a cancellation token to this message so stop/disconnect abort generation
+    cancel_token = CancellationToken().bind()
+    cl.user_session.set("cancel_token", cancel_token)
     
     # Get current user and check message limits for free users
     current_user = cl.user_session.get("user")
+    user_role = None
+    remaining = None
     if current_user:
         # Get user role to check if they're a free user
         user_metadata = current_user.metadata or {}
         user_role = user_metadata.get("role", "USER")
+        # Every non-admin message goes through the free-plan quota
+        set_plan("admin" if user_role == "ADMIN" else "free")
+        set_attributes(plan="admin" if user_role == "ADMIN" else "free")
         
         # Skip limit check for admin users
         if user_role != "ADMIN":
             # Get data layer instance
             data_layer = get_data_layer()
             
-            # Check message limit (configurable for free users)
-            can_send, current_count = await data_layer.check_user_message_limit(current_user.identifier, FREE_USER_MESSAGE_LIMIT)
+            # Reserve this message against the limit (configurable for free users)
+            # in one atomic UPDATE; it is refunded if answering fails
+            with stage_timer("quota_check"):
+                can_send, message_count = await data_layer.reserve_user_message(current_user.identifier, FREE_USER_MESSAGE_LIMIT)
             
             if not can_send:
                 # User has reached their message limit
@@ -214,18 +229,45 @@ async def on_message(message: cl.Message):
             
             # Show warning when approaching limit (75% of limit)
             warning_threshold = max(1, int(FREE_USER_MESSAGE_LIMIT * 0.75))
+            current_count = message_count - 1
             if current_count >= warning_threshold:
                 remaining = FREE_USER_MESSAGE_LIMIT - current_count
-                await cl.Message(
-                    content=f"⚠️ **{remaining} messages remaining** in your free plan. [Upgrade now](/dashboard) for unlimited messages.",
-                    author="System"
-                ).send()
     
     msg = cl.Message(content="")
-    await msg.send()
-    await msg.stream_token(" ")
     # Get chat history
     chat_history = cl.user_session.get("chat_history", [])
+    # The message is reserved from here on; refund it if no answer is delivered
+    try:
+        response_content, docs = await answer_message(message, user_question, msg, chat_history, remaining)
+    except asyncio.CancelledError:
+        # Keep the partial answer in the conversation so follow-ups have context
+        if msg.content and msg.content.strip():
+            chat_history.append({"role": "assistant", "content": msg.content})
+        cl.user_session.set("chat_history", chat_history)
+        # Stopping counts against the quota once any of the answer has streamed
+        if not (msg.content or "").strip():
+            await refund_message(current_user, user_role)
+        raise
+    except Exception:
+        await refund_message(current_user, user_role)
+        raise
+    chat_history.append({"role": "assistant", "content": response_content})
+    cl.user_session.set("chat_history", chat_history)
+    
+    if (msg.metadata or {}).get("failed"):
+        await refund_message(current_user, user_role)
+
+
+async def answer_message(message: cl.Message, user_question: str, msg: cl.Message, chat_history: list, remaining: Optional[int]):
+    """Stream the answer to `message` into `msg`; returns (response_content, docs)"""
+    if remaining is not None:
+        await cl.Message(
+            content=f"⚠️ **{remaining} messages remaining** in your free plan. [Upgrade now](/dashboard) for unlimited messages.",
+            author="System"
+        ).send()
+
+    await msg.send()
+    await msg.stream_token(" ")
 
     # Process uploaded files if any
     additional_docs = []
@@ -247,9 +289,13 @@ async def on_message(message: cl.Message):
     # Add user message to chat history
     chat_history.append({"role": "user", "content": user_question})
 
+    # Summaries of uploads go through the parallel map-reduce pipeline instead of
+    # stuffing every chunk into a single prompt
+    summarize_uploads = bool(additional_docs) and is_summarize_intent(user_question)
+
     # Regenerate question if there's history
-    if len(chat_history) > 1:
-        regenerated_question = chat_handler.regenerate_question(chat_history, user_question)
+    if len(chat_history) > 1 and not summarize_uploads:
+        regenerated_question = await chat_handler.regenerate_question(chat_history, user_question)
 
         # Add debug info if needed
         if os.environ.get("DEBUG_MODE") == "true":
@@ -267,23 +313,54 @@ async def on_message(message: cl.Message):
     # await msg.send()
     # await msg.stream_token(" ")
     # Get streaming response
-    response_content, docs = await chat_handler.retrieve_and_generate_response(msg,
-                                                                               regenerated_question,
-                                                                               chat_history,
-                                                                               additional_docs
-                                                                               )
-    chat_history.append({"role": "assistant", "content": response_content})
-    cl.user_session.set("chat_history", chat_history)
+    if summarize_uploads:
+        return await chat_handler.summarize_uploaded_documents(msg,
+                                                               user_question,
+                                                               additional_docs
+                                                               )
+    return await chat_handler.retrieve_and_generate_response(msg,
+                                                             regenerated_question,
+                                                             chat_history,
+                                                             additional_docs,
+                                                             memo=cl.user_session.get("retrieval_memo")
+                                                             )
+
+
+async def refund_message(current_user, user_role: Optional[str]) -> None:
+    """Return the message reserved in on_message when no answer was delivered"""
+    if not current_user or user_role == "ADMIN":
+        return
+    try:
+        with span("quota_refund"):
+            new_count = await get_data_layer().refund_user_message(current_user.identifier)
+        cl.logger.info(f"Message count refunded to {new_count} for user {current_user.identifier}")
+    except Exception as e:
+        cl.logger.error(f"Failed to refund message for user {current_user.identifier}: {e}")
+
+
+@cl.on_stop
+async def on_stop():
+    """Abort the in-flight generation when the user presses stop"""
+    cancel_token = cl.user_session.get("cancel_token")
+    if cancel_token:
+        cancel_token.cancel("stop")
+
+
+@cl.on_chat_end
+async def on_chat_end():
+    """Abort the in-flight generation when the session ends (tab closed, disconnect)"""
+    cancel_token = cl.user_session.get("cancel_token")
+    if cancel_token:
+        cancel_token.cancel("disconnect")
     
-    # Increment message count for non-admin users after successful message processing
-    if current_user and user_role != "ADMIN":
-        try:
-            new_count = await data_layer.increment_user_message_count(current_user.identifier)
-            cl.logger.info(f"Message count incremented to {new_count} for user {current_user.identifier}")
-        except Exception as e:
-            cl.logger.error(f"Failed to increment message count for user {current_user.identifier}: {e}")
+    # Drop the per-thread retrieval memo right away instead of at session timeout
+    memo = cl.user_session.get("retrieval_memo")
+    if memo:
+        memo.clear()
+        cl.user_session.set("retrieval_memo", None)
 
 
 @cl.on_chat_resume
 async def on_chat_resume(thread):
-    pass
\ No newline at end of file
+    if RETRIEVAL_MEMO_ENABLED:
+        cl.user_session.set("retrieval_memo", RetrievalMemo())
\ No newline at end of file
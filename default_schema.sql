@@ -15,9 +15,12 @@ CREATE TABLE IF NOT EXISTS threads (
     "userIdentifier" TEXT,
     "tags" TEXT[],
     "metadata" JSONB,
+    "updatedAt" TEXT NOT NULL DEFAULT '',
     FOREIGN KEY ("userId") REFERENCES users("id") ON DELETE CASCADE
 );
 
+CREATE INDEX IF NOT EXISTS idx_threads_user_updated_at ON threads ("userId", "updatedAt", "id");
+
 CREATE TABLE IF NOT EXISTS steps (
     "id" UUID PRIMARY KEY,
     "name" TEXT NOT NULL,
@@ -40,9 +43,41 @@ CREATE TABLE IF NOT EXISTS steps (
     "language" TEXT,
     "indent" INT,
     "defaultOpen" BOOLEAN,
+    "search_vector" tsvector GENERATED ALWAYS AS (
+        to_tsvector('english', coalesce("input", '') || ' ' || coalesce("output", ''))
+    ) STORED,
     FOREIGN KEY ("threadId") REFERENCES threads("id") ON DELETE CASCADE
 );
 
+CREATE INDEX IF NOT EXISTS idx_steps_search_vector ON steps USING GIN ("search_vector");
+CREATE INDEX IF NOT EXISTS idx_steps_thread_created ON steps ("threadId", "createdAt");
+
+-- threads."updatedAt" follows the latest step (see migrations/add_thread_updated_at.sql)
+CREATE OR REPLACE FUNCTION threads_init_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW."updatedAt" := COALESCE(NULLIF(NEW."updatedAt", ''), NEW."createdAt", '');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER threads_init_updated_at
+    BEFORE INSERT ON threads
+    FOR EACH ROW EXECUTE FUNCTION threads_init_updated_at();
+
+CREATE OR REPLACE FUNCTION steps_touch_thread() RETURNS trigger AS $$
+BEGIN
+    UPDATE threads
+    SET "updatedAt" = NEW."createdAt"
+    WHERE "id" = NEW."threadId" AND "updatedAt" < NEW."createdAt";
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER steps_touch_thread
+    AFTER INSERT OR UPDATE OF "createdAt" ON steps
+    FOR EACH ROW WHEN (NEW."createdAt" IS NOT NULL)
+    EXECUTE FUNCTION steps_touch_thread();
+
 CREATE TABLE IF NOT EXISTS elements (
     "id" UUID PRIMARY KEY,
     "threadId" UUID,
@@ -61,6 +96,8 @@ CREATE TABLE IF NOT EXISTS elements (
     FOREIGN KEY ("threadId") REFERENCES threads("id") ON DELETE CASCADE
 );
 
+CREATE INDEX IF NOT EXISTS idx_elements_thread ON elements ("threadId");
+
 CREATE TABLE IF NOT EXISTS feedbacks (
     "id" UUID PRIMARY KEY,
     "forId" UUID NOT NULL,
@@ -68,4 +105,7 @@ CREATE TABLE IF NOT EXISTS feedbacks (
     "value" INT NOT NULL,
     "comment" TEXT,
     FOREIGN KEY ("threadId") REFERENCES threads("id") ON DELETE CASCADE
-);
\ No newline at end of file
+);
+
+CREATE INDEX IF NOT EXISTS idx_feedbacks_for ON feedbacks ("forId");
+CREATE INDEX IF NOT EXISTS idx_feedbacks_thread ON feedbacks ("threadId");
\ No newline at end of file
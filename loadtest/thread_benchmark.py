@@ -0,0 +1,243 @@
+"""
+Benchmark of loading one thread: Chainlit's get_thread against CustomSQLAlchemyDataLayer's.
+
+Seeds a throwaway user with --threads threads (steps, feedback and one stored
+element each) in the DATABASE_URL database, then loads random threads of that
+user through both implementations and reports latency percentiles and queries
+per call. The sidebar's first page (list_threads) is timed too. Elements are
+served by a storage client that takes --presign-ms per presigned URL, like the
+Spaces client behind Chainlit's thread pool.
+
+Apply default_schema.sql (or the migrations) first, then run:
+
+    DATABASE_URL=postgresql://... python -m loadtest.thread_benchmark --threads 1000
+
+The seeded user and everything under it are deleted afterwards unless --keep is given.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from typing import Any, Dict, List
+
+from chainlit.data.sql_alchemy import SQLAlchemyDataLayer as ChainlitSQLAlchemyDataLayer
+from chainlit.types import Pagination, ThreadFilter
+
+from loadtest.websocket_load import percentiles
+from sql_data_layer import CustomSQLAlchemyDataLayer, asyncpg_conninfo
+
+
+class SimulatedStorage:
+    """Storage client whose presigning takes a fixed time"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.presigned = 0
+
+    async def get_read_url(self, object_key: str) -> str:
+        self.presigned += 1
+        await asyncio.sleep(self.delay)
+        return f"https://storage.invalid/{object_key}?signature=benchmark"
+
+    async def upload_file(self, object_key: str, data, mime: str = "application/octet-stream", overwrite: bool = True) -> Dict:
+        return {"object_key": object_key, "url": f"https://storage.invalid/{object_key}"}
+
+    async def close(self) -> None:
+        pass
+
+
+class CountingDataLayer(CustomSQLAlchemyDataLayer):
+    """Counts the queries each benchmarked call issues"""
+
+    queries = 0
+
+    async def execute_sql(self, query: str, parameters: dict):
+        self.queries += 1
+        return await super().execute_sql(query, parameters)
+
+
+async def seed(data_layer: CountingDataLayer, args: argparse.Namespace) -> Dict[str, Any]:
+    user_id = str(uuid.uuid4())
+    identifier = f"thread-benchmark-{user_id[:8]}"
+    # user_key is the same id as text, for building object keys
+    parameters = {"user_id": user_id, "user_key": user_id, "identifier": identifier}
+    await data_layer.execute_sql(
+        """
+        INSERT INTO users ("id", "identifier", "metadata", "createdAt")
+        VALUES (CAST(:user_id AS UUID), :identifier, '{"role": "USER"}', to_char(now() AT TIME ZONE 'utc', 'YYYY-MM-DD"T"HH24:MI:SS.US"Z"'))
+        """,
+        parameters,
+    )
+    # Threads a few minutes apart, each with alternating user/assistant steps
+    await data_layer.execute_sql(
+        """
+        INSERT INTO threads ("id", "createdAt", "name", "userId", "userIdentifier", "metadata")
+        SELECT
+            gen_random_uuid(),
+            to_char((now() AT TIME ZONE 'utc') - make_interval(mins => n * 7), 'YYYY-MM-DD"T"HH24:MI:SS.US"Z"'),
+            'Benchmark thread ' || n,
+            CAST(:user_id AS UUID),
+            :identifier,
+            '{}'
+        FROM generate_series(1, CAST(:threads AS INTEGER)) AS n
+        """,
+        {**parameters, "threads": args.threads},
+    )
+    await data_layer.execute_sql(
+        """
+        INSERT INTO steps ("id", "name", "type", "threadId", "streaming", "metadata", "input", "output", "createdAt", "showInput")
+        SELECT
+            gen_random_uuid(),
+            CASE WHEN k % 2 = 1 THEN :identifier ELSE 'Assistant' END,
+            CASE WHEN k % 2 = 1 THEN 'user_message' ELSE 'assistant_message' END,
+            t."id",
+            false,
+            '{}',
+            '',
+            'Benchmark message ' || k || ' om uppsägningstid enligt lagen om anställningsskydd',
+            to_char(CAST(t."createdAt" AS timestamp) + make_interval(secs => k * 20), 'YYYY-MM-DD"T"HH24:MI:SS.US"Z"'),
+            'false'
+        FROM threads t
+        CROSS JOIN generate_series(1, CAST(:steps AS INTEGER)) AS k
+        WHERE t."userId" = CAST(:user_id AS UUID)
+        """,
+        {**parameters, "steps": args.steps},
+    )
+    await data_layer.execute_sql(
+        """
+        INSERT INTO feedbacks ("id", "forId", "threadId", "value", "comment")
+        SELECT gen_random_uuid(), s."id", s."threadId", 1, NULL
+        FROM steps s
+        JOIN threads t ON t."id" = s."threadId"
+        WHERE t."userId" = CAST(:user_id AS UUID) AND s."type" = 'assistant_message' AND random() < 0.3
+        """,
+        parameters,
+    )
+    await data_layer.execute_sql(
+        """
+        INSERT INTO elements ("id", "threadId", "type", "url", "name", "display", "objectKey", "mime", "props")
+        SELECT
+            gen_random_uuid(),
+            t."id",
+            'pdf',
+            'https://storage.invalid/' || CAST(:user_key AS TEXT) || '/' || t."id" || '/avtal.pdf',
+            'avtal.pdf',
+            'side',
+            CAST(:user_key AS TEXT) || '/' || t."id" || '/avtal.pdf',
+            'application/pdf',
+            '{}'
+        FROM threads t
+        WHERE t."userId" = CAST(:user_id AS UUID)
+        """,
+        parameters,
+    )
+    # Make sure the planner sees the seeded rows
+    for table in ("threads", "steps", "feedbacks", "elements"):
+        await data_layer.execute_sql(f"ANALYZE {table}", {})
+    rows = await data_layer.execute_sql(
+        """SELECT "id" FROM threads WHERE "userId" = CAST(:user_id AS UUID)""", parameters
+    )
+    return {"user_id": user_id, "identifier": identifier, "thread_ids": [row["id"] for row in rows or []]}
+
+
+async def measure(data_layer: CountingDataLayer, call, rounds: int) -> Dict[str, Any]:
+    timings: List[float] = []
+    queries: List[int] = []
+    for _ in range(rounds):
+        data_layer.queries = 0
+        start = time.perf_counter()
+        await call()
+        timings.append(time.perf_counter() - start)
+        queries.append(data_layer.queries)
+    return {**percentiles(timings), "queries_per_call": round(sum(queries) / max(len(queries), 1), 2)}
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    conninfo = os.environ.get("DATABASE_URL")
+    if not conninfo:
+        raise SystemExit("DATABASE_URL environment variable is not set")
+    storage = SimulatedStorage(args.presign_ms / 1000)
+    data_layer = CountingDataLayer(conninfo=asyncpg_conninfo(conninfo), storage_provider=storage)
+    seeded = await seed(data_layer, args)
+    try:
+        thread_ids = seeded["thread_ids"]
+        if not thread_ids:
+            raise SystemExit("Seeding failed, see the warnings above")
+
+        # Same thread sequence for both implementations, after one warm-up each
+        picks = [random.choice(thread_ids) for _ in range(args.rounds)]
+
+        def sequence(load):
+            remaining = iter(picks)
+            return lambda: load(next(remaining))
+
+        await ChainlitSQLAlchemyDataLayer.get_thread(data_layer, thread_ids[0])
+        await data_layer.get_thread(thread_ids[0])
+
+        storage.presigned = 0
+        chainlit = await measure(
+            data_layer, sequence(lambda tid: ChainlitSQLAlchemyDataLayer.get_thread(data_layer, tid)), args.rounds
+        )
+        chainlit["presigned_per_call"] = round(storage.presigned / args.rounds, 2)
+        storage.presigned = 0
+        custom = await measure(data_layer, sequence(data_layer.get_thread), args.rounds)
+        custom["presigned_per_call"] = round(storage.presigned / args.rounds, 2)
+
+        # Both must return the same thread, steps and feedback
+        sample = picks[0]
+        old = await ChainlitSQLAlchemyDataLayer.get_thread(data_layer, sample)
+        new = await data_layer.get_thread(sample)
+        same = (
+            old is not None
+            and new is not None
+            and old["id"] == new["id"]
+            and [step["id"] for step in old["steps"]] == [step["id"] for step in new["steps"]]
+            and [bool(step.get("feedback")) for step in old["steps"]] == [bool(step.get("feedback")) for step in new["steps"]]
+            and sorted(e["id"] for e in old["elements"]) == sorted(e["id"] for e in new["elements"])
+        )
+
+        first_page = await measure(
+            data_layer,
+            lambda: data_layer.list_threads(Pagination(first=20), ThreadFilter(userId=seeded["user_id"])),
+            args.rounds,
+        )
+        return {
+            "threads": len(thread_ids),
+            "steps_per_thread": args.steps,
+            "rounds": args.rounds,
+            "presign_ms": args.presign_ms,
+            "get_thread": {"chainlit": chainlit, "custom": custom, "same_result": same},
+            "list_threads_first_page": first_page,
+        }
+    finally:
+        if not args.keep:
+            # threads, steps, elements and feedbacks go with the user (ON DELETE CASCADE)
+            await data_layer.execute_sql(
+                """DELETE FROM users WHERE "id" = CAST(:user_id AS UUID)""", {"user_id": seeded["user_id"]}
+            )
+        await data_layer.close()
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="get_thread benchmark on a seeded user")
+    parser.add_argument("--threads", type=int, default=1000)
+    parser.add_argument("--steps", type=int, default=8, help="steps per thread")
+    parser.add_argument("--rounds", type=int, default=200, help="get_thread calls per implementation")
+    parser.add_argument("--presign-ms", type=float, default=5.0, help="simulated time to presign one element URL")
+    parser.add_argument("--keep", action="store_true", help="keep the seeded user and threads")
+    parser.add_argument("--output", help="write the JSON report here")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_args(sys.argv[1:])
+    report = asyncio.run(main(arguments))
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,346 @@
+"""
+Concurrent-session websocket load test for the Chainlit app.
+
+Opens N Chainlit socket sessions against a running `main:app`, logs each one in
+through the password callback, and plays scripted multi-turn conversations
+(optionally with uploads). Per turn it records time-to-first-token and full-answer
+latency; from the server's admin runtime endpoint it records event-loop lag, DB
+pool wait and RSS. The JSON report can be compared against an earlier run.
+
+Start the app with the fake backends and run, for example:
+
+    LAW_AGENT_BACKEND=fake uvicorn main:app --port 8000
+    python -m loadtest.websocket_load --sessions 50 --output loadtest/report.json
+
+or let the script start the server itself with `--spawn`. Add
+`--compare loadtest/baseline.json` to print the deltas against a previous report.
+"""
+
+import argparse
+import asyncio
+import json
+import mimetypes
+import os
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import httpx
+import socketio
+
+SOCKET_PATH = "/chat/ws/socket.io"
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def at(quantile: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(quantile * len(ordered)))] * 1000, 1)
+
+    return {"count": len(ordered), "p50_ms": at(0.5), "p95_ms": at(0.95), "p99_ms": at(0.99), "max_ms": at(1.0)}
+
+
+class SessionResult:
+    def __init__(self):
+        self.ttft: List[float] = []
+        self.answer: List[float] = []
+        self.errors: List[str] = []
+        self.turns = 0
+
+
+async def login(http: httpx.AsyncClient, username: str, password: str) -> str:
+    """Log in through the password callback and return the auth cookie header"""
+    response = await http.post("/chat/login", data={"username": username, "password": password})
+    response.raise_for_status()
+    return "; ".join(f"{name}={value}" for name, value in http.cookies.items())
+
+
+async def upload(http: httpx.AsyncClient, session_id: str, path: str) -> Dict:
+    mime = mimetypes.guess_type(path)[0] or "text/plain"
+    with open(path, "rb") as f:
+        response = await http.post(
+            "/chat/project/file",
+            params={"session_id": session_id},
+            files={"file": (os.path.basename(path), f.read(), mime)},
+        )
+    response.raise_for_status()
+    return {"id": response.json()["id"]}
+
+
+async def run_session(
+    base_url: str, username: str, password: str, conversation: List[Dict], think_time: float, turn_timeout: float
+) -> SessionResult:
+    result = SessionResult()
+    session_id = str(uuid.uuid4())
+    sio = socketio.AsyncClient(reconnection=False)
+    ready = asyncio.Event()
+    done = asyncio.Event()
+    state: Dict[str, Optional[float]] = {"started": None, "first_token": None}
+
+    @sio.on("stream_token")
+    async def on_token(data):
+        # The app primes each answer with a single space; wait for real content
+        if state["started"] and state["first_token"] is None and data.get("token", "").strip():
+            state["first_token"] = time.perf_counter()
+
+    @sio.on("task_end")
+    async def on_task_end(data):
+        if state["started"]:
+            done.set()
+        else:
+            ready.set()
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as http:
+        try:
+            cookie = await login(http, username, password)
+            await sio.connect(
+                base_url,
+                socketio_path=SOCKET_PATH,
+                transports=["websocket"],
+                headers={"Cookie": cookie},
+                auth={
+                    "clientType": "webapp",
+                    "sessionId": session_id,
+                    "threadId": None,
+                    "userEnv": "{}",
+                    "chatProfile": None,
+                },
+            )
+            await sio.emit("connection_successful")
+            await asyncio.wait_for(ready.wait(), timeout=turn_timeout)
+
+            for turn in conversation:
+                file_references = [await upload(http, session_id, turn["upload"])] if turn.get("upload") else []
+                done.clear()
+                state["first_token"] = None
+                state["started"] = time.perf_counter()
+                await sio.emit(
+                    "client_message",
+                    {
+                        "message": {
+                            "id": str(uuid.uuid4()),
+                            "threadId": "",
+                            "name": username,
+                            "type": "user_message",
+                            "output": turn["text"],
+                            "createdAt": datetime.now(timezone.utc).isoformat(),
+                        },
+                        "fileReferences": file_references,
+                    },
+                )
+                await asyncio.wait_for(done.wait(), timeout=turn_timeout)
+                finished = time.perf_counter()
+                if state["first_token"] is not None:
+                    result.ttft.append(state["first_token"] - state["started"])
+                result.answer.append(finished - state["started"])
+                result.turns += 1
+                state["started"] = None
+                await asyncio.sleep(think_time)
+        except Exception as e:
+            result.errors.append(f"{type(e).__name__}: {e}")
+        finally:
+            if sio.connected:
+                await sio.disconnect()
+    return result
+
+
+class RuntimeMonitor:
+    """Polls the admin runtime endpoint during the run to track peak RSS"""
+
+    def __init__(self, base_url: str, username: str, password: str, interval: float = 1.0):
+        self.base_url = base_url
+        self.username = username
+        self.password = password
+        self.interval = interval
+        self.first: Optional[Dict] = None
+        self.last: Optional[Dict] = None
+        self.peak_rss = 0
+        self._http: Optional[httpx.AsyncClient] = None
+
+    async def snapshot(self) -> Optional[Dict]:
+        try:
+            response = await self._http.get("/chat/api/admin/runtime")
+            response.raise_for_status()
+            data = response.json()
+        except Exception as e:
+            print(f"runtime endpoint unavailable: {e}", file=sys.stderr)
+            return None
+        self.peak_rss = max(self.peak_rss, data.get("rss_bytes", 0))
+        return data
+
+    async def start(self) -> None:
+        self._http = httpx.AsyncClient(base_url=self.base_url, timeout=10)
+        await login(self._http, self.username, self.password)
+        self.first = await self.snapshot()
+
+    async def poll(self, stop: asyncio.Event) -> None:
+        while not stop.is_set():
+            await asyncio.sleep(self.interval)
+            snapshot = await self.snapshot()
+            if snapshot:
+                self.last = snapshot
+
+    async def close(self) -> None:
+        self.last = await self.snapshot() or self.last
+        await self._http.aclose()
+
+
+def _window_delta(first: Optional[Dict], last: Optional[Dict]) -> Dict:
+    """Mean over the run from two cumulative window summaries, plus the latest percentiles"""
+    if not last:
+        return {}
+    summary = dict(last)
+    if first and last["count"] > first["count"]:
+        total = last["mean_ms"] * last["count"] - first["mean_ms"] * first["count"]
+        summary["run_mean_ms"] = round(total / (last["count"] - first["count"]), 3)
+        summary["run_count"] = last["count"] - first["count"]
+    return summary
+
+
+def build_report(args, scenario: Dict, results: List[SessionResult], monitor: RuntimeMonitor, duration: float) -> Dict:
+    ttft = [value for r in results for value in r.ttft]
+    answer = [value for r in results for value in r.answer]
+    errors = [error for r in results for error in r.errors]
+    turns = sum(r.turns for r in results)
+    server: Dict = {}
+    first, last = monitor.first, monitor.last
+    if last:
+        baseline_rss = first["rss_bytes"] if first else last["rss_bytes"]
+        server = {
+            "event_loop_lag": _window_delta(first and first["event_loop_lag"], last["event_loop_lag"]),
+            "db_pool_wait": _window_delta(first and first["db_pool_wait"], last["db_pool_wait"]),
+            "db_pool": last.get("db_pool", {}),
+            "rss_baseline_mb": round(baseline_rss / 2**20, 1),
+            "rss_peak_mb": round(monitor.peak_rss / 2**20, 1),
+            "rss_per_session_kb": round((monitor.peak_rss - baseline_rss) / 1024 / max(1, args.sessions), 1),
+        }
+    return {
+        "scenario": scenario.get("name"),
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {"sessions": args.sessions, "ramp_up": args.ramp_up, "url": args.url},
+        "duration_s": round(duration, 2),
+        "turns_completed": turns,
+        "turns_per_second": round(turns / duration, 2) if duration else 0.0,
+        "sessions_failed": sum(1 for r in results if r.errors),
+        "errors": errors[:20],
+        "ttft": percentiles(ttft),
+        "answer": percentiles(answer),
+        "server": server,
+    }
+
+
+COMPARED_METRICS = [
+    ("ttft", "p50_ms"), ("ttft", "p95_ms"), ("answer", "p50_ms"), ("answer", "p95_ms"),
+    ("server.event_loop_lag", "p99_ms"), ("server.db_pool_wait", "run_mean_ms"),
+    ("server", "rss_per_session_kb"), ("", "turns_per_second"),
+]
+
+
+def compare(report: Dict, baseline: Dict) -> None:
+    """Print the main metrics next to a baseline report"""
+
+    def lookup(data: Dict, section: str, key: str):
+        for part in filter(None, section.split(".")):
+            data = data.get(part, {})
+        return data.get(key)
+
+    print(f"{'metric':40} {'baseline':>12} {'current':>12} {'delta':>9}")
+    for section, key in COMPARED_METRICS:
+        old, new = lookup(baseline, section, key), lookup(report, section, key)
+        name = f"{section}.{key}".strip(".")
+        if old is None or new is None:
+            print(f"{name:40} {str(old):>12} {str(new):>12}")
+            continue
+        delta = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"{name:40} {old:>12} {new:>12} {delta:>9}")
+
+
+def spawn_server(port: int) -> subprocess.Popen:
+    env = {**os.environ, "LAW_AGENT_BACKEND": os.environ.get("LAW_AGENT_BACKEND", "fake")}
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"], env=env
+    )
+
+
+async def wait_until_up(base_url: str, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as http:
+        while time.monotonic() < deadline:
+            try:
+                if (await http.get("/chat/hello")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f"Server at {base_url} did not come up within {timeout}s")
+
+
+async def main(args: argparse.Namespace) -> Dict:
+    with open(args.scenario) as f:
+        scenario = json.load(f)
+    conversations = scenario["conversations"]
+    server = spawn_server(args.port) if args.spawn else None
+    try:
+        await wait_until_up(args.url)
+        monitor = RuntimeMonitor(args.url, args.admin_username, args.admin_password)
+        await monitor.start()
+        stop = asyncio.Event()
+        poller = asyncio.create_task(monitor.poll(stop))
+
+        async def delayed(index: int) -> SessionResult:
+            await asyncio.sleep(args.ramp_up * index / max(1, args.sessions))
+            return await run_session(
+                args.url,
+                args.username,
+                args.password,
+                conversations[index % len(conversations)],
+                scenario.get("think_time", 1.0),
+                args.turn_timeout,
+            )
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(delayed(i) for i in range(args.sessions)))
+        duration = time.perf_counter() - started
+        stop.set()
+        await poller
+        await monitor.close()
+        return build_report(args, scenario, results, monitor, duration)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Chainlit websocket load test")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="seconds over which sessions are started")
+    parser.add_argument("--scenario", default="loadtest/scenario_default.json")
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin")
+    parser.add_argument("--admin-username", default="admin")
+    parser.add_argument("--admin-password", default="admin")
+    parser.add_argument("--turn-timeout", type=float, default=120.0)
+    parser.add_argument("--spawn", action="store_true", help="start main:app with the fake backends")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="baseline report to compare against")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_args(sys.argv[1:])
+    report = asyncio.run(main(arguments))
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps({k: report[k] for k in ("turns_completed", "sessions_failed", "ttft", "answer", "server")}, indent=2))
+    if arguments.compare:
+        with open(arguments.compare) as f:
+            compare(report, json.load(f))
@@ -6,13 +6,15 @@ It mounts the Chainlit application and registers additional routes
 for Google OAuth authentication and Stripe subscription management.
 """
 
+import hmac
 import os
 import stripe
+from contextlib import asynccontextmanager
 from chainlit import User, PersistedUser
 from chainlit.auth import get_current_user
 from fastapi import FastAPI, Request, HTTPException, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
 from pydantic import BaseModel
 from typing import Optional, Union, Annotated, List
 from chainlit.oauth_providers import GoogleOAuthProvider
@@ -21,7 +23,11 @@ from auth_providers.google_oauth_provider import GoogleOAuthProvider as CustomGo
 from chainlit.utils import mount_chainlit
 from chainlit.server import _authenticate_user
 from services.stripe_service import StripeService
-from sql_data_layer import CustomSQLAlchemyDataLayer
+from observability.metrics import METRICS_PUBLIC, METRICS_TOKEN, REGISTRY
+from observability.runtime import BLOCKING_CALLS, EVENT_LOOP_LAG, runtime_snapshot
+from observability.tracing import set_attributes, setup_tracing, shutdown_tracing, span
+from chainlit.data import get_data_layer
+from sql_data_layer import ELEMENT_READ_ROUTE, close_shared_data_layer
 
 # Configuration
 FREE_USER_MESSAGE_LIMIT = int(os.environ.get("FREE_USER_MESSAGE_LIMIT", "20"))
@@ -48,7 +54,33 @@ async def get_admin_user(current_user: UserParam) -> GenericUser:
 AdminUserParam = Annotated[GenericUser, Depends(get_admin_user)]
 
 GoogleOAuthProvider.get_user_info = CustomGoogleOAuthProvider.get_user_info_patched
-app = FastAPI(title="Chainlit with Google OAuth")
+setup_tracing()
+
+# Shared data layer and Stripe service, set up in the lifespan below
+data_layer = None
+stripe_service = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the process-wide services on startup and dispose of them on shutdown"""
+    global data_layer, stripe_service
+
+    # Resolved through Chainlit so app.py's callbacks and these routes share
+    # one data layer and one connection pool
+    data_layer = get_data_layer()
+    # Log missing optional migrations up front instead of on the first sidebar load
+    await data_layer.detect_schema()
+    stripe_service = StripeService(data_layer)
+    EVENT_LOOP_LAG.start()
+    try:
+        yield
+    finally:
+        await EVENT_LOOP_LAG.stop()
+        await close_shared_data_layer()
+        # Flush buffered spans before the process exits
+        shutdown_tracing()
+
+app = FastAPI(title="Chainlit with Google OAuth", lifespan=lifespan)
 
 # Add CORS middleware for React app communication
 app.add_middleware(
@@ -59,22 +91,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize data layer and Stripe service
-data_layer = None
-stripe_service = None
-
-@app.on_event("startup")
-async def startup():
-    """Initialize services on startup"""
-    global data_layer, stripe_service
-    
-    conninfo = os.environ.get("DATABASE_URL")
-    if conninfo and "postgresql" in conninfo and "+asyncpg" not in conninfo:
-        conninfo = conninfo.replace("postgresql://", "postgresql+asyncpg://")
-    
-    data_layer = CustomSQLAlchemyDataLayer(conninfo=conninfo)
-    stripe_service = StripeService(data_layer)
-
 # Pydantic models for request/response
 class CreateCheckoutSessionRequest(BaseModel):
     price_id: str
@@ -388,10 +404,7 @@ async def get_usage_status(current_user: UserParam):
                 "remaining": -1  # -1 indicates unlimited
             }
         
-        # Get current message count for regular users
-        message_count = await data_layer.get_user_message_count(current_user.identifier)
-        
-        # Check if user can send more messages
+        # Same count on_message reserves against
         can_send, current_count = await data_layer.check_user_message_limit(current_user.identifier, FREE_USER_MESSAGE_LIMIT)
         
         return {
@@ -404,6 +417,26 @@ async def get_usage_status(current_user: UserParam):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting usage status: {str(e)}")
 
+# ========== Thread Element API ==========
+
+@app.get(ELEMENT_READ_ROUTE + "/{thread_id}/{element_id}")
+async def read_thread_element(thread_id: str, element_id: str, current_user: UserParam):
+    """Redirect to a presigned URL of a thread element (the lazy element URLs of get_thread)"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    try:
+        author = await data_layer.get_thread_author(thread_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Element not found")
+    if author != current_user.identifier:
+        raise HTTPException(status_code=403, detail="Not the author of this thread")
+    
+    url = await data_layer.get_element_read_url(thread_id, element_id)
+    if not url:
+        raise HTTPException(status_code=404, detail="Element not found")
+    # Presigned URLs live for an hour; let the browser reuse the redirect for a while
+    return RedirectResponse(url, status_code=307, headers={"Cache-Control": "private, max-age=600"})
+
 # ========== Authentication API Endpoints ==========
 
 @app.post("/chat/api/auth/signup", response_model=SignupResponse)
@@ -605,6 +638,21 @@ async def get_global_billing_history(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/chat/api/admin/runtime")
+async def get_runtime_stats(admin_user: AdminUserParam):
+    """Event-loop lag, DB pool wait and memory of this worker (used by the load test)"""
+    snapshot = runtime_snapshot(data_layer.engine if data_layer else None)
+    if data_layer and data_layer.usage_buffer is not None:
+        snapshot["usage_buffer"] = data_layer.usage_buffer.stats
+    if data_layer and data_layer.user_cache is not None:
+        snapshot["user_cache"] = data_layer.user_cache.stats
+    return snapshot
+
+@app.get("/chat/api/admin/runtime/blocking")
+async def get_blocking_calls(admin_user: AdminUserParam, limit: int = 20):
+    """Call sites that blocked the event loop, ordered by cumulative blocked time"""
+    return {"summary": BLOCKING_CALLS.summary(), "offenders": BLOCKING_CALLS.top(limit)}
+
 @app.get("/chat/api/admin/users/{user_id}/subscription")
 async def get_user_subscription_admin(
     user_id: str,
@@ -684,43 +732,56 @@ async def get_user_billing_admin(
 @app.post("/chat/api/stripe/webhook/")
 async def stripe_webhook(request: Request):
     """Handle Stripe webhook events"""
-    try:
-        payload = await request.body()
-        sig_header = request.headers.get('stripe-signature')
-        #
-        # if not sig_header:
-        #     raise HTTPException(status_code=400, detail="Missing stripe-signature header")
-        
-        # Verify webhook signature
-        # webhook_secret = stripe_service.webhook_secret
-
-        webhook_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
-        if webhook_secret:
-            try:
-                event = stripe.Webhook.construct_event(
-                    payload, sig_header, webhook_secret
-                )
-            except ValueError:
-                raise HTTPException(status_code=400, detail="Invalid payload")
-            except stripe.error.SignatureVerificationError:
-                raise HTTPException(status_code=400, detail="Invalid signature")
-        else:
-            # If no webhook secret is configured, parse the payload directly (not recommended for production)
-            import json
-            event = json.loads(payload.decode('utf-8'))
+    with span("stripe.webhook"):
+        try:
+            payload = await request.body()
+            sig_header = request.headers.get('stripe-signature')
+            #
+            # if not sig_header:
+            #     raise HTTPException(status_code=400, detail="Missing stripe-signature header")
+        
+            # Verify webhook signature
+            # webhook_secret = stripe_service.webhook_secret
+
+            webhook_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
+            if webhook_secret:
+                try:
+                    event = stripe.Webhook.construct_event(
+                        payload, sig_header, webhook_secret
+                    )
+                except ValueError:
+                    raise HTTPException(status_code=400, detail="Invalid payload")
+                except stripe.error.SignatureVerificationError:
+                    raise HTTPException(status_code=400, detail="Invalid signature")
+            else:
+                # If no webhook secret is configured, parse the payload directly (not recommended for production)
+                import json
+                event = json.loads(payload.decode('utf-8'))
         
-        # Process the webhook event
-        success = await stripe_service.handle_webhook_event(event)
+            set_attributes(**{"stripe.event_type": event.get("type")})
+
+            # Process the webhook event
+            success = await stripe_service.handle_webhook_event(event)
         
-        if success:
-            return {"status": "success"}
-        else:
-            raise HTTPException(status_code=500, detail="Failed to process webhook event")
+            if success:
+                return {"status": "success"}
+            else:
+                raise HTTPException(status_code=500, detail="Failed to process webhook event")
             
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Webhook processing failed: {str(e)}")
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Webhook processing failed: {str(e)}")
+
+@app.get("/metrics")
+async def metrics(authorization: Optional[str] = Header(None)):
+    """Prometheus scrape endpoint; requires METRICS_TOKEN unless METRICS_PUBLIC is set"""
+    if not METRICS_PUBLIC:
+        if not METRICS_TOKEN:
+            raise HTTPException(status_code=404, detail="Not Found")
+        if not hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+            raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/chat/hello")
 async def hello():
@@ -0,0 +1,10 @@
+-- Migration: indexes for loading a single thread
+-- Backs CustomSQLAlchemyDataLayer.get_thread (steps and feedback by thread,
+-- elements by thread) and the feedback filter of list_threads. Postgres does
+-- not index foreign keys on its own, so without these every lookup scans the table.
+
+-- CONCURRENTLY keeps the tables writable while the indexes build (cannot run inside a transaction)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_steps_thread_created ON steps ("threadId", "createdAt");
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_elements_thread ON elements ("threadId");
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_feedbacks_for ON feedbacks ("forId");
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_feedbacks_thread ON feedbacks ("threadId");
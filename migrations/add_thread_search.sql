@@ -0,0 +1,12 @@
+-- Migration: full-text search over thread steps
+-- Backs the search box of list_threads (CustomSQLAlchemyDataLayer.search_threads)
+-- with a stored tsvector of each step's input and output and a GIN index on it.
+
+-- Adding a stored generated column rewrites the steps table; run it in a
+-- maintenance window on large databases
+ALTER TABLE steps ADD COLUMN IF NOT EXISTS "search_vector" tsvector GENERATED ALWAYS AS (
+    to_tsvector('english', coalesce("input", '') || ' ' || coalesce("output", ''))
+) STORED;
+
+-- CONCURRENTLY keeps steps writable while the index builds (cannot run inside a transaction)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_steps_search_vector ON steps USING GIN ("search_vector");
@@ -0,0 +1,51 @@
+-- Migration: denormalized threads."updatedAt"
+-- The sidebar sorts threads by their latest step. Instead of MAX(steps."createdAt")
+-- over every step of the user, threads."updatedAt" is kept current by triggers
+-- and listed through an index on ("userId", "updatedAt", "id").
+
+ALTER TABLE threads ADD COLUMN IF NOT EXISTS "updatedAt" TEXT;
+
+-- New threads start at their creation time
+CREATE OR REPLACE FUNCTION threads_init_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW."updatedAt" := COALESCE(NULLIF(NEW."updatedAt", ''), NEW."createdAt", '');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS threads_init_updated_at ON threads;
+CREATE TRIGGER threads_init_updated_at
+    BEFORE INSERT ON threads
+    FOR EACH ROW EXECUTE FUNCTION threads_init_updated_at();
+
+-- Every step write moves its thread forward (never backward)
+CREATE OR REPLACE FUNCTION steps_touch_thread() RETURNS trigger AS $$
+BEGIN
+    UPDATE threads
+    SET "updatedAt" = NEW."createdAt"
+    WHERE "id" = NEW."threadId" AND "updatedAt" < NEW."createdAt";
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS steps_touch_thread ON steps;
+CREATE TRIGGER steps_touch_thread
+    AFTER INSERT OR UPDATE OF "createdAt" ON steps
+    FOR EACH ROW WHEN (NEW."createdAt" IS NOT NULL)
+    EXECUTE FUNCTION steps_touch_thread();
+
+-- Backfill after the triggers exist so no step written meanwhile is missed:
+-- latest step, or the thread's own creation time
+UPDATE threads t
+SET "updatedAt" = COALESCE(
+    (SELECT MAX(s."createdAt") FROM steps s WHERE s."threadId" = t."id"),
+    t."createdAt",
+    ''
+)
+WHERE t."updatedAt" IS NULL;
+
+ALTER TABLE threads ALTER COLUMN "updatedAt" SET DEFAULT '';
+ALTER TABLE threads ALTER COLUMN "updatedAt" SET NOT NULL;
+
+-- CONCURRENTLY keeps threads writable while the index builds (cannot run inside a transaction)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_threads_user_updated_at ON threads ("userId", "updatedAt", "id");
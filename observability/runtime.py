@@ -0,0 +1,395 @@
+"""
+Process runtime probes: event-loop lag, blocking calls, DB pool wait and memory.
+
+`EVENT_LOOP_LAG` samples how late a periodic wake-up fires; while that wake-up
+is overdue by more than SLOW_CALLBACK_SECONDS, a watchdog thread samples the
+loop thread's stack so the blocking call (bcrypt, a sync Stripe or LangChain
+call, a file loader) is attributed its blocked time. `DB_POOL_WAIT` records how
+long each connection checkout waited on the pool, not counting the time spent
+opening a new connection. All of it is cheap enough to leave on: the
+watchdog only compares two floats per tick until the loop actually stalls.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, List, Optional
+
+from sqlalchemy import event
+
+from observability.metrics import REGISTRY
+
+logger = logging.getLogger("swedish_law_chat")
+
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.1"))
+SLOW_CALLBACK_SECONDS = float(os.environ.get("SLOW_CALLBACK_SECONDS", "0.1"))
+LOOP_WATCHDOG_INTERVAL = float(os.environ.get("LOOP_WATCHDOG_INTERVAL", "0.05"))
+LOOP_BLOCK_LOG_SECONDS = float(os.environ.get("LOOP_BLOCK_LOG_SECONDS", "1.0"))
+BLOCKING_SITES_MAX = int(os.environ.get("BLOCKING_SITES_MAX", "200"))
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+EVENT_LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "law_event_loop_lag_seconds",
+    "How late the event loop ran a timed wake-up",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+EVENT_LOOP_BLOCKED_SECONDS = REGISTRY.counter(
+    "law_event_loop_blocked_seconds_total", "Time the event loop spent in stalls longer than SLOW_CALLBACK_SECONDS"
+)
+DB_POOL_CHECKOUT_SECONDS = REGISTRY.histogram(
+    "law_db_pool_checkout_wait_seconds",
+    "Time spent waiting for a pooled database connection",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0),
+)
+DB_POOL_CONNECT_SECONDS = REGISTRY.histogram(
+    "law_db_pool_connect_seconds",
+    "Time spent opening a new database connection for the pool",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0),
+)
+DB_POOL_CONNECTIONS = REGISTRY.gauge(
+    "law_db_pool_connections", "Connections of the data layer pool by state (in_use, idle, overflow, size)", ["state"]
+)
+DB_POOL_CHECKOUT_WAIT_P99 = REGISTRY.gauge(
+    "law_db_pool_checkout_wait_p99_seconds", "p99 connection checkout wait over the recent window"
+)
+BLOCKING_SITE_SECONDS = REGISTRY.gauge(
+    "law_event_loop_blocking_site_seconds",
+    "Cumulative blocked time of the top blocking call sites",
+    ["site"],
+)
+
+
+class SampleWindow:
+    """Bounded window of recent samples (seconds) with percentile summaries"""
+
+    def __init__(self, size: int = 2048):
+        self._samples: Deque[float] = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value: float) -> None:
+        self._samples.append(value)
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, quantile: float) -> float:
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(0.5) * 1000, 3),
+            "p99_ms": round(self.percentile(0.99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+def _is_project_frame(filename: str) -> bool:
+    return filename.startswith(PROJECT_ROOT) and "site-packages" not in filename
+
+
+def summarize_stack(frame, depth: int = 8) -> Dict:
+    """Name a blocking call site after the innermost project frame and the innermost frame overall"""
+    stack = traceback.extract_stack(frame)
+    project_frames = [f for f in stack if _is_project_frame(f.filename)]
+    innermost = stack[-1] if stack else None
+    anchor = project_frames[-1] if project_frames else innermost
+
+    def describe(f) -> str:
+        return f"{os.path.relpath(f.filename, PROJECT_ROOT) if _is_project_frame(f.filename) else f.filename}:{f.lineno} {f.name}"
+
+    site = describe(anchor) if anchor else "unknown"
+    if innermost is not None and innermost is not anchor:
+        site = f"{site} -> {innermost.name}"
+    return {
+        "site": site,
+        "stack": [f"{describe(f)}: {(f.line or '').strip()}" for f in stack[-depth:]],
+    }
+
+
+class BlockingCallMonitor:
+    """
+    Watchdog thread attributing event-loop stalls to the code that caused them.
+
+    Every LOOP_WATCHDOG_INTERVAL it checks the lag sampler's heartbeat. Once the
+    next wake-up is SLOW_CALLBACK_SECONDS overdue, it samples the loop thread's
+    stack on each tick and charges the time since the previous tick to that call
+    site, so a site's total approximates how long it kept the loop blocked.
+    """
+
+    def __init__(self, threshold: float = SLOW_CALLBACK_SECONDS, interval: float = LOOP_WATCHDOG_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.sites: Dict[str, Dict] = {}
+        self.stalls = 0
+        self.blocked_seconds = 0.0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._loop_thread_id: Optional[int] = None
+        self._deadline = 0.0
+
+    def heartbeat(self, next_deadline: float) -> None:
+        """Called from the loop: the next wake-up is due at `next_deadline` (time.monotonic)"""
+        self._deadline = next_deadline
+
+    def start(self, deadline: float) -> None:
+        self._loop_thread_id = threading.get_ident()
+        self._deadline = deadline
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _watch(self) -> None:
+        stall_deadline = None
+        charged_until = 0.0
+        stall_sites: set = set()
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            deadline = self._deadline
+            if now - deadline < self.threshold:
+                if stall_deadline is not None:
+                    self._end_stall(stall_deadline, charged_until, stall_sites)
+                    stall_deadline = None
+                continue
+            if stall_deadline != deadline:
+                if stall_deadline is not None:
+                    self._end_stall(stall_deadline, charged_until, stall_sites)
+                stall_deadline, charged_until, stall_sites = deadline, deadline, set()
+                self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            summary = summarize_stack(frame)
+            del frame
+            self._charge(summary, now - charged_until, first=summary["site"] not in stall_sites)
+            stall_sites.add(summary["site"])
+            charged_until = now
+
+    def _charge(self, summary: Dict, seconds: float, first: bool) -> None:
+        with self._lock:
+            entry = self.sites.get(summary["site"])
+            if entry is None:
+                if len(self.sites) >= BLOCKING_SITES_MAX:
+                    smallest = min(self.sites, key=lambda site: self.sites[site]["blocked_seconds"])
+                    del self.sites[smallest]
+                entry = {"site": summary["site"], "count": 0, "blocked_seconds": 0.0, "max_seconds": 0.0}
+                self.sites[summary["site"]] = entry
+            entry["blocked_seconds"] += seconds
+            entry["stack"] = summary["stack"]
+            entry["last_seen"] = time.time()
+            if first:
+                entry["count"] += 1
+                entry["current"] = seconds
+            else:
+                entry["current"] = entry.get("current", 0.0) + seconds
+            entry["max_seconds"] = max(entry["max_seconds"], entry["current"])
+        self.blocked_seconds += seconds
+        EVENT_LOOP_BLOCKED_SECONDS.inc(seconds)
+
+    def _end_stall(self, deadline: float, charged_until: float, sites: set) -> None:
+        duration = charged_until - deadline
+        if duration >= LOOP_BLOCK_LOG_SECONDS:
+            logger.warning(f"Event loop blocked for {duration:.2f}s in {', '.join(sorted(sites))}")
+
+    def top(self, limit: int = 20) -> List[Dict]:
+        """Blocking call sites ordered by cumulative blocked time"""
+        with self._lock:
+            entries = sorted(self.sites.values(), key=lambda e: e["blocked_seconds"], reverse=True)[:limit]
+            return [
+                {
+                    "site": e["site"],
+                    "count": e["count"],
+                    "blocked_ms": round(e["blocked_seconds"] * 1000, 1),
+                    "max_ms": round(e["max_seconds"] * 1000, 1),
+                    "last_seen": e["last_seen"],
+                    "stack": e["stack"],
+                }
+                for e in entries
+            ]
+
+    def summary(self) -> Dict:
+        return {
+            "threshold_ms": round(self.threshold * 1000, 1),
+            "stalls": self.stalls,
+            "blocked_ms": round(self.blocked_seconds * 1000, 1),
+            "sites": len(self.sites),
+        }
+
+
+class EventLoopLagSampler:
+    """Background task measuring how late the event loop runs a timed wake-up"""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, monitor: Optional[BlockingCallMonitor] = None):
+        self.interval = interval
+        self.lag = SampleWindow()
+        self.monitor = monitor
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            if self.monitor is not None:
+                self.monitor.start(time.monotonic() + self.interval)
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.monitor is not None:
+            self.monitor.stop()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            if self.monitor is not None:
+                self.monitor.heartbeat(time.monotonic() + self.interval)
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.lag.record(lag)
+            EVENT_LOOP_LAG_SECONDS.observe(lag)
+
+
+BLOCKING_CALLS = BlockingCallMonitor()
+EVENT_LOOP_LAG = EventLoopLagSampler(monitor=BLOCKING_CALLS)
+
+
+def _collect_blocking_sites() -> None:
+    BLOCKING_SITE_SECONDS.clear()
+    for entry in BLOCKING_CALLS.top(10):
+        BLOCKING_SITE_SECONDS.set(entry["blocked_ms"] / 1000, site=entry["site"])
+
+
+REGISTRY.on_collect(_collect_blocking_sites)
+
+DB_POOL_WAIT = SampleWindow()
+
+# Engine whose pool the /metrics gauges report on (the shared data layer's)
+_instrumented_engine = None
+# Connection record info keys set by the connect listeners
+_CONNECT_STARTED = "law_connect_started"
+_CONNECT_SECONDS = "law_connect_seconds"
+
+
+def instrument_pool(engine) -> None:
+    """
+    Time new connections of an (async) SQLAlchemy engine's pool with its public
+    connect events, and report the pool on /metrics. The listeners live on the
+    engine, so they carry over when `dispose()` recreates the pool.
+    """
+    global _instrumented_engine
+    sync_engine = getattr(engine, "sync_engine", engine)
+    _instrumented_engine = engine
+    if event.contains(sync_engine, "connect", _connected):
+        return
+    event.listen(sync_engine, "do_connect", _connecting)
+    event.listen(sync_engine, "connect", _connected)
+
+
+def _connecting(dialect, conn_rec, cargs, cparams) -> None:
+    conn_rec.info[_CONNECT_STARTED] = time.perf_counter()
+
+
+def _connected(dbapi_connection, connection_record) -> None:
+    started = connection_record.info.pop(_CONNECT_STARTED, None)
+    if started is None:
+        return
+    created = time.perf_counter() - started
+    DB_POOL_CONNECT_SECONDS.observe(created)
+    # Deducted from the wait of the checkout that opened this connection
+    connection_record.info[_CONNECT_SECONDS] = created
+
+
+async def record_checkout(connection, started: float) -> None:
+    """
+    Record the pool wait of a checkout that began at `started` (perf_counter),
+    excluding the time spent opening a new connection for it
+    """
+    raw = await connection.get_raw_connection()
+    waited = max(0.0, time.perf_counter() - started - raw.info.pop(_CONNECT_SECONDS, 0.0))
+    DB_POOL_WAIT.record(waited)
+    DB_POOL_CHECKOUT_SECONDS.observe(waited)
+
+
+@asynccontextmanager
+async def pooled_connection(engine) -> AsyncIterator:
+    """`engine.connect()` that records the pool wait of its checkout"""
+    started = time.perf_counter()
+    async with engine.connect() as connection:
+        await record_checkout(connection, started)
+        yield connection
+
+
+def pool_status(engine) -> Dict[str, int]:
+    pool = engine.sync_engine.pool if hasattr(engine, "sync_engine") else engine.pool
+    status = {}
+    for name in ("size", "checkedout", "overflow", "checkedin"):
+        method = getattr(pool, name, None)
+        if callable(method):
+            status[name] = method()
+    return status
+
+
+def _collect_pool() -> None:
+    if _instrumented_engine is None:
+        return
+    status = pool_status(_instrumented_engine)
+    if "checkedout" in status:
+        DB_POOL_CONNECTIONS.set(status["checkedout"], state="in_use")
+    if "checkedin" in status:
+        DB_POOL_CONNECTIONS.set(status["checkedin"], state="idle")
+    if "overflow" in status:
+        # Negative while the pool has not yet opened pool_size connections
+        DB_POOL_CONNECTIONS.set(max(0, status["overflow"]), state="overflow")
+    if "size" in status:
+        DB_POOL_CONNECTIONS.set(status["size"], state="size")
+    DB_POOL_CHECKOUT_WAIT_P99.set(DB_POOL_WAIT.percentile(0.99))
+
+
+REGISTRY.on_collect(_collect_pool)
+
+
+def rss_bytes() -> int:
+    """Resident set size of this process"""
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def runtime_snapshot(engine=None) -> Dict:
+    snapshot = {
+        "pid": os.getpid(),
+        "rss_bytes": rss_bytes(),
+        "event_loop_lag": EVENT_LOOP_LAG.lag.summary(),
+        "blocking_calls": BLOCKING_CALLS.summary(),
+        "db_pool_wait": DB_POOL_WAIT.summary(),
+    }
+    if engine is not None:
+        snapshot["db_pool"] = pool_status(engine)
+    return snapshot
@@ -0,0 +1,215 @@
+"""
+OpenTelemetry tracing: one trace per user message.
+
+`on_message` opens the root `chat.message` span; the quota check, regeneration,
+retrieval, generation, file parsing, data layer queries and step writes, and
+Stripe SDK calls become its children because the span context travels in
+context variables (including into the tasks Chainlit spawns to persist steps).
+Stripe webhooks get their own `stripe.webhook` trace covering the handlers.
+
+TRACING_EXPORTER selects where spans go:
+
+    none     tracing off (the API's no-op tracer), the default
+    memory   kept in `MEMORY_EXPORTER`, for tests and local inspection
+    file     one JSON span per line in TRACING_FILE, no collector needed
+    console  printed to stdout
+    otlp     OTLP/HTTP to OTEL_EXPORTER_OTLP_ENDPOINT
+
+The SDK ships with Chainlit's dependencies; without it every helper here is a
+no-op.
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+logger = logging.getLogger("swedish_law_chat")
+
+TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER", "none").lower()
+TRACING_FILE = os.environ.get("TRACING_FILE", "traces.jsonl")
+TRACING_SERVICE_NAME = os.environ.get("TRACING_SERVICE_NAME", "swedish-law-chat")
+
+try:
+    from opentelemetry import trace
+    from opentelemetry.trace import Status, StatusCode
+except ImportError:  # pragma: no cover - tracing is optional
+    trace = None
+
+try:
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import (
+        BatchSpanProcessor,
+        ConsoleSpanExporter,
+        SimpleSpanProcessor,
+        SpanExporter,
+        SpanExportResult,
+    )
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+except ImportError:  # pragma: no cover - tracing is optional
+    TracerProvider = None
+    SpanExporter = object
+
+MEMORY_EXPORTER = InMemorySpanExporter() if TracerProvider is not None else None
+
+_setup_lock = threading.Lock()
+_provider = None
+
+
+class FileSpanExporter(SpanExporter):
+    """Append finished spans to a file as JSON lines (an offline stand-in for a collector)"""
+
+    def __init__(self, path: str = TRACING_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans) -> "SpanExportResult":
+        lines = [json.dumps(json.loads(span.to_json()), separators=(",", ":")) for span in spans]
+        try:
+            with self._lock, open(self.path, "a") as f:
+                f.write("\n".join(lines) + "\n")
+        except OSError as e:
+            logger.error(f"Could not write spans to {self.path}: {e}")
+            return SpanExportResult.FAILURE
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self) -> None:
+        pass
+
+
+def _create_exporter(kind: str):
+    if kind == "memory":
+        return MEMORY_EXPORTER
+    if kind == "file":
+        return FileSpanExporter(TRACING_FILE)
+    if kind == "console":
+        return ConsoleSpanExporter()
+    if kind == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        return OTLPSpanExporter()
+    raise ValueError(f"Unknown TRACING_EXPORTER: {kind}")
+
+
+def setup_tracing(exporter: Optional[str] = None) -> bool:
+    """Install the global tracer provider once; returns whether spans are recorded"""
+    global _provider
+    kind = (exporter or TRACING_EXPORTER).lower()
+    if kind == "none" or trace is None or TracerProvider is None:
+        return False
+    with _setup_lock:
+        if _provider is not None:
+            return True
+        try:
+            span_exporter = _create_exporter(kind)
+        except Exception as e:
+            logger.error(f"Tracing disabled, could not create the {kind} exporter: {e}")
+            return False
+        provider = TracerProvider(resource=Resource.create({"service.name": TRACING_SERVICE_NAME}))
+        # In-memory spans must be visible as soon as they end; the rest are batched
+        processor = SimpleSpanProcessor if kind == "memory" else BatchSpanProcessor
+        provider.add_span_processor(processor(span_exporter))
+        trace.set_tracer_provider(provider)
+        _provider = provider
+        logger.info(f"Tracing enabled with the {kind} exporter")
+        return True
+
+
+def shutdown_tracing() -> None:
+    """Flush pending spans"""
+    if _provider is not None:
+        _provider.shutdown()
+
+
+def get_tracer():
+    return trace.get_tracer("swedish_law_chat") if trace is not None else None
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Any]:
+    """Run the block in a child span of the current one; exceptions are recorded on it"""
+    tracer = get_tracer()
+    if tracer is None:
+        yield None
+        return
+    clean = {key: value for key, value in attributes.items() if value is not None}
+    with tracer.start_as_current_span(name, attributes=clean, record_exception=False) as current:
+        try:
+            yield current
+        except BaseException as e:
+            # Cancellation (stop button, disconnect) is not an error
+            if not isinstance(e, GeneratorExit) and type(e).__name__ != "CancelledError":
+                current.record_exception(e)
+                current.set_status(Status(StatusCode.ERROR, str(e)))
+            else:
+                current.set_attribute("cancelled", True)
+            raise
+
+
+def traced(name: str, **attributes: Any) -> Callable:
+    """Decorator form of `span` for async functions"""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name, **attributes):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def set_attributes(**attributes: Any) -> None:
+    """Attach attributes to the span that is current right now"""
+    if trace is None:
+        return
+    current = trace.get_current_span()
+    for key, value in attributes.items():
+        if value is not None:
+            current.set_attribute(key, value)
+
+
+STRIPE_CALLS = [
+    ("Customer", "create"),
+    ("Customer", "retrieve"),
+    ("Subscription", "retrieve"),
+    ("Subscription", "modify"),
+    ("Subscription", "delete"),
+    ("Price", "retrieve"),
+    ("Product", "retrieve"),
+    ("Coupon", "create"),
+    ("InvoiceItem", "create"),
+    ("checkout.Session", "create"),
+    ("billing_portal.Session", "create"),
+]
+
+
+def instrument_stripe() -> None:
+    """Wrap the Stripe SDK class methods the app calls in `stripe.<Resource>.<method>` spans"""
+    import stripe
+
+    if getattr(stripe, "_law_traced", False):
+        return
+    for resource_path, method_name in STRIPE_CALLS:
+        resource = stripe
+        for part in resource_path.split("."):
+            resource = getattr(resource, part, None)
+        original = getattr(resource, method_name, None) if resource is not None else None
+        if original is None:
+            continue
+
+        def make_wrapper(call, span_name):
+            @functools.wraps(call)
+            def wrapper(*args, **kwargs):
+                with span(span_name, **{"rpc.system": "stripe"}):
+                    return call(*args, **kwargs)
+
+            return staticmethod(wrapper)
+
+        setattr(resource, method_name, make_wrapper(original, f"stripe.{resource_path}.{method_name}"))
+    stripe._law_traced = True
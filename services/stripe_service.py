@@ -15,8 +15,11 @@ from datetime import datetime
 from fastapi import HTTPException
 from chainlit.logger import logger
 
+from observability.tracing import instrument_stripe, set_attributes, traced
+
 # Initialize Stripe with secret key
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+instrument_stripe()
 
 class StripeService:
     def __init__(self, data_layer):
@@ -442,11 +445,13 @@ class StripeService:
             logger.error(f"Error getting billing history for user {user_id}: {e}")
             raise HTTPException(status_code=500, detail="Failed to get billing history")
 
+    @traced("stripe.handle_webhook_event")
     async def handle_webhook_event(self, event_data: Dict) -> bool:
         """Process Stripe webhook events"""
         try:
             event_type = event_data.get("type")
             event_id = event_data.get("id")
+            set_attributes(**{"stripe.event_type": event_type, "stripe.event_id": event_id})
             
             # Store event for debugging - convert to JSON string for database storage
             import json
@@ -475,6 +480,7 @@ class StripeService:
             logger.error(f"Error handling webhook event {event_data.get('id')}: {e}")
             return False
 
+    @traced("stripe.webhook_customer_created")
     async def _handle_customer_created(self, event_data: Dict):
         """Handle customer.created webhook"""
         try:
@@ -495,6 +501,7 @@ class StripeService:
             logger.error(f"Error handling customer.created event: {e}")
             raise
 
+    @traced("stripe.webhook_subscription_created")
     async def _handle_subscription_created(self, event_data: Dict):
         """Handle subscription.created webhook"""
         try:
@@ -565,6 +572,7 @@ class StripeService:
             logger.error(f"Error in _handle_subscription_created: {e}")
             raise
 
+    @traced("stripe.webhook_subscription_updated")
     async def _handle_subscription_updated(self, event_data: Dict):
         """Handle subscription.updated webhook"""
         try:
@@ -625,6 +633,7 @@ class StripeService:
             logger.error(f"Error in _handle_subscription_updated: {e}")
             raise
 
+    @traced("stripe.webhook_subscription_deleted")
     async def _handle_subscription_deleted(self, event_data: Dict):
         """Handle subscription.deleted webhook"""
         try:
@@ -643,6 +652,7 @@ class StripeService:
             logger.error(f"Error in _handle_subscription_deleted: {e}")
             raise
 
+    @traced("stripe.webhook_invoice_payment_succeeded")
     async def _handle_invoice_payment_succeeded(self, event_data: Dict):
         """Handle invoice.payment_succeeded webhook"""
         invoice = event_data["data"]["object"]
@@ -661,6 +671,7 @@ class StripeService:
         
         logger.info(f"Processed successful payment for invoice {invoice['id']}")
 
+    @traced("stripe.webhook_invoice_payment_failed")
     async def _handle_invoice_payment_failed(self, event_data: Dict):
         """Handle invoice.payment_failed webhook"""
         invoice = event_data["data"]["object"]
@@ -0,0 +1,206 @@
+"""
+Write-behind buffer for free-plan message counters.
+
+Instead of one `UPDATE users ... RETURNING` per answered message, reservations
+and refunds are aggregated per identifier in memory and written in one batched
+`UPDATE ... FROM (VALUES ...)` every USAGE_FLUSH_INTERVAL seconds, as soon as
+USAGE_MAX_PENDING messages are buffered, and when the data layer closes.
+
+Limit checks stay correct within the process: the buffer keeps the last count
+read from (or returned by) Postgres per identifier and adds the pending and
+in-flight deltas to it. The base count is re-read after USAGE_COUNT_TTL so
+resets and other workers' flushes are picked up.
+
+Crash-loss bound: a crash loses at most USAGE_MAX_PENDING buffered messages,
+at most USAGE_FLUSH_INTERVAL seconds of them, and always in the user's favour.
+"""
+
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from chainlit.logger import logger
+
+from observability.metrics import REGISTRY
+
+USAGE_WRITE_BEHIND = os.environ.get("USAGE_WRITE_BEHIND", "false").lower() == "true"
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", "5"))
+USAGE_MAX_PENDING = int(os.environ.get("USAGE_MAX_PENDING", "500"))
+USAGE_COUNT_TTL = float(os.environ.get("USAGE_COUNT_TTL", "30"))
+USAGE_FLUSH_BATCH = 500
+
+USAGE_FLUSHES = REGISTRY.counter("law_usage_flushes_total", "Usage counter flushes by result", ["result"])
+USAGE_FLUSHED_MESSAGES = REGISTRY.counter(
+    "law_usage_flushed_messages_total", "Message count changes (reservations and refunds) written by flushes"
+)
+USAGE_FLUSH_SECONDS = REGISTRY.histogram(
+    "law_usage_flush_duration_seconds",
+    "Duration of a usage counter flush",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+USAGE_PENDING = REGISTRY.gauge(
+    "law_usage_pending_messages", "Buffered message count changes not yet in Postgres (the crash-loss exposure)"
+)
+
+
+class UsageCounterBuffer:
+    """Per-process message counter buffer in front of users.message_count"""
+
+    def __init__(
+        self,
+        data_layer,
+        flush_interval: float = USAGE_FLUSH_INTERVAL,
+        max_pending: int = USAGE_MAX_PENDING,
+        count_ttl: float = USAGE_COUNT_TTL,
+    ):
+        self.data_layer = data_layer
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.count_ttl = count_ttl
+        # identifier -> (count in Postgres, when it was read)
+        self._base: Dict[str, Tuple[int, float]] = {}
+        self._pending: Dict[str, int] = {}
+        self._inflight: Dict[str, int] = {}
+        # Bumped whenever a flush writes, so a read racing a flush is not cached
+        self._epoch = 0
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self.last_flush_at: Optional[float] = None
+        REGISTRY.on_collect(lambda: USAGE_PENDING.set(self.pending_messages))
+
+    @property
+    def pending_messages(self) -> int:
+        return sum(abs(d) for d in self._pending.values()) + sum(abs(d) for d in self._inflight.values())
+
+    def _unflushed(self, identifier: str) -> int:
+        return self._pending.get(identifier, 0) + self._inflight.get(identifier, 0)
+
+    async def current_count(self, identifier: str) -> int:
+        """Postgres count plus the buffered changes of this process"""
+        cached = self._base.get(identifier)
+        if cached is None or time.monotonic() - cached[1] > self.count_ttl:
+            epoch = self._epoch
+            count = await self.data_layer.read_user_message_count(identifier)
+            if epoch == self._epoch and identifier not in self._inflight:
+                self._base[identifier] = (count, time.monotonic())
+            elif cached is None:
+                # A flush raced the read; fall back to what was read
+                return max(0, count + self._unflushed(identifier))
+        return max(0, self._base[identifier][0] + self._unflushed(identifier))
+
+    async def reserve(self, identifier: str, limit: int) -> Tuple[bool, int]:
+        """Consume one message if the user is under the limit; returns (reserved, count)"""
+        # No await between reading the count and adding to it, so concurrent
+        # reservations of one user cannot both pass the limit
+        count = await self.current_count(identifier)
+        if count >= limit:
+            return False, count
+        self.add(identifier, 1)
+        return True, count + 1
+
+    def add(self, identifier: str, delta: int) -> None:
+        self._pending[identifier] = self._pending.get(identifier, 0) + delta
+        if self._pending[identifier] == 0:
+            del self._pending[identifier]
+        self._ensure_started()
+        flushing = self._flush_lock is not None and self._flush_lock.locked()
+        if self.pending_messages >= self.max_pending and not flushing:
+            asyncio.get_running_loop().create_task(self.flush())
+
+    def refund(self, identifier: str) -> None:
+        self.add(identifier, -1)
+
+    def forget(self, identifier: str) -> None:
+        """Drop the buffered state of a user whose count was rewritten directly (reset)"""
+        self._pending.pop(identifier, None)
+        self._base.pop(identifier, None)
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> int:
+        """Write all pending deltas; returns how many users were updated"""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            self._inflight, self._pending = self._pending, {}
+            self._epoch += 1
+            start = time.perf_counter()
+            updated = 0
+            items = list(self._inflight.items())
+            try:
+                for offset in range(0, len(items), USAGE_FLUSH_BATCH):
+                    batch = items[offset:offset + USAGE_FLUSH_BATCH]
+                    rows = await self._write(batch)
+                    if rows is None:
+                        raise RuntimeError("usage counter flush query failed")
+                    now = time.monotonic()
+                    for row in rows:
+                        self._base[row["identifier"]] = (row["message_count"] or 0, now)
+                    for identifier, delta in batch:
+                        self._inflight.pop(identifier, None)
+                        USAGE_FLUSHED_MESSAGES.inc(abs(delta))
+                    updated += len(rows)
+                USAGE_FLUSHES.inc(result="success")
+                self.last_flush_at = time.time()
+            except Exception as e:
+                USAGE_FLUSHES.inc(result="error")
+                logger.error(f"Usage counter flush failed, keeping {len(self._inflight)} users buffered: {e}")
+                for identifier, delta in self._inflight.items():
+                    self._pending[identifier] = self._pending.get(identifier, 0) + delta
+                self._inflight = {}
+            finally:
+                self._epoch += 1
+                USAGE_FLUSH_SECONDS.observe(time.perf_counter() - start)
+            return updated
+
+    async def _write(self, batch: List[Tuple[str, int]]) -> Optional[List[Dict]]:
+        values = ", ".join(
+            f"(CAST(:identifier_{i} AS TEXT), CAST(:delta_{i} AS INTEGER))" for i in range(len(batch))
+        )
+        query = f"""
+            UPDATE users AS u
+            SET "message_count" = GREATEST(COALESCE(u."message_count", 0) + v.delta, 0)
+            FROM (VALUES {values}) AS v(identifier, delta)
+            WHERE u."identifier" = v.identifier
+            RETURNING u."identifier", u."message_count"
+        """
+        parameters = {}
+        for i, (identifier, delta) in enumerate(batch):
+            parameters[f"identifier_{i}"] = identifier
+            parameters[f"delta_{i}"] = delta
+        result = await self.data_layer.execute_sql(query, parameters)
+        if isinstance(result, list):
+            return result
+        # A rowcount means no row matched (users deleted); nothing left to write
+        return [] if isinstance(result, int) else None
+
+    async def close(self) -> None:
+        """Stop the periodic flush and write what is still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    @property
+    def stats(self) -> Dict:
+        return {
+            "flush_interval_s": self.flush_interval,
+            "max_pending": self.max_pending,
+            "pending_messages": self.pending_messages,
+            "pending_users": len(self._pending),
+            "last_flush_at": self.last_flush_at,
+        }
@@ -0,0 +1,95 @@
+"""
+Bounded TTL cache of PersistedUser, keyed by identifier.
+
+Chainlit's auth dependency loads the user on every request to the main.py
+routes and callbacks load it again on login; with the cache most of those
+`SELECT * FROM users` round trips (and the metadata JSON parsing) go away.
+The data layer invalidates an entry whenever it writes that user. Writes made
+by another worker become visible here after at most USER_CACHE_TTL seconds.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from dataclasses import replace
+from typing import Dict, Optional, Tuple
+
+from chainlit.user import PersistedUser
+
+from observability.metrics import REGISTRY
+
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+
+USER_CACHE_REQUESTS = REGISTRY.counter("law_user_cache_requests_total", "User cache lookups by result", ["result"])
+USER_CACHE_ENTRIES = REGISTRY.gauge("law_user_cache_entries", "Users currently cached")
+USER_CACHE_HIT_RATIO = REGISTRY.gauge("law_user_cache_hit_ratio", "Share of user lookups served from the cache")
+
+
+class UserCache:
+    """LRU-bounded identifier -> PersistedUser cache whose entries expire after a TTL"""
+
+    def __init__(self, ttl: float = USER_CACHE_TTL, max_size: int = USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[PersistedUser, float]]" = OrderedDict()
+        # id -> identifier, for writes that only know the user's id
+        self._identifiers: Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+        # Bumped on every invalidation so a read that raced a write is not cached
+        self.generation = 0
+        REGISTRY.on_collect(self._collect)
+
+    def get(self, identifier: str) -> Optional[PersistedUser]:
+        entry = self._entries.get(identifier)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            if entry is not None:
+                self._drop(identifier)
+            self.misses += 1
+            USER_CACHE_REQUESTS.inc(result="miss")
+            return None
+        self._entries.move_to_end(identifier)
+        self.hits += 1
+        USER_CACHE_REQUESTS.inc(result="hit")
+        # Callers may edit metadata; keep the cached copy intact
+        return replace(entry[0], metadata=dict(entry[0].metadata or {}))
+
+    def put(self, user: PersistedUser, generation: Optional[int] = None) -> None:
+        if generation is not None and generation != self.generation:
+            return
+        self._entries[user.identifier] = (replace(user, metadata=dict(user.metadata or {})), time.monotonic())
+        self._entries.move_to_end(user.identifier)
+        self._identifiers[user.id] = user.identifier
+        while len(self._entries) > self.max_size:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self._identifiers.pop(evicted.id, None)
+
+    def invalidate(self, identifier: str) -> None:
+        self._drop(identifier)
+
+    def invalidate_id(self, user_id: str) -> None:
+        identifier = self._identifiers.get(user_id)
+        if identifier is not None:
+            self._drop(identifier)
+
+    def _drop(self, identifier: str) -> None:
+        self.generation += 1
+        entry = self._entries.pop(identifier, None)
+        if entry is not None:
+            self._identifiers.pop(entry[0].id, None)
+
+    def _collect(self) -> None:
+        USER_CACHE_ENTRIES.set(len(self._entries))
+        lookups = self.hits + self.misses
+        USER_CACHE_HIT_RATIO.set(self.hits / lookups if lookups else 0.0)
+
+    @property
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -1,15 +1,543 @@
 from chainlit.data.sql_alchemy import SQLAlchemyDataLayer as ChainlitSQLAlchemyDataLayer
-from typing import Dict, List, Optional, Any
+from chainlit.element import ElementDict
+from chainlit.logger import logger
+from chainlit.step import StepDict
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from typing import Dict, List, Optional, Any, Set, Tuple
+import asyncio
 import uuid
 from datetime import datetime
 import bcrypt
 import os
 import re
-from chainlit.user import User
+import time
+from chainlit.types import FeedbackDict, PageInfo, PaginatedResponse, Pagination, ThreadDict, ThreadFilter
+from chainlit.user import PersistedUser, User
+
+from observability.metrics import DB_QUERY_SECONDS, sql_operation
+from observability.runtime import instrument_pool, record_checkout
+from observability.tracing import span
+from services.usage_buffer import USAGE_WRITE_BEHIND, UsageCounterBuffer
+from services.user_cache import USER_CACHE_TTL, UserCache
+
+# Connection pool, per worker process. Size it so that
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) stays below Postgres max_connections.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "-1"))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "false").lower() == "true"
+# "fulltext" is used once migrations/add_thread_search.sql has added
+# steps.search_vector; "substring" (and the fallback until then) is the ILIKE scan
+THREAD_SEARCH_MODE = os.environ.get("THREAD_SEARCH_MODE", "fulltext")
+# Element URLs returned by get_thread: "lazy" points them at ELEMENT_READ_ROUTE,
+# which presigns one element when the browser asks for it; "eager" presigns
+# every element of the thread while it loads
+ELEMENT_URL_MODE = os.environ.get("ELEMENT_URL_MODE", "lazy")
+ELEMENT_READ_ROUTE = "/chat/api/elements"
+# asyncpg statement caches; set both to 0 behind PgBouncer in transaction mode
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_PREPARED_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_PREPARED_STATEMENT_CACHE_SIZE", "100"))
+
+
+def engine_options(conninfo: str) -> Dict[str, Any]:
+    """Pool settings for create_async_engine, plus asyncpg's statement caches"""
+    options: Dict[str, Any] = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    connect_args: Dict[str, Any] = {}
+    if "+asyncpg" in conninfo:
+        connect_args["statement_cache_size"] = DB_STATEMENT_CACHE_SIZE
+        connect_args["prepared_statement_cache_size"] = DB_PREPARED_STATEMENT_CACHE_SIZE
+    return {"connect_args": connect_args, **options}
 
 
 class CustomSQLAlchemyDataLayer(ChainlitSQLAlchemyDataLayer):
+
+    def __init__(self, conninfo: str, connect_args: Optional[Dict[str, Any]] = None, *args, **kwargs):
+        options = engine_options(conninfo)
+        connect_args = {**options.pop("connect_args"), **(connect_args or {})}
+        # Chainlit adds its SSL context to connect_args in place
+        super().__init__(conninfo, connect_args, *args, **kwargs)
+        # Chainlit creates the engine with default pool settings; it has not
+        # connected yet, so replace it with the configured one
+        self.engine = create_async_engine(self._conninfo, connect_args=connect_args, **options)
+        self.async_session = sessionmaker(bind=self.engine, expire_on_commit=False, class_=AsyncSession)
+        # Time new connections; execute_sql records the checkout wait
+        instrument_pool(self.engine)
+        # Message counters are buffered in memory and flushed in batches when enabled
+        self.usage_buffer = UsageCounterBuffer(self) if USAGE_WRITE_BEHIND else None
+        # USER_CACHE_TTL=0 turns the user cache off
+        self.user_cache = UserCache() if USER_CACHE_TTL > 0 else None
+        # Optional migrated columns present in the database, read by detect_schema
+        self.schema_columns: Optional[Set[Tuple[str, str]]] = None
+
+    async def close(self) -> None:
+        if self.usage_buffer is not None:
+            await self.usage_buffer.close()
+        await super().close()
+
+    async def execute_sql(self, query: str, parameters: dict):
+        """
+        Chainlit's execute_sql, timed and traced per SQL operation. The connection
+        is checked out first so its pool wait is recorded on its own.
+        """
+        operation = sql_operation(query)
+        with span("db.query", **{"db.system": "postgresql", "db.operation": operation}):
+            with DB_QUERY_SECONDS.time(operation=operation):
+                async with self.async_session() as session:
+                    try:
+                        started = time.perf_counter()
+                        # Begins the session's transaction on the checked out connection
+                        await record_checkout(await session.connection(), started)
+                        result = await session.execute(text(query), parameters)
+                        await session.commit()
+                        if result.returns_rows:
+                            return self.clean_result([dict(row._mapping) for row in result.fetchall()])
+                        return result.rowcount
+                    except SQLAlchemyError as e:
+                        await session.rollback()
+                        logger.warning(f"An error occurred: {e}")
+                        return None
+                    except Exception as e:
+                        await session.rollback()
+                        logger.warning(f"An unexpected error occurred: {e}")
+                        return None
+
+    async def get_user(self, identifier: str):
+        """Chainlit's get_user behind the PersistedUser cache"""
+        if self.user_cache is None:
+            return await super().get_user(identifier)
+        cached = self.user_cache.get(identifier)
+        if cached is not None:
+            return cached
+        generation = self.user_cache.generation
+        user = await super().get_user(identifier)
+        if user is not None:
+            self.user_cache.put(user, generation)
+        return user
+
+    def _invalidate_user(self, identifier: Optional[str] = None, user_id: Optional[str] = None) -> None:
+        if self.user_cache is None:
+            return
+        if identifier is not None:
+            self.user_cache.invalidate(identifier)
+        if user_id is not None:
+            self.user_cache.invalidate_id(user_id)
+
+    # ========== Step Persistence (traced) ==========
+
+    async def create_step(self, step_dict):
+        with span("persist.create_step", **{"step.type": step_dict.get("type")}):
+            return await super().create_step(step_dict)
+
+    async def update_step(self, step_dict):
+        with span("persist.update_step", **{"step.type": step_dict.get("type")}):
+            return await super().update_step(step_dict)
+
+    async def update_thread(self, thread_id: str, *args, **kwargs):
+        with span("persist.update_thread"):
+            return await super().update_thread(thread_id, *args, **kwargs)
     
+    # ========== Schema Detection ==========
+
+    async def detect_schema(self) -> bool:
+        """
+        Record which optional migrations the database has. Without
+        migrations/add_thread_updated_at.sql threads are listed by "createdAt",
+        and without migrations/add_thread_search.sql searches are substring scans.
+        Returns False when the schema could not be read; the next thread listing
+        tries again.
+        """
+        rows = await self.execute_sql(
+            """
+            SELECT table_name, column_name FROM information_schema.columns
+            WHERE table_schema = current_schema()
+            AND (table_name, column_name) IN (('threads', 'updatedAt'), ('steps', 'search_vector'))
+            """,
+            {},
+        )
+        if not isinstance(rows, list):
+            logger.error("Could not read the database schema; optional migrations are not detected yet")
+            return False
+        self.schema_columns = {(row["table_name"], row["column_name"]) for row in rows}
+        if not self.has_column("threads", "updatedAt"):
+            logger.warning(
+                'threads."updatedAt" is missing, listing threads by "createdAt"; '
+                "run migrations/add_thread_updated_at.sql to sort them by latest activity"
+            )
+        if THREAD_SEARCH_MODE == "fulltext" and not self.has_column("steps", "search_vector"):
+            logger.warning(
+                "steps.search_vector is missing, searching threads by substring; "
+                "run migrations/add_thread_search.sql for full-text search"
+            )
+        return True
+
+    @property
+    def thread_search_mode(self) -> str:
+        """THREAD_SEARCH_MODE, or "substring" while full-text search is not migrated"""
+        if THREAD_SEARCH_MODE == "fulltext" and self.has_column("steps", "search_vector"):
+            return "fulltext"
+        return "substring"
+
+    def has_column(self, table: str, column: str) -> bool:
+        return (table, column) in (self.schema_columns or set())
+
+    # ========== Thread Listing ==========
+
+    async def list_threads(self, pagination: Pagination, filters: ThreadFilter) -> PaginatedResponse:
+        """
+        Sidebar listing, paginated and filtered in SQL.
+        Threads are ordered by the denormalized (updatedAt, id) descending, or by
+        (createdAt, id) before that migration, and the cursor (the last thread id
+        of the previous page) is resolved to its sort key, so each page is a
+        keyset range instead of a scan over every thread the user has.
+        Only thread-level columns are fetched; steps and elements are left empty.
+        Searches are ranked full-text matches (see search_threads) once that
+        migration is applied, substring matches before.
+        """
+        if not filters.userId:
+            raise ValueError("userId is required")
+        if self.schema_columns is None:
+            await self.detect_schema()
+        
+        if filters.search and self.thread_search_mode == "fulltext":
+            rows = await self.search_threads(
+                filters.userId,
+                filters.search,
+                limit=pagination.first + 1,
+                cursor=pagination.cursor,
+                feedback=filters.feedback,
+            )
+        else:
+            rows = await self._list_thread_rows(pagination, filters)
+        
+        has_next_page = len(rows) > pagination.first
+        threads = [self._thread_from_row(row) for row in rows[: pagination.first]]
+        return PaginatedResponse(
+            pageInfo=PageInfo(
+                hasNextPage=has_next_page,
+                startCursor=threads[0]["id"] if threads else None,
+                endCursor=threads[-1]["id"] if threads else None,
+            ),
+            data=threads,
+        )
+
+    async def _list_thread_rows(self, pagination: Pagination, filters: ThreadFilter) -> List[Dict[str, Any]]:
+        # threads."updatedAt" is kept current by a trigger on steps
+        # (migrations/add_thread_updated_at.sql), so this is a range scan of
+        # the ("userId", "updatedAt", "id") index; unmigrated databases are
+        # listed by creation time
+        if self.has_column("threads", "updatedAt"):
+            sort_key = '{0}."updatedAt"'
+        else:
+            sort_key = "COALESCE({0}.\"createdAt\", '')"
+        conditions = ['t."userId" = :user_id']
+        parameters: Dict[str, Any] = {"user_id": filters.userId, "limit": pagination.first + 1}
+        if pagination.cursor:
+            conditions.append(f"""
+                ({sort_key.format("t")}, t."id") < (
+                    SELECT {sort_key.format("c")}, c."id" FROM threads c WHERE c."id" = CAST(:cursor AS UUID)
+                )""")
+            parameters["cursor"] = pagination.cursor
+        if filters.feedback is not None:
+            conditions.append("""
+                EXISTS (
+                    SELECT 1 FROM feedbacks f WHERE f."threadId" = t."id" AND f."value" = :feedback
+                )""")
+            parameters["feedback"] = int(filters.feedback)
+        if filters.search:
+            conditions.append("""
+                EXISTS (
+                    SELECT 1 FROM steps s WHERE s."threadId" = t."id" AND s."output" ILIKE :search
+                )""")
+            escaped = filters.search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            parameters["search"] = f"%{escaped}%"
+        
+        query = f"""
+            SELECT
+                t."id",
+                t."createdAt",
+                t."name",
+                t."userId",
+                t."userIdentifier",
+                t."tags",
+                t."metadata"
+            FROM threads t
+            WHERE {" AND ".join(conditions)}
+            ORDER BY {sort_key.format("t")} DESC, t."id" DESC
+            LIMIT :limit
+        """
+        rows = await self.execute_sql(query, parameters)
+        return rows if isinstance(rows, list) else []
+
+    async def search_threads(
+        self,
+        user_id: str,
+        search: str,
+        limit: int = 20,
+        cursor: Optional[str] = None,
+        feedback: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Full-text search over a user's threads through the GIN index on
+        steps.search_vector. Returns thread rows ranked by their best matching
+        step, each with a highlighted `snippet`; `cursor` (a thread id of the
+        previous page) continues after that thread's (rank, id).
+        """
+        conditions = []
+        parameters: Dict[str, Any] = {"user_id": user_id, "search": search, "limit": limit}
+        if cursor:
+            conditions.append("""
+                (m."rank", m."id") < (
+                    SELECT c."rank", c."id" FROM matches c WHERE c."id" = CAST(:cursor AS UUID)
+                )""")
+            parameters["cursor"] = cursor
+        if feedback is not None:
+            conditions.append("""
+                EXISTS (
+                    SELECT 1 FROM feedbacks f WHERE f."threadId" = m."id" AND f."value" = :feedback
+                )""")
+            parameters["feedback"] = int(feedback)
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        
+        query = f"""
+            WITH search AS (
+                SELECT websearch_to_tsquery('english', :search) AS q
+            ),
+            matches AS (
+                SELECT s."threadId" AS "id", MAX(ts_rank(s."search_vector", search.q)) AS "rank"
+                FROM steps s
+                JOIN threads t ON t."id" = s."threadId"
+                CROSS JOIN search
+                WHERE s."search_vector" @@ search.q AND t."userId" = :user_id
+                GROUP BY s."threadId"
+            ),
+            page AS (
+                SELECT
+                    t."id",
+                    t."createdAt",
+                    t."name",
+                    t."userId",
+                    t."userIdentifier",
+                    t."tags",
+                    t."metadata",
+                    m."rank"
+                FROM matches m
+                JOIN threads t ON t."id" = m."id"
+                {where}
+                ORDER BY m."rank" DESC, m."id" DESC
+                LIMIT :limit
+            )
+            SELECT page.*, best."snippet"
+            FROM page
+            LEFT JOIN LATERAL (
+                SELECT ts_headline(
+                    'english', coalesce(s."output", s."input", ''), search.q,
+                    'MaxFragments=1, MinWords=5, MaxWords=20, StartSel=<mark>, StopSel=</mark>'
+                ) AS "snippet"
+                FROM steps s
+                CROSS JOIN search
+                WHERE s."threadId" = page."id" AND s."search_vector" @@ search.q
+                ORDER BY ts_rank(s."search_vector", search.q) DESC
+                LIMIT 1
+            ) best ON TRUE
+            ORDER BY page."rank" DESC, page."id" DESC
+        """
+        rows = await self.execute_sql(query, parameters)
+        return rows if isinstance(rows, list) else []
+
+    def _thread_from_row(self, row: Dict[str, Any]) -> ThreadDict:
+        import json
+        metadata = row.get("metadata")
+        if isinstance(metadata, str):
+            metadata = json.loads(metadata)
+        thread = ThreadDict(
+            id=str(row["id"]),
+            createdAt=row["createdAt"],
+            name=row["name"],
+            userId=str(row["userId"]) if row.get("userId") else None,
+            userIdentifier=row["userIdentifier"],
+            tags=row["tags"],
+            metadata=metadata,
+            steps=[],
+            elements=[],
+        )
+        if row.get("snippet"):
+            # Highlighted match for search results
+            thread["snippet"] = row["snippet"]
+        return thread
+
+    # ========== Thread Loading ==========
+
+    async def get_thread(self, thread_id: str) -> Optional[ThreadDict]:
+        """
+        Load one thread for resume and authorization checks.
+        The thread and its elements come from a primary key lookup, its steps and
+        their feedback from the steps ("threadId", "createdAt") index. Chainlit's
+        version goes through get_all_user_threads, whose `userId = ... OR id = ...`
+        aggregation walks every thread of the user.
+        """
+        import json
+        with span("persist.get_thread"):
+            thread_query = """
+                SELECT
+                    t."id",
+                    t."createdAt",
+                    t."name",
+                    t."userId",
+                    t."userIdentifier",
+                    t."tags",
+                    t."metadata",
+                    (
+                        SELECT COALESCE(json_agg(e), '[]')
+                        FROM elements e
+                        WHERE e."threadId" = t."id"
+                    ) AS "elements"
+                FROM threads t
+                WHERE t."id" = CAST(:thread_id AS UUID)
+            """
+            rows = await self.execute_sql(thread_query, {"thread_id": thread_id})
+            if not isinstance(rows, list) or not rows:
+                return None
+            thread = self._thread_from_row(rows[0])
+            
+            steps_query = """
+                SELECT
+                    s."id",
+                    s."name",
+                    s."type",
+                    s."threadId",
+                    s."parentId",
+                    s."streaming",
+                    s."waitForAnswer",
+                    s."isError",
+                    s."metadata",
+                    s."tags",
+                    s."input",
+                    s."output",
+                    s."createdAt",
+                    s."start",
+                    s."end",
+                    s."generation",
+                    s."showInput",
+                    s."language",
+                    f."id" AS "feedbackId",
+                    f."value" AS "feedbackValue",
+                    f."comment" AS "feedbackComment"
+                FROM steps s
+                LEFT JOIN feedbacks f ON f."forId" = s."id"
+                WHERE s."threadId" = CAST(:thread_id AS UUID)
+                ORDER BY s."createdAt" ASC
+            """
+            step_rows = await self.execute_sql(steps_query, {"thread_id": thread_id})
+            if isinstance(step_rows, list):
+                thread["steps"] = [self._step_from_row(row) for row in step_rows]
+            
+            elements = rows[0].get("elements") or []
+            if isinstance(elements, str):
+                elements = json.loads(elements)
+            urls = await asyncio.gather(*(self._element_url(thread["id"], element) for element in elements))
+            thread["elements"] = [
+                self._element_from_row(element, url) for element, url in zip(elements, urls)
+            ]
+            return thread
+
+    def _step_from_row(self, row: Dict[str, Any]) -> StepDict:
+        import json
+        metadata = row.get("metadata")
+        if isinstance(metadata, str):
+            metadata = json.loads(metadata)
+        feedback = None
+        if row.get("feedbackValue") is not None:
+            feedback = FeedbackDict(
+                forId=row["id"],
+                id=row.get("feedbackId"),
+                value=row["feedbackValue"],
+                comment=row.get("feedbackComment"),
+            )
+        # Same shape as Chainlit's get_all_user_threads, including hidden inputs
+        return StepDict(
+            id=row["id"],
+            name=row["name"],
+            type=row["type"],
+            threadId=row["threadId"],
+            parentId=row.get("parentId"),
+            streaming=row.get("streaming", False),
+            waitForAnswer=row.get("waitForAnswer"),
+            isError=row.get("isError"),
+            metadata=metadata if metadata is not None else {},
+            tags=row.get("tags"),
+            input=row.get("input", "") if row.get("showInput") not in [None, "false"] else "",
+            output=row.get("output", ""),
+            createdAt=row.get("createdAt"),
+            start=row.get("start"),
+            end=row.get("end"),
+            generation=row.get("generation"),
+            showInput=row.get("showInput"),
+            language=row.get("language"),
+            feedback=feedback,
+        )
+
+    def _element_from_row(self, row: Dict[str, Any], url: Optional[str]) -> ElementDict:
+        import json
+        props = row.get("props")
+        if isinstance(props, str):
+            props = json.loads(props)
+        return ElementDict(
+            id=row["id"],
+            threadId=row.get("threadId"),
+            type=row["type"],
+            chainlitKey=row.get("chainlitKey"),
+            url=url,
+            objectKey=row.get("objectKey"),
+            name=row["name"],
+            display=row["display"],
+            size=row.get("size"),
+            language=row.get("language"),
+            page=row.get("page"),
+            props=props or {},
+            forId=row.get("forId"),
+            mime=row.get("mime"),
+        )
+
+    def _has_object(self, object_key: Optional[str]) -> bool:
+        return self.storage_provider is not None and isinstance(object_key, str) and bool(object_key.strip())
+
+    async def _element_url(self, thread_id: str, element: Dict[str, Any]) -> Optional[str]:
+        if not self._has_object(element.get("objectKey")):
+            return element.get("url")
+        if ELEMENT_URL_MODE == "lazy":
+            return f"{ELEMENT_READ_ROUTE}/{thread_id}/{element['id']}"
+        return await self._presign(element["objectKey"], element.get("url"))
+
+    async def _presign(self, object_key: str, fallback: Optional[str]) -> Optional[str]:
+        try:
+            return await self.storage_provider.get_read_url(object_key=object_key)
+        except Exception as e:
+            logger.warning(f"Failed to get read URL for object_key '{object_key}': {e}. Falling back to stored URL.")
+            return fallback
+
+    async def get_element_read_url(self, thread_id: str, element_id: str) -> Optional[str]:
+        """Presigned URL of one element, for ELEMENT_READ_ROUTE; the stored URL without a storage object"""
+        query = """
+            SELECT "objectKey", "url" FROM elements
+            WHERE "id" = CAST(:element_id AS UUID) AND "threadId" = CAST(:thread_id AS UUID)
+        """
+        rows = await self.execute_sql(query, {"element_id": element_id, "thread_id": thread_id})
+        if not isinstance(rows, list) or not rows:
+            return None
+        if not self._has_object(rows[0]["objectKey"]):
+            return rows[0]["url"]
+        return await self._presign(rows[0]["objectKey"], rows[0]["url"])
+
     # ========== Password Authentication Methods ==========
     
     def _hash_password(self, password: str) -> str:
@@ -116,6 +644,7 @@ class CustomSQLAlchemyDataLayer(ChainlitSQLAlchemyDataLayer):
             user_dict["metadata"] = json.dumps(user_dict["metadata"])
         
         result = await self.execute_sql(query, user_dict)
+        self._invalidate_user(identifier=email)
         if result is not None:
             return {"id": user_dict["id"], "identifier": email}
         return None
@@ -159,7 +688,7 @@ class CustomSQLAlchemyDataLayer(ChainlitSQLAlchemyDataLayer):
             raise ValueError("Invalid role. Must be USER or ADMIN")
         
         # Get current user metadata
-        query = """SELECT "metadata" FROM users WHERE "id" = :user_id"""
+        query = """SELECT "identifier", "metadata" FROM users WHERE "id" = :user_id"""
         result = await self.execute_sql(query, {"user_id": user_id})
         
         if not result or not isinstance(result, list) or len(result) == 0:
@@ -181,6 +710,7 @@ class CustomSQLAlchemyDataLayer(ChainlitSQLAlchemyDataLayer):
             "user_id": user_id,
             "metadata": json.dumps(metadata)
         })
+        self._invalidate_user(identifier=result[0]["identifier"], user_id=user_id)
         
         return update_result is not None
     
@@ -241,64 +771,66 @@ class CustomSQLAlchemyDataLayer(ChainlitSQLAlchemyDataLayer):
         return result if isinstance(result, list) else []
     
     # Override Chainlit's create_user to preserve roles
-    async def create_user(self, user) -> Optional[dict]:
-        """Override Chainlit's create_user to preserve existing user roles"""
+    async def create_user(self, user) -> Optional[PersistedUser]:
+        """
+        Override Chainlit's create_user to preserve existing user roles.
+        One upsert: a new user is inserted; an existing user's metadata is merged
+        with the new metadata, but the role stored in the row always wins.
+        """
         from chainlit.logger import logger
         import json
         
         if self.show_logger:
             logger.info(f"CustomSQLAlchemy: create_user, user_identifier={user.identifier}")
         
-        existing_user = await self.get_user(user.identifier)
-        
-        if not existing_user:  # Create new user
-            if self.show_logger:
-                logger.info("CustomSQLAlchemy: Creating new user")
-            
-            user_dict = {
-                "id": str(uuid.uuid4()),
-                "identifier": str(user.identifier),
-                "metadata": json.dumps(user.metadata) if user.metadata else "{}",
-                "createdAt": datetime.now().isoformat(),
-                "message_count": 0
-            }
-            
-            query = """INSERT INTO users ("id", "identifier", "createdAt", "metadata", "message_count") VALUES (:id, :identifier, :createdAt, :metadata, :message_count)"""
-            await self.execute_sql(query=query, parameters=user_dict)
-            logger.info(f"CustomSQLAlchemy: Created new user {user.identifier} with role {user.metadata.get('role', 'No role') if user.metadata else 'No metadata'}")
-            
-        else:  # Update existing user but preserve role
-            if self.show_logger:
-                logger.info("CustomSQLAlchemy: Updating existing user metadata (preserving role)")
-            
-            # Get existing metadata
-            existing_metadata = existing_user.metadata
-            if isinstance(existing_metadata, str):
-                try:
-                    existing_metadata = json.loads(existing_metadata)
-                except:
-                    existing_metadata = {}
-            
-            # Preserve existing role if it exists
-            new_metadata = user.metadata or {}
-            if existing_metadata.get("role"):
-                new_metadata["role"] = existing_metadata["role"]
-                logger.info(f"CustomSQLAlchemy: Preserved role '{existing_metadata['role']}' for user {user.identifier}")
-            
-            user_dict = {
-                "identifier": str(user.identifier),
-                "metadata": json.dumps(new_metadata)
-            }
-            
-            query = """UPDATE users SET "metadata" = :metadata WHERE "identifier" = :identifier"""
-            await self.execute_sql(query=query, parameters=user_dict)
+        query = """
+            INSERT INTO users ("id", "identifier", "createdAt", "metadata", "message_count")
+            VALUES (:id, :identifier, :createdAt, :metadata, 0)
+            ON CONFLICT ("identifier") DO UPDATE
+            SET "metadata" = users."metadata" || excluded."metadata" || CASE
+                WHEN users."metadata" -> 'role' IS NOT NULL
+                THEN jsonb_build_object('role', users."metadata" -> 'role')
+                ELSE '{}'::jsonb
+            END
+            RETURNING "id", "identifier", "createdAt", "metadata"
+        """
+        parameters = {
+            "id": str(uuid.uuid4()),
+            "identifier": str(user.identifier),
+            "metadata": json.dumps(user.metadata) if user.metadata else "{}",
+            "createdAt": datetime.now().isoformat(),
+        }
+        result = await self.execute_sql(query=query, parameters=parameters)
+        self._invalidate_user(identifier=user.identifier)
+        if not result or not isinstance(result, list):
+            return None
         
-        return await self.get_user(user.identifier)
+        row = result[0]
+        metadata = row.get("metadata") or {}
+        if isinstance(metadata, str):
+            metadata = json.loads(metadata)
+        persisted_user = PersistedUser(
+            id=str(row["id"]),
+            identifier=row["identifier"],
+            createdAt=row["createdAt"],
+            metadata=metadata,
+        )
+        if self.show_logger:
+            logger.info(f"CustomSQLAlchemy: Upserted user {user.identifier} with role {metadata.get('role', 'No role')}")
+        if self.user_cache is not None:
+            self.user_cache.put(persisted_user)
+        return persisted_user
     
     # ========== Message Count Management Methods ==========
     
     async def get_user_message_count(self, user_identifier: str) -> int:
-        """Get current message count for a user"""
+        """Get current message count for a user, including buffered messages"""
+        if self.usage_buffer is not None:
+            return await self.usage_buffer.current_count(user_identifier)
+        return await self.read_user_message_count(user_identifier)
+    
+    async def read_user_message_count(self, user_identifier: str) -> int:
+        """Message count as stored in Postgres"""
         query = """
             SELECT "message_count" 
             FROM users 
@@ -312,6 +844,10 @@ class CustomSQLAlchemyDataLayer(ChainlitSQLAlchemyDataLayer):
     
     async def increment_user_message_count(self, user_identifier: str) -> int:
         """Increment message count for a user and return new count"""
+        if self.usage_buffer is not None:
+            self.usage_buffer.add(user_identifier, 1)
+            return await self.usage_buffer.current_count(user_identifier)
+        
         query = """
             UPDATE users 
             SET "message_count" = COALESCE("message_count", 0) + 1 
@@ -326,6 +862,9 @@ class CustomSQLAlchemyDataLayer(ChainlitSQLAlchemyDataLayer):
     
     async def reset_user_message_count(self, user_identifier: str) -> bool:
         """Reset message count for a user (used when upgrading to paid plan)"""
+        if self.usage_buffer is not None:
+            self.usage_buffer.forget(user_identifier)
+        
         query = """
             UPDATE users 
             SET "message_count" = 0 
@@ -344,6 +883,52 @@ class CustomSQLAlchemyDataLayer(ChainlitSQLAlchemyDataLayer):
         can_send = current_count < limit
         return can_send, current_count
 
+    async def reserve_user_message(self, user_identifier: str, limit: int = 20) -> tuple[bool, int]:
+        """
+        Atomically consume one message of the user's quota if it is not used up.
+        The conditional UPDATE is a single round trip, and concurrent sessions
+        cannot push the count past the limit.
+        Returns (can_send_message: bool, message_count: int) where message_count
+        includes this message when it was reserved.
+        With USAGE_WRITE_BEHIND the reservation is buffered instead (see
+        services/usage_buffer.py).
+        """
+        if self.usage_buffer is not None:
+            return await self.usage_buffer.reserve(user_identifier, limit)
+        
+        query = """
+            UPDATE users 
+            SET "message_count" = COALESCE("message_count", 0) + 1 
+            WHERE "identifier" = :identifier AND COALESCE("message_count", 0) < :limit
+            RETURNING "message_count"
+        """
+        
+        result = await self.execute_sql(query, {"identifier": user_identifier, "limit": limit})
+        if result and isinstance(result, list) and len(result) > 0:
+            return True, result[0].get("message_count", 1)
+        # Nothing updated: either the quota is used up or there is no user row
+        # (which check_user_message_limit has always let through)
+        current_count = await self.get_user_message_count(user_identifier)
+        return current_count < limit, current_count
+    
+    async def refund_user_message(self, user_identifier: str) -> int:
+        """Give back a reserved message whose answer failed; returns the new count"""
+        if self.usage_buffer is not None:
+            self.usage_buffer.refund(user_identifier)
+            return await self.usage_buffer.current_count(user_identifier)
+        
+        query = """
+            UPDATE users 
+            SET "message_count" = GREATEST(COALESCE("message_count", 0) - 1, 0) 
+            WHERE "identifier" = :identifier
+            RETURNING "message_count"
+        """
+        
+        result = await self.execute_sql(query, {"identifier": user_identifier})
+        if result and isinstance(result, list) and len(result) > 0:
+            return result[0].get("message_count", 0)
+        return 0
+
     # ========== Subscription Management Methods ==========
     
     async def get_user_subscription(self, user_id: str) -> Optional[Dict[str, Any]]:
@@ -582,4 +1167,38 @@ class CustomSQLAlchemyDataLayer(ChainlitSQLAlchemyDataLayer):
             "created_at": datetime.now()
         }
         result = await self.execute_sql(query, parameters)
-        return result is not None
\ No newline at end of file
+        return result is not None
+
+# ========== Process-wide Instance ==========
+
+_shared_data_layer: Optional[CustomSQLAlchemyDataLayer] = None
+
+
+def asyncpg_conninfo(conninfo: str) -> str:
+    """Make sure a Postgres connection string uses the asyncpg driver"""
+    if "postgresql" in conninfo and "+asyncpg" not in conninfo:
+        conninfo = conninfo.replace("postgresql://", "postgresql+asyncpg://")
+    return conninfo
+
+
+def get_shared_data_layer(**kwargs) -> CustomSQLAlchemyDataLayer:
+    """
+    The one data layer (and connection pool) of this process, shared by the
+    Chainlit callbacks and the FastAPI routes. Created on first use; `kwargs`
+    (e.g. storage_provider) only apply then.
+    """
+    global _shared_data_layer
+    if _shared_data_layer is None:
+        conninfo = os.environ.get("DATABASE_URL")
+        if not conninfo:
+            raise ValueError("DATABASE_URL environment variable is not set")
+        _shared_data_layer = CustomSQLAlchemyDataLayer(conninfo=asyncpg_conninfo(conninfo), **kwargs)
+    return _shared_data_layer
+
+
+async def close_shared_data_layer() -> None:
+    """Dispose of the shared engine's pooled connections"""
+    global _shared_data_layer
+    if _shared_data_layer is not None:
+        await _shared_data_layer.close()
+        _shared_data_layer = None
@@ -0,0 +1,32 @@
+import asyncio
+
+
+async def test_reserve_stops_at_the_limit(data_layer, make_user):
+    await make_user("quota@example.com")
+    results = [await data_layer.reserve_user_message("quota@example.com", limit=3) for _ in range(4)]
+    assert results == [(True, 1), (True, 2), (True, 3), (False, 3)]
+
+
+async def test_concurrent_reservations_cannot_pass_the_limit(data_layer, make_user):
+    await make_user("tabs@example.com")
+    results = await asyncio.gather(
+        *(data_layer.reserve_user_message("tabs@example.com", limit=4) for _ in range(10))
+    )
+    assert sum(reserved for reserved, _ in results) == 4
+    assert await data_layer.read_user_message_count("tabs@example.com") == 4
+
+
+async def test_refund_gives_back_a_reserved_message(data_layer, make_user):
+    await make_user("refund@example.com")
+    await data_layer.reserve_user_message("refund@example.com", limit=2)
+    await data_layer.reserve_user_message("refund@example.com", limit=2)
+    assert await data_layer.reserve_user_message("refund@example.com", limit=2) == (False, 2)
+
+    assert await data_layer.refund_user_message("refund@example.com") == 1
+    assert await data_layer.reserve_user_message("refund@example.com", limit=2) == (True, 2)
+
+
+async def test_refund_never_goes_below_zero(data_layer, make_user):
+    await make_user("zero@example.com")
+    assert await data_layer.refund_user_message("zero@example.com") == 0
+    assert await data_layer.read_user_message_count("zero@example.com") == 0
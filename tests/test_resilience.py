@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+import pytest
+
+from agent.fakes import FaultInjectingStream, FaultInjector, InjectedFault
+from agent.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    LatencyTracker,
+    hedged,
+    stream_with_first_token_timeout,
+)
+
+
+async def test_hedged_cuts_the_slow_tail():
+    # 10% of calls stall for 2s; the hedge should pull p95 down to the fast path
+    tracker = LatencyTracker("fake", default_delay=0.05, min_samples=5)
+    injector = FaultInjector(latency=0.01, slow_rate=0.1, slow_latency=2.0, seed=7)
+    latencies = []
+    for _ in range(40):
+        start = time.monotonic()
+        assert await hedged(lambda: injector.run(lambda: asyncio.sleep(0, result="ok")), tracker) == "ok"
+        latencies.append(time.monotonic() - start)
+    latencies.sort()
+    assert latencies[int(len(latencies) * 0.95)] < 0.5
+    assert injector.calls > 40
+
+
+async def test_hedged_retries_a_failed_attempt():
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise InjectedFault("first attempt fails")
+        return "ok"
+
+    assert await hedged(flaky, LatencyTracker("fake", default_delay=1.0)) == "ok"
+    assert len(attempts) == 2
+
+
+async def test_hedged_raises_when_every_attempt_fails():
+    failing = FaultInjector(latency=0.0, error_rate=1.0)
+    with pytest.raises(InjectedFault):
+        await hedged(lambda: failing.run(lambda: asyncio.sleep(0)), LatencyTracker("fake"))
+    assert failing.calls == 2
+
+
+async def test_first_token_timeout_restarts_a_stalled_stream():
+    chain = FaultInjectingStream(["a", "b", "c"], first_token_delays=[1.0, 0.0])
+    stream = stream_with_first_token_timeout(lambda: chain.astream({}), first_token_timeout=0.1, retries=1)
+    assert [token async for token in stream] == ["a", "b", "c"]
+
+
+async def test_first_token_timeout_gives_up_after_its_retries():
+    chain = FaultInjectingStream(["a"], first_token_delays=[1.0, 1.0])
+    stream = stream_with_first_token_timeout(lambda: chain.astream({}), first_token_timeout=0.05, retries=1)
+    with pytest.raises(asyncio.TimeoutError):
+        [token async for token in stream]
+
+
+async def test_circuit_breaker_opens_and_fails_fast():
+    breaker = CircuitBreaker("fake", failure_threshold=3, reset_timeout=60)
+    failing = FaultInjector(latency=0.0, error_rate=1.0)
+    rejected = 0
+    for _ in range(10):
+        try:
+            await breaker.call(lambda: failing.run(lambda: asyncio.sleep(0)))
+        except CircuitOpenError:
+            rejected += 1
+        except InjectedFault:
+            pass
+    assert breaker.state == CircuitBreaker.OPEN
+    assert failing.calls == 3
+    assert rejected == 7
+
+
+def test_circuit_breaker_half_open_lets_a_single_probe_through():
+    breaker = CircuitBreaker("fake", failure_threshold=1, reset_timeout=0.0)
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow() and breaker.allow()
+
+
+def test_circuit_breaker_reopens_when_the_probe_fails():
+    breaker = CircuitBreaker("fake", failure_threshold=5, reset_timeout=60)
+    breaker.state = CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_circuit_breaker_release_frees_the_probe_slot():
+    breaker = CircuitBreaker("fake", failure_threshold=1, reset_timeout=0.0)
+    breaker.record_failure()
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.release()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+
+
+async def test_circuit_breaker_releases_the_probe_of_a_cancelled_call():
+    breaker = CircuitBreaker("fake", failure_threshold=1, reset_timeout=0.0)
+    breaker.record_failure()
+    probe = asyncio.create_task(breaker.call(lambda: asyncio.sleep(10)))
+    await asyncio.sleep(0)
+    assert not breaker.allow()
+
+    probe.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await probe
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
@@ -0,0 +1,180 @@
+import uuid
+from typing import List, Optional
+
+import pytest
+from chainlit.types import Pagination, ThreadFilter
+from chainlit.user import User
+
+from sql_data_layer import CustomSQLAlchemyDataLayer, asyncpg_conninfo
+
+# Chainlit's tables as they were before migrations/add_thread_updated_at.sql
+# and migrations/add_thread_search.sql
+UNMIGRATED_TABLES = [
+    """CREATE TABLE users (
+        "id" UUID PRIMARY KEY,
+        "identifier" TEXT NOT NULL UNIQUE,
+        "metadata" JSONB NOT NULL,
+        "createdAt" TEXT,
+        "message_count" INTEGER DEFAULT 0
+    )""",
+    """CREATE TABLE threads (
+        "id" UUID PRIMARY KEY,
+        "createdAt" TEXT,
+        "name" TEXT,
+        "userId" UUID REFERENCES users("id") ON DELETE CASCADE,
+        "userIdentifier" TEXT,
+        "tags" TEXT[],
+        "metadata" JSONB
+    )""",
+    """CREATE TABLE steps (
+        "id" UUID PRIMARY KEY,
+        "name" TEXT NOT NULL,
+        "type" TEXT NOT NULL,
+        "threadId" UUID NOT NULL REFERENCES threads("id") ON DELETE CASCADE,
+        "streaming" BOOLEAN NOT NULL,
+        "input" TEXT,
+        "output" TEXT,
+        "createdAt" TEXT
+    )""",
+    """CREATE TABLE feedbacks (
+        "id" UUID PRIMARY KEY,
+        "forId" UUID NOT NULL,
+        "threadId" UUID NOT NULL REFERENCES threads("id") ON DELETE CASCADE,
+        "value" INT NOT NULL,
+        "comment" TEXT
+    )""",
+]
+
+
+@pytest.fixture
+async def user(make_user):
+    return await make_user("threads@example.com", role="USER")
+
+
+@pytest.fixture
+async def unmigrated_layer(database_url, data_layer):
+    """A data layer on a schema without the optional thread migrations"""
+    schema = f"unmigrated_{uuid.uuid4().hex[:12]}"
+    assert await data_layer.execute_sql(f'CREATE SCHEMA "{schema}"', {}) is not None
+    layer = CustomSQLAlchemyDataLayer(
+        conninfo=asyncpg_conninfo(database_url), connect_args={"server_settings": {"search_path": schema}}
+    )
+    for statement in UNMIGRATED_TABLES:
+        assert await layer.execute_sql(statement, {}) is not None
+    yield layer
+    await layer.close()
+    await data_layer.execute_sql(f'DROP SCHEMA "{schema}" CASCADE', {})
+
+
+async def add_thread(data_layer, user, name: str, created_at: str) -> str:
+    thread_id = str(uuid.uuid4())
+    result = await data_layer.execute_sql(
+        """
+        INSERT INTO threads ("id", "createdAt", "name", "userId", "userIdentifier")
+        VALUES (CAST(:id AS UUID), :created_at, :name, CAST(:user_id AS UUID), :identifier)
+        """,
+        {
+            "id": thread_id,
+            "created_at": created_at,
+            "name": name,
+            "user_id": user.id,
+            "identifier": user.identifier,
+        },
+    )
+    assert result is not None
+    return thread_id
+
+
+async def add_step(data_layer, thread_id: str, created_at: str, output: str = "") -> None:
+    result = await data_layer.execute_sql(
+        """
+        INSERT INTO steps ("id", "name", "type", "threadId", "streaming", "output", "createdAt")
+        VALUES (CAST(:id AS UUID), 'answer', 'assistant_message', CAST(:thread_id AS UUID), false, :output, :created_at)
+        """,
+        {"id": str(uuid.uuid4()), "thread_id": thread_id, "output": output, "created_at": created_at},
+    )
+    assert result is not None
+
+
+async def list_names(data_layer, user, first: int = 20, search: Optional[str] = None) -> List[List[str]]:
+    """Names of every page, following the cursors"""
+    pages = []
+    cursor = None
+    while True:
+        response = await data_layer.list_threads(
+            Pagination(first=first, cursor=cursor), ThreadFilter(userId=user.id, search=search)
+        )
+        pages.append([thread["name"] for thread in response.data])
+        if not response.pageInfo.hasNextPage:
+            return pages
+        cursor = response.pageInfo.endCursor
+
+
+async def test_pages_follow_latest_activity_without_gaps_or_duplicates(data_layer, user):
+    for day in range(1, 6):
+        await add_thread(data_layer, user, f"thread {day}", f"2025-01-0{day}T00:00:00Z")
+    assert await list_names(data_layer, user, first=2) == [
+        ["thread 5", "thread 4"],
+        ["thread 3", "thread 2"],
+        ["thread 1"],
+    ]
+
+
+async def test_a_new_step_moves_its_thread_to_the_top(data_layer, user):
+    oldest = await add_thread(data_layer, user, "oldest", "2025-01-01T00:00:00Z")
+    await add_thread(data_layer, user, "newest", "2025-01-05T00:00:00Z")
+    await add_step(data_layer, oldest, "2025-01-09T00:00:00Z")
+    assert await list_names(data_layer, user) == [["oldest", "newest"]]
+
+
+async def test_threads_of_other_users_are_not_listed(data_layer, user, make_user):
+    other = await make_user("other@example.com", role="USER")
+    await add_thread(data_layer, user, "mine", "2025-01-01T00:00:00Z")
+    await add_thread(data_layer, other, "theirs", "2025-01-02T00:00:00Z")
+    assert await list_names(data_layer, user) == [["mine"]]
+
+
+async def test_a_listing_without_threads_is_one_empty_page(data_layer, user):
+    response = await data_layer.list_threads(Pagination(first=20), ThreadFilter(userId=user.id))
+    assert response.data == []
+    assert not response.pageInfo.hasNextPage
+    assert response.pageInfo.endCursor is None
+
+
+async def test_detect_schema_finds_the_migrated_columns(data_layer):
+    assert await data_layer.detect_schema()
+    assert data_layer.has_column("threads", "updatedAt")
+    assert data_layer.has_column("steps", "search_vector")
+
+
+async def test_unmigrated_threads_are_listed_by_creation_time(unmigrated_layer):
+    user = await unmigrated_layer.create_user(User(identifier="old@example.com", metadata={"role": "USER"}))
+    for day in (2, 1, 3):
+        thread_id = await add_thread(unmigrated_layer, user, f"thread {day}", f"2025-01-0{day}T00:00:00Z")
+        await add_step(unmigrated_layer, thread_id, f"2025-02-0{4 - day}T00:00:00Z")
+
+    assert await list_names(unmigrated_layer, user, first=2) == [["thread 3", "thread 2"], ["thread 1"]]
+    assert not unmigrated_layer.has_column("threads", "updatedAt")
+
+
+async def test_search_ranks_full_text_matches_when_migrated(data_layer, user):
+    custody = await add_thread(data_layer, user, "custody", "2025-01-01T00:00:00Z")
+    await add_step(data_layer, custody, "2025-01-01T00:01:00Z", "Joint custody schedules in Texas")
+    support = await add_thread(data_layer, user, "support", "2025-01-02T00:00:00Z")
+    await add_step(data_layer, support, "2025-01-02T00:01:00Z", "Child support guidelines")
+
+    response = await data_layer.list_threads(Pagination(first=20), ThreadFilter(userId=user.id, search="schedule"))
+    assert data_layer.thread_search_mode == "fulltext"
+    assert [thread["name"] for thread in response.data] == ["custody"]
+    assert "<mark>" in response.data[0]["snippet"]
+
+
+async def test_search_falls_back_to_substring_without_search_vector(unmigrated_layer):
+    user = await unmigrated_layer.create_user(User(identifier="old@example.com", metadata={"role": "USER"}))
+    custody = await add_thread(unmigrated_layer, user, "custody", "2025-01-01T00:00:00Z")
+    await add_step(unmigrated_layer, custody, "2025-01-01T00:01:00Z", "Joint custody schedules in Texas")
+    support = await add_thread(unmigrated_layer, user, "support", "2025-01-02T00:00:00Z")
+    await add_step(unmigrated_layer, support, "2025-01-02T00:01:00Z", "Child support guidelines")
+
+    assert await list_names(unmigrated_layer, user, search="custody sched") == [["custody"]]
+    assert unmigrated_layer.thread_search_mode == "substring"
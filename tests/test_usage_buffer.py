@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from services.usage_buffer import UsageCounterBuffer
+
+
+@pytest.fixture
+def buffer(data_layer):
+    data_layer.usage_buffer = UsageCounterBuffer(data_layer, flush_interval=60, max_pending=100)
+    return data_layer.usage_buffer
+
+
+async def test_reservations_are_buffered_until_flushed(data_layer, buffer, make_user):
+    await make_user("buffered@example.com")
+    results = [await data_layer.reserve_user_message("buffered@example.com", limit=3) for _ in range(4)]
+    assert results == [(True, 1), (True, 2), (True, 3), (False, 3)]
+    assert await data_layer.read_user_message_count("buffered@example.com") == 0
+
+    assert await buffer.flush() == 1
+    assert await data_layer.read_user_message_count("buffered@example.com") == 3
+    assert buffer.pending_messages == 0
+    assert await data_layer.get_user_message_count("buffered@example.com") == 3
+
+
+async def test_one_flush_writes_every_user_with_refunds_netted(data_layer, buffer, make_user):
+    await make_user("first@example.com")
+    await make_user("second@example.com")
+    await data_layer.reserve_user_message("first@example.com", limit=10)
+    await data_layer.reserve_user_message("first@example.com", limit=10)
+    await data_layer.refund_user_message("first@example.com")
+    await data_layer.reserve_user_message("second@example.com", limit=10)
+
+    assert await buffer.flush() == 2
+    assert await data_layer.read_user_message_count("first@example.com") == 1
+    assert await data_layer.read_user_message_count("second@example.com") == 1
+
+
+async def test_failed_flush_keeps_the_messages_buffered(data_layer, buffer, make_user, monkeypatch):
+    await make_user("retry@example.com")
+    await data_layer.reserve_user_message("retry@example.com", limit=10)
+
+    # execute_sql reports query errors by returning None
+    async def failing_execute_sql(query, parameters):
+        return None
+
+    with monkeypatch.context() as patch:
+        patch.setattr(data_layer, "execute_sql", failing_execute_sql)
+        assert await buffer.flush() == 0
+    assert buffer.pending_messages == 1
+    assert await data_layer.get_user_message_count("retry@example.com") == 1
+
+    assert await buffer.flush() == 1
+    assert await data_layer.read_user_message_count("retry@example.com") == 1
+
+
+async def test_max_pending_triggers_a_flush(data_layer, make_user):
+    data_layer.usage_buffer = UsageCounterBuffer(data_layer, flush_interval=60, max_pending=2)
+    await make_user("busy@example.com")
+    await data_layer.reserve_user_message("busy@example.com", limit=10)
+    await data_layer.reserve_user_message("busy@example.com", limit=10)
+
+    for _ in range(50):
+        if await data_layer.read_user_message_count("busy@example.com") == 2:
+            break
+        await asyncio.sleep(0.01)
+    assert await data_layer.read_user_message_count("busy@example.com") == 2
+
+
+async def test_close_writes_what_is_still_buffered(data_layer, buffer, make_user):
+    await make_user("closing@example.com")
+    await data_layer.reserve_user_message("closing@example.com", limit=10)
+    await buffer.close()
+    assert await data_layer.read_user_message_count("closing@example.com") == 1
@@ -0,0 +1,28 @@
+async def test_create_user_inserts_a_new_user(data_layer, make_user):
+    user = await make_user("new@example.com", provider="google", role="USER")
+    assert user.identifier == "new@example.com"
+    assert user.metadata == {"provider": "google", "role": "USER"}
+    assert await data_layer.read_user_message_count("new@example.com") == 0
+
+
+async def test_create_user_merges_metadata_but_keeps_the_stored_role(data_layer, make_user):
+    first = await make_user("admin@example.com", provider="password", role="ADMIN")
+    again = await make_user("admin@example.com", provider="google", role="USER", name="Admin")
+
+    assert again.id == first.id
+    assert again.metadata == {"provider": "google", "role": "ADMIN", "name": "Admin"}
+    stored = await data_layer.get_user("admin@example.com")
+    assert stored.metadata["role"] == "ADMIN"
+
+
+async def test_create_user_sets_a_role_when_none_was_stored(data_layer, make_user):
+    await make_user("legacy@example.com", provider="google")
+    user = await make_user("legacy@example.com", provider="google", role="USER")
+    assert user.metadata["role"] == "USER"
+
+
+async def test_create_user_does_not_reset_the_message_count(data_layer, make_user):
+    await make_user("counted@example.com", role="USER")
+    await data_layer.reserve_user_message("counted@example.com", limit=10)
+    await make_user("counted@example.com", role="USER")
+    assert await data_layer.read_user_message_count("counted@example.com") == 1